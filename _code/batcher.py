@@ -0,0 +1,232 @@
+import threading
+import time
+from collections import deque, OrderedDict
+from Queue import Queue, Full, Empty
+import numpy as np
+
+
+class Overloaded(Exception):
+    '''The request queue is full'''
+
+
+class BatchTimeout(Exception):
+    '''No sentence came back in time'''
+
+
+class _Request(object):
+    '''One queued run call and the slot for its answer'''
+
+    def __init__(self, mc, input_text, key_gram_size, value_gram_size, timeout):
+        self.mc = mc
+        self.input_text = input_text
+        self.group = (id(mc), key_gram_size, value_gram_size)
+        self.key_gram_size = key_gram_size
+        self.value_gram_size = value_gram_size
+        self.queued = time.time()
+        self.expires = self.queued + timeout
+        self.done = threading.Event()
+        self.sent = None
+        self.error = None
+
+
+class Batcher(object):
+    '''Coalesces concurrent MarkovChain.run calls into run_batch calls
+
+    Input: seconds to gather requests after the first one arrives, most
+    requests per batch, depth of the request queue, worker threads, seconds
+    a caller waits in all, seconds a batch may spend generating and the
+    most tokens of a sentence
+    run() queues a request and blocks until its sentence is ready.
+    A dispatcher thread takes the requests that arrive within window and
+    hands each model's share to the workers as one run_batch call.
+    With every worker busy the dispatcher waits and the queue fills, past
+    queue_depth run() raises Overloaded right away. A caller still
+    waiting after timeout gets BatchTimeout and its request is dropped
+    from any batch that has not started
+    The requests for the same model and gram sizes in a batch share one
+    run_batch call over their distinct input texts once there are
+    min_batch of them, all their chains advancing in lockstep; below that
+    run_batch costs more per sentence than run and they run one by one
+    Callers block without a timeout (a timed wait polls in Python 2), a
+    watchdog thread answers the expired requests instead'''
+
+    def __init__(self, window=0.005, max_batch=64, queue_depth=256, workers=2,
+                 timeout=1.0, deadline=0.25, min_batch=24, max_tokens=None):
+        self.window = window
+        self.max_batch = max_batch
+        self.min_batch = min_batch
+        self.timeout = timeout
+        self.deadline = deadline
+        self.max_tokens = max_tokens
+        self.workers = workers
+        self._requests = Queue(maxsize=queue_depth)
+        self._jobs = Queue(maxsize=workers)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._running = False
+        self.accepted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.batches = 0
+        self.batch_sizes = deque(maxlen=1000)
+        self.waits = deque(maxlen=1000)
+
+    def start(self):
+        '''Start the dispatcher, the workers and the watchdog'''
+        if self._threads:
+            return self
+        self._running = True
+        targets = [('batcher-dispatch', self._dispatch_loop)] + \
+            [('batcher-worker-%d' % idx, self._work_loop) for idx in xrange(self.workers)]
+        for name, target in targets:
+            thread = threading.Thread(target=target, name=name)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        self._watchdog = threading.Thread(target=self._watch_loop, name='batcher-watchdog')
+        self._watchdog.daemon = True
+        self._watchdog.start()
+        return self
+
+    def stop(self):
+        '''Stop the threads once the queued requests are answered'''
+        if not self._threads:
+            return
+        self._requests.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._running = False
+        self._watchdog.join()
+
+    def run(self, mc, input_text, key_gram_size=2, value_gram_size=1, timeout=None):
+        '''Return a sentence from mc for input_text, like mc.run
+        Raise Overloaded when the queue is full and BatchTimeout past timeout'''
+        request = _Request(mc, input_text, key_gram_size, value_gram_size,
+                           self.timeout if timeout is None else timeout)
+        with self._lock:
+            self._pending.add(request)
+        try:
+            self._requests.put_nowait(request)
+        except Full:
+            with self._lock:
+                self._pending.discard(request)
+                self.rejected += 1
+            raise Overloaded()
+        with self._lock:
+            self.accepted += 1
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.sent
+
+    def _finish(self, request, sent=None, error=None):
+        '''Answer a request unless it was answered already'''
+        with self._lock:
+            if request not in self._pending:
+                return
+            self._pending.discard(request)
+            if isinstance(error, BatchTimeout):
+                self.timeouts += 1
+        request.sent = sent
+        request.error = error
+        request.done.set()
+
+    def _watch_loop(self):
+        '''Time out the requests past their expiry until stopped'''
+        tick = min(self.timeout / 10.0, 0.01)
+        while self._running:
+            time.sleep(tick)
+            now = time.time()
+            with self._lock:
+                expired = [request for request in self._pending if request.expires <= now]
+            for request in expired:
+                self._finish(request, error=BatchTimeout())
+
+    def _dispatch_loop(self):
+        '''Gather requests into batches until stop() queues None'''
+        while True:
+            first = self._requests.get()
+            if first is None:
+                break
+            # Let the requests arriving right behind the first one catch up
+            if self.window:
+                time.sleep(self.window)
+            batch = [first]
+            stopping = False
+            while len(batch) < self.max_batch:
+                try:
+                    request = self._requests.get_nowait()
+                except Empty:
+                    break
+                if request is None:
+                    stopping = True
+                    break
+                batch.append(request)
+            groups = {}
+            for request in batch:
+                groups.setdefault(request.group, []).append(request)
+            for group in groups.itervalues():
+                # Blocks while every worker is busy, which backs up the queue
+                self._jobs.put(group)
+            if stopping:
+                break
+        for _ in self._threads[1:]:
+            self._jobs.put(None)
+
+    def _work_loop(self):
+        '''Run batches until the dispatcher sends None'''
+        while True:
+            group = self._jobs.get()
+            if group is None:
+                break
+            self._run_group(group)
+
+    def _run_group(self, group):
+        '''Answer the requests of one model and gram sizes, with one
+        run_batch call over their distinct input texts when there are
+        min_batch of them'''
+        with self._lock:
+            group = [request for request in group if request in self._pending]
+        if not group:
+            return
+        start = time.time()
+        first = group[0]
+        try:
+            if len(group) >= self.min_batch:
+                by_text = OrderedDict()
+                for request in group:
+                    by_text.setdefault(request.input_text, []).append(request)
+                batch = first.mc.run_batch(by_text.keys(), [len(requests) for requests in by_text.values()],
+                                           first.key_gram_size, first.value_gram_size,
+                                           max_tokens=self.max_tokens, deadline=self.deadline)
+                for requests, sents in zip(by_text.values(), batch):
+                    for request, sent in zip(requests, sents):
+                        self._finish(request, sent)
+            else:
+                for request in group:
+                    self._finish(request, first.mc.run(request.input_text, first.key_gram_size,
+                                                       first.value_gram_size, max_tokens=self.max_tokens,
+                                                       deadline=self.deadline))
+        except Exception as error:
+            for request in group:
+                self._finish(request, error=error)
+        with self._lock:
+            self.batches += 1
+            self.batch_sizes.append(len(group))
+            self.waits.extend(start - request.queued for request in group)
+
+    def metrics(self):
+        '''Return a dict of counters, batch sizes and queue wait in seconds'''
+        with self._lock:
+            sizes = list(self.batch_sizes)
+            waits = list(self.waits)
+            return dict(accepted=self.accepted, rejected=self.rejected, timeouts=self.timeouts,
+                        batches=self.batches, queued=self._requests.qsize(),
+                        pending=len(self._pending),
+                        queue_depth=self._requests.maxsize,
+                        batch_size_mean=float(np.mean(sizes)) if sizes else None,
+                        batch_size_max=max(sizes) if sizes else None,
+                        wait_mean=float(np.mean(waits)) if waits else None,
+                        wait_max=max(waits) if waits else None)
@@ -0,0 +1,172 @@
+import glob
+import io
+import os
+from array import array
+import numpy as np
+
+
+def _iter_fnames(source):
+    '''Return the files a source string names: a file, directory or glob'''
+    if os.path.isdir(source):
+        return sorted(os.path.join(source, name) for name in os.listdir(source)
+                      if os.path.isfile(os.path.join(source, name)))
+    if os.path.isfile(source):
+        return [source]
+    fnames = sorted(glob.glob(source))
+    if not fnames:
+        raise IOError('No corpus files match %s' % source)
+    return fnames
+
+
+def iter_chunks(source, chunk_size=1 << 20):
+    '''Yield the text of a corpus in chunks with line breaks replaced
+
+    source is a filename, a directory, a glob or an iterable of documents
+    Documents are separated by a space, as if they were one file'''
+    if isinstance(source, basestring):
+        documents = _iter_files(_iter_fnames(source), chunk_size)
+    else:
+        documents = ([doc] for doc in source)
+    for doc in documents:
+        for chunk in doc:
+            if isinstance(chunk, str):
+                chunk = chunk.decode('utf-8')
+            yield chunk.replace('\n', ' ')
+        yield u' '
+
+
+def _iter_files(fnames, chunk_size):
+    '''Yield an iterator of chunks for each file'''
+    for fname in fnames:
+        yield _read_chunks(fname, chunk_size)
+
+
+def _read_chunks(fname, chunk_size):
+    '''Yield a file chunk_size characters at a time'''
+    with io.open(fname, 'r', encoding='utf-8', newline='') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def iter_sentences(source, chunk_size=1 << 20):
+    '''Yield the sentences of a corpus, splitting it chunk by chunk
+
+    The last sentence of every chunk may be cut off, so its text is
+    carried over and split again with the next chunk'''
+    # Only reading a corpus needs nltk, loading a model does not
+    from nltk.tokenize import sent_tokenize
+    carry = u''
+    for chunk in iter_chunks(source, chunk_size):
+        text = carry + chunk
+        sent_list_of_str = sent_tokenize(text)
+        if not sent_list_of_str:
+            carry = text
+            continue
+        for sent in sent_list_of_str[:-1]:
+            yield sent
+        start = text.rfind(sent_list_of_str[-1])
+        carry = text[start:] if start >= 0 else sent_list_of_str[-1]
+    for sent in sent_tokenize(carry):
+        yield sent
+
+
+def count_sentence(sent, sent_counts, capacity=1000):
+    '''Count a sentence in a bounded summary of the most common ones
+    (Misra-Gries: when it is full every count drops by one)
+    Counting more sentences into a summary gives the summary of all of them'''
+    if sent in sent_counts:
+        sent_counts[sent] += 1
+    elif len(sent_counts) < capacity:
+        sent_counts[sent] = 1
+    else:
+        for key in sent_counts.keys():
+            sent_counts[key] -= 1
+            if not sent_counts[key]:
+                del sent_counts[key]
+
+
+def top_sentences(sent_counts, n=100):
+    '''Return the n most common (sentence, count) of a summary, ties in
+    sentence order'''
+    return sorted(sent_counts.iteritems(), key=lambda item: (-item[1], item[0]))[:n]
+
+
+def source_name(source):
+    '''Return a printable name for a source, None for an iterable'''
+    return source if isinstance(source, basestring) else None
+
+
+class Corpus(object):
+    '''A corpus read and tokenized in a single pass
+
+    Input: a filename, directory, glob or iterable of documents
+    Built once and handed to MarkovDict, TrueCase, SyntaxTree and
+    SyntaxChain (MarkovChain gets it through the model) so none of them
+    read or tokenize the text again
+
+    words are the distinct whitespace tokens in order of appearance and
+    case_counts how often each appears, case is kept
+    tokens holds the word id of every token, sentence i is
+    tokens[sent_offsets[i]:sent_offsets[i + 1]]
+    sentence_summary is a bounded summary of the sentence counts, started
+    from a copy of the sentence_summary given, and sentence_counts the
+    most common sentences in it with their counts
+    tokens are only needed while models are fit, release() frees them
+    and keeps the rest; MarkovDict releases the corpora it reads itself
+    once they are counted'''
+
+    def __init__(self, source, chunk_size=1 << 20, sentence_summary=None):
+        self.fname = source_name(source)
+        self.words = []
+        self.tokens = array('i')
+        self.sent_offsets = array('l', [0])
+        word_ids = {}
+        case_counts = array('l')
+        sent_counts = dict(sentence_summary or {})
+        for sent in iter_sentences(source, chunk_size):
+            for word in sent.split():
+                word_id = word_ids.get(word)
+                if word_id is None:
+                    word_id = word_ids[word] = len(self.words)
+                    self.words.append(word)
+                    case_counts.append(0)
+                case_counts[word_id] += 1
+                self.tokens.append(word_id)
+            self.sent_offsets.append(len(self.tokens))
+            count_sentence(sent, sent_counts)
+        self.case_counts = np.array(case_counts, dtype=np.int64)
+        self.sentence_summary = sent_counts
+        self.sentence_counts = top_sentences(sent_counts)
+
+    def __len__(self):
+        if self.sent_offsets is None:
+            return self.n_sentences
+        return len(self.sent_offsets) - 1
+
+    def release(self):
+        '''Free tokens and sent_offsets, the sentences can't be read again'''
+        self.n_sentences = len(self)
+        self.tokens = None
+        self.sent_offsets = None
+
+    def iter_words(self):
+        '''Yield the list of words of every sentence'''
+        if self.tokens is None:
+            raise ValueError('the tokens of this Corpus were released')
+        for i in xrange(len(self)):
+            yield [self.words[idx] for idx in self.tokens[self.sent_offsets[i]:self.sent_offsets[i + 1]]]
+
+    def iter_text(self):
+        '''Yield every sentence as a string'''
+        for words in self.iter_words():
+            yield ' '.join(words)
+
+
+def as_corpus(source):
+    '''Return source if it is already a Corpus, else read it into one'''
+    if isinstance(source, Corpus):
+        return source
+    return Corpus(source)
@@ -0,0 +1,55 @@
+import re
+from string import punctuation
+
+# Punctuation sticks to the word before it
+_SPACE_BEFORE_PUNCTUATION = re.compile(' (?=[%s])' % re.escape(punctuation))
+_PUNCTUATION = frozenset(punctuation)
+
+
+def join_words(words):
+    '''Return words joined by spaces, with no space before punctuation'''
+    return _SPACE_BEFORE_PUNCTUATION.sub('', ' '.join(words))
+
+
+def iter_tokens(words):
+    '''Yield the whitespace separated tokens of join_words(words) as the
+    words come in, a word starting with punctuation is added to the token
+    before it'''
+    token = None
+    for word in words:
+        if not word:
+            if token:
+                yield token
+            token = None
+        elif token and word[0] in _PUNCTUATION:
+            token += word
+        else:
+            if token:
+                yield token
+            token = word
+    if token:
+        yield token
+
+
+def merge_words(words, end=None):
+    '''Return the whitespace separated tokens of join_words(words)
+    end is added to the last token when it does not end in punctuation'''
+    tokens = list(iter_tokens(words))
+    if end and tokens and tokens[-1][-1] not in _PUNCTUATION:
+        tokens[-1] += end
+    return tokens
+
+
+def detokenize(token_ids, vocab, truecaser=None):
+    '''Return the sentence string of a list of token ids
+    With a TrueCase every id is decoded, stuck to the word before it and
+    cased in one pass, the result is cached by token ids'''
+    if truecaser is None:
+        return join_words(vocab.decode(token_ids))
+    return truecaser.truecase(iter_tokens(vocab.word(idx) for idx in token_ids),
+                              key=tuple(token_ids))
+
+
+def detokenize_batch(sents, vocab, truecaser):
+    '''Return the true cased sentence strings of lists of token ids'''
+    return [detokenize(token_ids, vocab, truecaser) for token_ids in sents]
@@ -0,0 +1,93 @@
+import numpy as np
+from _code.vocab import Vocab
+
+
+class GrammarTable(object):
+    '''Sentence structures and the words seen with each tag, as int arrays
+
+    Input: list of sentences of (word, tags...) tuples, as in
+    SyntaxTree.chunk_list, pos_list or chunk_pos_list
+    Words and tags are interned in a Vocab, a structure is the tuple of
+    tag ids of a sentence
+
+    Structures are sorted by count, most common first, structure s is
+    struct_tags[struct_offsets[s]:struct_offsets[s + 1]]
+    The tokens with tag t are tag_tokens[tag_offsets[t]:tag_offsets[t + 1]]
+    and cum_weights is a running count over them, so a word is picked in
+    proportion to how often it has the tag with a single searchsorted'''
+
+    _fields = ['struct_offsets', 'struct_tags', 'struct_counts',
+               'tag_offsets', 'tag_tokens', 'cum_weights']
+
+    def __init__(self, sent_list):
+        self.vocab = Vocab()
+        struct_counts = {}
+        token_counts = {}
+        for sent in sent_list:
+            struct = []
+            for tup in sent:
+                # tup[0] is word, tup[1:] is tuple of tags
+                token = self.vocab.add(tup[0], tuple(tup[1:]))
+                token_counts[token] = token_counts.get(token, 0) + 1
+                struct.append(self.vocab.token_tag[token])
+            struct = tuple(struct)
+            struct_counts[struct] = struct_counts.get(struct, 0) + 1
+
+        structs = sorted(struct_counts, key=lambda struct: (-struct_counts[struct], struct))
+        self.struct_offsets = np.concatenate(
+            [[0], np.cumsum([len(struct) for struct in structs])]).astype(np.int64)
+        self.struct_tags = np.array([tag for struct in structs for tag in struct], dtype=np.int32)
+        self.struct_counts = np.array([struct_counts[struct] for struct in structs], dtype=np.int64)
+
+        token_tag = np.array(self.vocab.token_tag, dtype=np.int32)
+        self.tag_tokens = np.argsort(token_tag, kind='mergesort').astype(np.int32)
+        tag_counts = np.bincount(token_tag, minlength=max(len(self.vocab.tags), 1))
+        self.tag_offsets = np.concatenate([[0], np.cumsum(tag_counts)]).astype(np.int64)
+        weights = np.array([token_counts[token] for token in self.tag_tokens], dtype=np.int64)
+        self.cum_weights = np.cumsum(weights)
+
+    def __len__(self):
+        return len(self.struct_counts)
+
+    def to_arrays(self, arrays, prefix):
+        '''Add the arrays of the table and its vocab to arrays'''
+        self.vocab.to_arrays(arrays, prefix + 'vocab.')
+        for field in self._fields:
+            arrays[prefix + field] = getattr(self, field)
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix):
+        '''Return a GrammarTable backed by arrays written with to_arrays'''
+        table = cls.__new__(cls)
+        table.vocab = Vocab.from_arrays(arrays, prefix + 'vocab.')
+        for field in cls._fields:
+            setattr(table, field, arrays[prefix + field])
+        return table
+
+    def structure(self, struct_id):
+        '''Return the tag ids of a structure'''
+        return self.struct_tags[self.struct_offsets[struct_id]:self.struct_offsets[struct_id + 1]]
+
+    def n_structures(self, min_appearances):
+        '''Return how many structures appear at least min_appearances times'''
+        # struct_counts is descending, search it negated
+        return int(np.searchsorted(-self.struct_counts, -min_appearances, side='right'))
+
+    def pick_structure(self, min_appearances=2):
+        '''Return a structure id, every structure seen at least
+        min_appearances times is equally likely, None if there are none'''
+        n_structs = self.n_structures(min_appearances)
+        if not n_structs:
+            return None
+        return np.random.randint(n_structs)
+
+    def fill_words(self, struct):
+        '''Return a word for every tag id in struct, in proportion to how
+        often each word has that tag'''
+        struct = np.asarray(struct, dtype=np.int64)
+        lo = self.tag_offsets[struct]
+        hi = self.tag_offsets[struct + 1]
+        base = np.where(lo > 0, self.cum_weights[np.maximum(lo - 1, 0)], 0)
+        target = base + np.random.random_sample(len(struct)) * (self.cum_weights[hi - 1] - base)
+        idx = np.minimum(np.searchsorted(self.cum_weights, target, side='right'), hi - 1)
+        return self.vocab.decode(self.tag_tokens[idx].tolist())
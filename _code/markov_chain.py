@@ -1,72 +1,197 @@
 import re
+import sys
+import time
+import threading
 import numpy as np
 import cPickle as pickle
-from nltk.corpus import stopwords
-from nltk.tokenize.regexp import WhitespaceTokenizer
-from collections import Counter
 from _code.truecase import TrueCase
+from _code.detokenize import detokenize, detokenize_batch
 from _code.markov_dict import MarkovDict
-from string import punctuation
-from nltk.tokenize import sent_tokenize
+from _code.suffix_model import END
+from _code.stop_words import ENGLISH_STOP_WORDS, most_common_words
+
+
+def check_random_state(random_state):
+	'''Return a np.random.RandomState for None, an int seed or a RandomState
+	None gets a new state seeded by the OS, never the global np.random'''
+	if isinstance(random_state, np.random.RandomState):
+		return random_state
+	return np.random.RandomState(random_state)
+
+
+class _Timeout(Exception):
+	'''Raised by a chain once the deadline of its call has passed'''
+
+
+class _Stuck(Exception):
+	'''Raised by a chain that can't go on without copying the corpus'''
+
+
+class _RunContext(object):
+	'''State of one call to run or run_batch
+
+	model is a snapshot of the api dict, so a concurrent add_documents
+	can't swap the tables out in the middle of a chain
+	rng is the only source of randomness, a seeded call is deterministic
+	backoff runs over the model's SuffixModel with contexts of up to
+	max_order tokens (default gram_size)
+	ngrams is the model's NGramSet when originality is checked, a chain
+	never draws a value that copies the corpus and backs up at most
+	max_retries values when every follower of a key would
+	A sentence has at most max_tokens tokens, half from each chain, and
+	the call raises _Timeout deadline seconds after it starts
+	Near the end of its budget a chain only draws values that can still
+	end the sentence in time, once three quarters of the deadline have
+	gone it heads for the nearest end
+	steps is None, or a list that gets the number of steps of every chain
+	run, metrics set it'''
+
+	# Steps between reads of the clock
+	clock_every = 8
+
+	def __init__(self, model, key_gram_size, value_gram_size, match, random_state,
+				 backoff=False, max_order=None, min_followers=2, originality=True, max_retries=10,
+				 max_tokens=None, deadline=None):
+		if backoff and model.get('suffix_model') is None:
+			raise ValueError('backoff needs a MarkovDict built with backoff=True')
+		if key_gram_size < 1 or value_gram_size < 1:
+			raise ValueError('key_gram_size and value_gram_size must be at least 1')
+		if max_tokens is not None and max_tokens < 1:
+			raise ValueError('max_tokens must be at least 1, None for no limit')
+		if deadline is not None and deadline <= 0:
+			raise ValueError('deadline must be positive, None for no limit')
+		self.model = model
+		self.match = match
+		self.key_gram_size = min(key_gram_size, model['gram_size'])
+		self.value_gram_size = min(value_gram_size, model['gram_size'])
+		while self.key_gram_size + self.value_gram_size < model['gram_size']:
+			self.value_gram_size += 1
+		self.rng = check_random_state(random_state)
+		self.backoff = backoff
+		self.max_order = max_order or model['gram_size']
+		self.min_followers = min_followers
+		self.ngrams = model.get('ngram_set') if originality else None
+		# A key and its value are a corpus span, at copy_len every step would copy
+		if self.ngrams is not None and not backoff and \
+				model['gram_size'] + self.value_gram_size >= self.ngrams.n:
+			raise ValueError('copy_len must be larger than gram_size + value_gram_size, '
+							 'every value would copy the corpus')
+		self.max_retries = max_retries
+		# Plain ints and floats, these are checked on every step
+		self.chain_tokens = (max_tokens + 1) // 2 if max_tokens is not None else sys.maxint
+		horizon = model['f_dict'].end_horizon * self.value_gram_size
+		self.close_at = self.chain_tokens - horizon if max_tokens is not None else sys.maxint
+		start = time.time()
+		self.expires = start + deadline if deadline is not None else None
+		self.closes = start + 0.75 * deadline if deadline is not None else None
+		self.late = False
+		self._ticks = 0
+		self.steps = None
+
+	def check_time(self, steps=1):
+		'''Raise _Timeout once the deadline has passed
+		The clock is read once every clock_every chain steps, which also
+		sets late once three quarters of the deadline have gone'''
+		if self.expires is None:
+			return
+		self._ticks += steps
+		if self._ticks < self.clock_every:
+			return
+		self._ticks = 0
+		now = time.time()
+		if now >= self.expires:
+			raise _Timeout()
+		self.late = now >= self.closes
+
+	def room(self, length):
+		'''Return how many tokens a chain of length tokens can still add,
+		length may be an array'''
+		return self.chain_tokens - length
+
+	def closing(self, length):
+		'''Return True once a chain of length tokens should head for the
+		end of its sentence'''
+		return self.late or length >= self.close_at
+
+	def closing_chains(self, lengths):
+		'''Return closing for an array of chain lengths'''
+		return (lengths >= self.close_at) | self.late
+
+	def max_steps(self, length):
+		'''Return how many more values a closing chain can take before
+		it has to end, none once it is late, length may be an array'''
+		if self.late:
+			return length * 0
+		return (self.chain_tokens - length) // self.value_gram_size
+
 
 class MarkovChain(object):
 	'''Create a MarkovChain from the given dictionary and parameters,
 	run() returns a sentence given a seed
 
-	markov_dict should be a MarkovDict().api dictionary'''
+	markov_dict should be a MarkovDict().api dictionary
+	neighbor_dict maps words outside the corpus to similar words, a
+	NeighborIndex or a dict of word -> list of words
+	MarkovChain.from_model(path) runs from a model file written by MarkovDict.save
+	Chains run over token ids and are decoded to words at the end
+	The parameters and random state of a call live in a _RunContext, so
+	one MarkovChain can serve many threads at once'''
 
 	def __init__(self, markov_dict, priority_list=None, not_found_list=None, neighbor_dict=None):
 		self.markov_dict = markov_dict
 		self.gtype = self.markov_dict['gtype']
-		self.stop_words = set(stopwords.words('english'))
+		self.stop_words = ENGLISH_STOP_WORDS
 		self.neighbor_dict = neighbor_dict
-		self.tokenizer = WhitespaceTokenizer()
-		self.word_list = self.tokenizer.tokenize(self.markov_dict['corpus_txt'])
-		self.lower_word_list = [w.lower() for w in self.word_list]
-		# Count of word freq, maintaining case
-		self.word_dict_count = Counter(self.word_list)
-		self.truecaser = TrueCase(self.markov_dict['fname'])
+		self.user_priority_list = priority_list
+		self.user_not_found_list = not_found_list
+		self._lock = threading.Lock()
+		self._load_model()
+
+	def _load_model(self):
+		'''Set up the word lists from the model, again whenever it changes'''
+		self.model_version = self.markov_dict.get('version')
+		# The model keeps a true caser built when it was fit, older ones count the words here
+		self.truecaser = self.markov_dict.get('truecaser')
+		if self.truecaser is None:
+			self.truecaser = TrueCase(case_words=list(self.markov_dict['case_words']),
+									  case_counts=self.markov_dict['case_counts'])
+		# Its case map has every distinct lowercase word of the corpus
+		self.lower_words = self.truecaser.case_map
 
 		# Create priority and not_found_list if none were entered
-		if priority_list:
-			self.priority_list = priority_list
+		if self.user_priority_list:
+			self.priority_list = self.user_priority_list
 		else:
 			self._make_priority()
-		if not_found_list:
-			self.not_found_list = not_found_list
+		if self.user_not_found_list:
+			self.not_found_list = self.user_not_found_list
 		else:
 			self._make_not_found()
 
+	@classmethod
+	def from_model(cls, fname, **kwargs):
+		'''Return a MarkovChain over a model file, the corpus is not read'''
+		return cls(MarkovDict.load(fname).api, **kwargs)
+
 	def _make_priority(self, n=10):
 		'''Return the n most common words in the corpus'''
-		# Remove stop_words
-		content = [w for w in self.lower_word_list if w not in self.stop_words]
-		# Remove words that are only punctuation
-		content_no_punc = []
-		for word in content:
-			tmp = False
-			for char in word:
-				if char not in punctuation:
-					tmp = True
-				else:
-					continue
-			if tmp:
-				content_no_punc.append(word)
-
-		priority_dict = Counter(content_no_punc)
-		self.priority_list = [key for key, val in priority_dict.most_common(n)]
+		# Stop words and words that are only punctuation are left out
+		priority_words = self.markov_dict.get('priority_words')
+		if priority_words is None:
+			priority_words = most_common_words(self.markov_dict['case_words'],
+											   self.markov_dict['case_counts'], n)
+		self.priority_list = list(priority_words[:n])
 
 	def _make_not_found(self, n=15):
 		'''Return the n most common sentences in the corpus'''
-		not_found_dict = Counter(sent_tokenize(self.markov_dict['corpus_txt']))
-		common_sent = [key for key, val in not_found_dict.most_common(n)]
+		common_sent = self.markov_dict['common_sentences'][:n]
 		self.not_found_list = []
 		# Might fill with small stuff, don't let that happen
 		for sent in common_sent:
 			if len(sent) > 5:
 				self.not_found_list.append(sent)
 
-	def _get_input(self, input_phrase):
+	def _get_input(self, input_phrase, ctx):
 		'''Take in the raw input from the user'''
 		# Lowercase and remove common punc
 		input_phrase = input_phrase.lower()
@@ -77,6 +202,9 @@ class MarkovChain(object):
 
 		# List of words from a potential input phrase
 		word_list = input_phrase.split()
+		# Nothing but punctuation or spaces, there is no seed
+		if not word_list:
+			return None
 
 		# Make a list of words that are in priority_list
 		priority_words = [w for w in word_list if w in self.priority_list]
@@ -86,77 +214,168 @@ class MarkovChain(object):
 
 		# Look for priority words first, content second, and finally random
 		if priority_words:
-			seed = np.random.choice(priority_words)
+			seed = ctx.rng.choice(priority_words)
 		elif content:
-			seed = np.random.choice(content)
+			seed = ctx.rng.choice(content)
 		else:  # Final option is a random word
-		    seed = np.random.choice(word_list)
+		    seed = ctx.rng.choice(word_list)
 
 		# if the words is not in text, find neighbors
 		if not self._in_text(seed):
-			seed = self._get_neighbor(seed)
+			seed = self._get_neighbor(seed, ctx)
 
 		return seed
 
 
 	def _in_text(self, word):
 		'''Return true if word is in the corpus'''
-		return word.lower() in set(self.lower_word_list)
+		return word.lower() in self.lower_words
 
-	def _get_neighbor(self, seed):
+	def _get_neighbor(self, seed, ctx):
 		'''Return the nearest neighbor to seed from a database'''
 		if not self.neighbor_dict:
 			return None
 
-		neighbors = self.neighbor_dict[seed]
+		neighbors = self.neighbor_dict.get(seed, [])
 
 		good_neighbors = []
 		for word in neighbors:
 			if self._in_text(word):  # Only pick a neighbor if in text
 				good_neighbors.append(word)
 		if good_neighbors:
-			return np.random.choice(good_neighbors)
+			return ctx.rng.choice(good_neighbors)
 		else:
 			return None
 
-	def _generate_key(self, seed, dir_dict):
+	def _seed_rows(self, seed, dir_index, ctx):
+		'''Return the rows of the keys a chain from seed can start at'''
+		# Look at the last key_gram_size words in the key
+		# First word in that key_gram_size len phrase must match seed
+		offset = ctx.model['gram_size'] - ctx.key_gram_size
+		key_list = dir_index.lookup(seed, offset, ctx.match)
+		# Words keep their punctuation, so fall back to a substring match
+		if len(key_list) == 0 and ctx.match == 'exact':
+			key_list = dir_index.lookup(seed, offset, 'substring')
+		return key_list
+
+	def _generate_key(self, seed, dir_dict, dir_index, ctx):
 		'''Return key from a chosen seed'''
-		key_list = []
-		for key in dir_dict:
-			# Look at the last key_gram_size words in the key
-			# First word in that key_gram_size len phrase must match seed
-			if seed in key[-self.key_gram_size]:
-				key_list.append(key)
-		return key_list[np.random.choice(len(key_list))]
-
-	def _run_chain(self, seed, dir_dict):
-		'''Return a list of words generated from seed
-		Iterate through dictionary until a period or capital is reached'''
-		key = self._generate_key(seed, dir_dict)
-		text = list(key[-self.key_gram_size:])
+		key_list = self._seed_rows(seed, dir_index, ctx)
+		return dir_dict.key(key_list[ctx.rng.randint(len(key_list))])
+
+	def _run_chain(self, seed, dir_dict, dir_index, ctx):
+		'''Return a list of token ids generated from seed
+		Iterate through dictionary until a period or capital is reached,
+		or the chain is out of tokens
+		With an originality check, a key whose every follower copies the
+		corpus sends the chain back to the key before, drawing anew there
+		without the value it took; raise _Stuck past max_retries of those'''
+		key = self._generate_key(seed, dir_dict, dir_index, ctx)
+		text = list(key[-ctx.key_gram_size:])
+		backward = dir_dict is ctx.model['b_dict']
+		# (key, values ruled out at it, value taken, tokens added) per step
+		taken = []
+		excluded = ()
+		backtracks = 0
+		steps = 0
 
 		# If not end/begin of sent, run
-		while True:
-			# Values is a list of lists
-			values = dir_dict[key]
-
-			# Choose a value with probability equal to distribution in corpus
-			value = values[np.random.choice(len(values))]
-			if (() in value) | (value == ()): # End condition
+		while ctx.room(len(text)) > 0:
+			ctx.check_time()
+			steps += 1
+			try:
+				value = self._sample_value(key, text, dir_dict, backward, excluded, ctx)
+			except KeyError:
+				# Texts shorter than gram_size have no key, stop there
+				break
+			if value is None:
+				# Every follower copies the corpus, back up a value
+				if not taken or backtracks >= ctx.max_retries:
+					raise _Stuck()
+				backtracks += 1
+				key, excluded, value, n_added = taken.pop()
+				excluded = excluded + (value,)
+				del text[-n_added:]
+				continue
+			if not value: # End condition
 				break
 
 			# Add a value_gram_size phrase to the text
-			words_from_value = value[:self.value_gram_size]
+			words_from_value = value[:min(ctx.value_gram_size, ctx.room(len(text)))]
+			taken.append((key, excluded, value, len(words_from_value)))
 			text += words_from_value
+			excluded = ()
 
 			# Create new lookup key
-			key = tuple(text[-self.markov_dict['gram_size']:])
+			key = tuple(text[-ctx.model['gram_size']:])
+		if ctx.steps is not None:
+			ctx.steps.append(steps)
 		return text
 
-	def _get_sentence(self, seed):
+	def _sample_value(self, key, text, dir_dict, backward, excluded, ctx):
+		'''Return a value with probability equal to distribution in corpus
+		A closing chain only draws among the values that can end the
+		sentence in the tokens it has left
+		With an originality check values that copy the corpus and the
+		excluded ones are left out, None if that leaves nothing
+		Raise KeyError if the table lacks key'''
+		length = len(text)
+		if not ctx.closing(length):
+			value = dir_dict.sample(key, ctx.rng.random_sample())
+		else:
+			row = dir_dict.row(key)
+			if row is None:
+				raise KeyError(key)
+			follower = dir_dict.sample_within([row], ctx.rng.random_sample(1),
+											  [ctx.max_steps(length)], ctx.value_gram_size)[0]
+			value = dir_dict.value(follower)
+		if ctx.ngrams is None:
+			return value
+		# Most draws don't copy, keeping one that doesn't is the same as
+		# drawing among the values that don't
+		take = min(ctx.value_gram_size, ctx.room(length))
+		if value not in excluded and not (value and self._copies(text, value[:take], backward, ctx)):
+			return value
+		follower = self._original_follower(dir_dict.row(key), text, dir_dict, backward, excluded, ctx)
+		return None if follower is None else dir_dict.value(follower)
+
+	def _original_follower(self, row, text, dir_dict, backward, excluded, ctx):
+		'''Return a follower of row drawn in proportion to its count among
+		those that neither copy the corpus after text nor are excluded,
+		None if no follower is left
+		A closing chain keeps to the ones that end the sentence in time'''
+		lo = int(dir_dict.key_offsets[row])
+		take = min(ctx.value_gram_size, ctx.room(len(text)))
+		counts = dir_dict.follower_counts(row).astype(np.float64)
+		for idx in xrange(len(counts)):
+			value = dir_dict.value(lo + idx)
+			if value in excluded or (value and self._copies(text, value[:take], backward, ctx)):
+				counts[idx] = 0
+		if ctx.closing(len(text)) and counts.any():
+			steps = dir_dict.end_steps(ctx.value_gram_size)[lo:lo + len(counts)]
+			allowed = counts > 0
+			within = allowed & (steps <= ctx.max_steps(len(text)))
+			keep = within if within.any() else allowed & (steps == steps[allowed].min())
+			counts[~keep] = 0
+		total = counts.sum()
+		if not total:
+			return None
+		cum_counts = np.cumsum(counts)
+		idx = np.searchsorted(cum_counts, ctx.rng.random_sample() * total, side='right')
+		return lo + min(int(idx), int(np.flatnonzero(counts)[-1]))
+
+	def _copies(self, text, words, backward, ctx):
+		'''Return True if adding words to text copies a corpus span'''
+		if ctx.ngrams is None:
+			return False
+		text = text + list(words)
+		return any(ctx.ngrams.copies_end(text[:end], backward)
+				   for end in xrange(len(text) - len(words) + 1, len(text) + 1))
+
+	def _get_sentence(self, seed, ctx):
 		'''Return a sentence given a seed'''
-		f_text = self._run_chain(seed, self.markov_dict['f_dict'])
-		b_text = self._run_chain(seed, self.markov_dict['b_dict'])
+		f_text = self._run_chain(seed, ctx.model['f_dict'], ctx.model['f_index'], ctx)
+		b_text = self._run_chain(seed, ctx.model['b_dict'], ctx.model['b_index'], ctx)
 
 		# b_text is backwards obviously, so turn it around
 		b_text = list(reversed(b_text))
@@ -166,39 +385,314 @@ class MarkovChain(object):
 
 		return sent
 
-	def _get_sentence_str(self, sent):
-		'''Return a string representation of a list'''
-		if self.gtype != 'naive':
-			sent = [w[0] for w in sent]
-		text = ' '.join(sent)
+	def _run_chains(self, key_rows, dir_dict, ctx):
+		'''Return a list of token id lists, one chain per row of key_rows
+		All chains advance in lockstep: one vectorized key lookup and one
+		vectorized draw per step for every chain still running
+		A chain stops at the end of a sentence, at a key the table lacks or
+		when it is out of tokens, a chain that can only go on by copying
+		the corpus is None'''
+		gram_size = ctx.model['gram_size']
+		n_chains = len(key_rows)
+		keys = dir_dict.keys[key_rows].astype(np.int64)
+		capacity = max(4 * gram_size, 16)
+		text = np.zeros((n_chains, capacity), dtype=np.int64)
+		text[:, :ctx.key_gram_size] = keys[:, -ctx.key_gram_size:]
+		lengths = np.empty(n_chains, dtype=np.int64)
+		lengths.fill(ctx.key_gram_size)
+		active = np.arange(n_chains)
+		backward = dir_dict is ctx.model['b_dict']
+		stuck = np.zeros(n_chains, dtype=bool)
+		steps = None if ctx.steps is None else np.zeros(n_chains, dtype=np.int64)
+
+		while len(active):
+			ctx.check_time(len(active))
+			if steps is not None:
+				steps[active] += 1
+			rows = dir_dict.rows(keys[active])
+			running = rows >= 0
+			active = active[running]
+			rows = rows[running]
+			if not len(active):
+				break
+			# Choose values with probability equal to distribution in corpus
+			followers = dir_dict.sample_rows(rows, ctx.rng.random_sample(len(rows)))
+			closing = ctx.closing_chains(lengths[active])
+			if closing.any():
+				followers[closing] = dir_dict.sample_within(
+					rows[closing], ctx.rng.random_sample(closing.sum()),
+					ctx.max_steps(lengths[active][closing]), ctx.value_gram_size)
+			starts = dir_dict.value_offsets[followers]
+			value_lens = dir_dict.value_offsets[followers + 1] - starts
+			running = value_lens > 0 # End condition
+			active = active[running]
+			rows = rows[running]
+			starts = starts[running]
+			value_lens = np.minimum(value_lens[running], ctx.value_gram_size)
+			value_lens = np.minimum(value_lens, ctx.room(lengths[active]))
+			if not len(active):
+				break
 
-		punc_w_space = [' ' + x for x in punctuation]
-		for i in xrange(len(text)-1):
-			if text[i:i+2] in punc_w_space:
-				text = text[:i] + text[i+1:]
+			if lengths[active].max() + ctx.value_gram_size > text.shape[1]:
+				text = np.hstack([text, np.zeros_like(text)])
+			# Add a value_gram_size phrase to each text
+			copied = np.zeros(len(active), dtype=bool)
+			for idx in xrange(ctx.value_gram_size):
+				adding = value_lens > idx
+				chains = active[adding]
+				text[chains, lengths[chains]] = dir_dict.value_tokens[starts[adding] + idx]
+				lengths[chains] += 1
+				if ctx.ngrams is not None:
+					copied[adding] |= ctx.ngrams.copies_rows(text, lengths, chains, backward)
+
+			# Take back values that copy the corpus and draw those chains
+			# again among the followers that don't, a chain left with
+			# none is stuck and its sentence is generated again
+			lengths[active[copied]] -= value_lens[copied]
+			done = copied.copy()
+			for pos in np.flatnonzero(copied):
+				chain = active[pos]
+				follower = self._original_follower(rows[pos], text[chain, :lengths[chain]].tolist(),
+												   dir_dict, backward, (), ctx)
+				if follower is None:
+					stuck[chain] = True
+					continue
+				value = dir_dict.value(follower)[:min(ctx.value_gram_size, ctx.room(lengths[chain]))]
+				if value: # An empty value ends the chain
+					text[chain, lengths[chain]:lengths[chain] + len(value)] = value
+					lengths[chain] += len(value)
+					done[pos] = False
+
+			# Create new lookup keys, short texts have no key and stop
+			extended = active[~done]
+			extended = extended[(lengths[extended] >= gram_size) & (ctx.room(lengths[extended]) > 0)]
+			key_cols = lengths[extended][:, None] + np.arange(-gram_size, 0)
+			keys[extended] = text[extended[:, None], key_cols]
+			active = extended
+
+		if steps is not None:
+			ctx.steps.extend(steps.tolist())
+		return [None if stuck[idx] else text[idx, :lengths[idx]].tolist() for idx in xrange(n_chains)]
+
+	def _get_sentences(self, seeds, counts, ctx):
+		'''Return a list of counts[idx] sentences for every seeds[idx], the
+		chains of every seed generated together in lockstep
+		With an originality check sentences that got stuck or copy the
+		corpus where the two chains meet are generated again, up to
+		max_retries rounds, then one at a time with backing up
+		A sentence that still can't be made is None, a seed that is None
+		or has no keys gets None instead of a list'''
+		batch = self._get_sentences_once(seeds, counts, ctx)
+		if ctx.ngrams is None:
+			return batch
+		for _ in xrange(ctx.max_retries):
+			todo = [[idx for idx, sent in enumerate(sents) if sent is None or ctx.ngrams.copies(sent)]
+					if sents is not None else [] for sents in batch]
+			if not any(todo):
+				return batch
+			again = self._get_sentences_once(seeds, [len(idxs) for idxs in todo], ctx)
+			for sents, idxs, new_sents in zip(batch, todo, again):
+				for idx, sent in zip(idxs, new_sents or ()):
+					sents[idx] = sent
+		for seed, sents in zip(seeds, batch):
+			for idx, sent in enumerate(sents or ()):
+				if sent is None or ctx.ngrams.copies(sent):
+					sents[idx] = self._get_original_sentence(seed, ctx)
+		return batch
+
+	def _get_sentences_once(self, seeds, counts, ctx):
+		'''Return a list of counts[idx] sentences for every seeds[idx], one
+		_run_chains call per direction runs the chains of every seed
+		None for the sentences with a stuck chain, and in place of the list
+		for a seed that is None or has no keys'''
+		key_lists = [[self._seed_rows(seed, dir_index, ctx) if seed and n else []
+					  for seed, n in zip(seeds, counts)]
+					 for dir_index in (ctx.model['f_index'], ctx.model['b_index'])]
+		found = [len(f_keys) > 0 and len(b_keys) > 0 for f_keys, b_keys in zip(*key_lists)]
+		texts = []
+		for dir_dict, dir_lists in zip((ctx.model['f_dict'], ctx.model['b_dict']), key_lists):
+			key_rows = [np.asarray(key_list)[ctx.rng.randint(len(key_list), size=n)]
+						for key_list, n, ok in zip(dir_lists, counts, found) if ok]
+			texts.append(self._run_chains(np.concatenate(key_rows), dir_dict, ctx) if key_rows else [])
+
+		# b_text is backwards, turn it around and only include seed once
+		sents = iter([None if f_text is None or b_text is None else b_text[::-1][:-1] + f_text
+					  for f_text, b_text in zip(*texts)])
+		return [[next(sents) for _ in xrange(n)] if ok else None for n, ok in zip(counts, found)]
+
+	def _backoff_token(self, seed, ctx):
+		'''Return a token of seed in proportion to its count, None if unseen'''
+		vocab = ctx.model['vocab']
+		suffix_model = ctx.model['suffix_model']
+		word_id = vocab.word_id(seed) if ctx.match == 'exact' else None
+		if word_id is not None:
+			word_ids = [word_id]
+		else:
+			# Words keep their punctuation, so fall back to a substring match
+			word_ids = [idx for idx, word in enumerate(vocab.words) if seed in word]
+		tokens = np.flatnonzero(np.in1d(np.asarray(vocab.token_word), word_ids))
+		counts = np.array([suffix_model.count([token]) for token in tokens], dtype=np.float64)
+		if not counts.sum():
+			return None
+		return int(tokens[ctx.rng.choice(len(tokens), p=counts / counts.sum())])
+
+	def _run_backoff_chain(self, token, backward, ctx):
+		'''Return a list of token ids generated from token
+		Each step samples a follower of the longest context, up to
+		max_order tokens, that has min_followers distinct followers'''
+		text = [token]
+		retries = 0
+		steps = 0
+		suffix_model = ctx.model['suffix_model']
+		while ctx.room(len(text)) > 0:
+			ctx.check_time()
+			steps += 1
+			# Stop where the longest context ends a sentence in the corpus
+			context = text[-ctx.max_order:]
+			if ctx.closing(len(text)) and suffix_model.count(context + [END], backward):
+				break
+			value, order = suffix_model.backoff_sample(
+				text, ctx.max_order, ctx.min_followers, ctx.rng.random_sample(), backward)
+			if value is None: # End condition
+				break
+			if self._copies(text, [value], backward, ctx):
+				# Draw again, the sentence is generated again once out of retries
+				retries += 1
+				if retries > ctx.max_retries:
+					raise _Stuck()
+				continue
+			text.append(value)
+		if ctx.steps is not None:
+			ctx.steps.append(steps)
 		return text
 
-	def run(self, input_text, key_gram_size=2, value_gram_size=1):
+	def _get_backoff_sentence(self, seed, ctx):
+		'''Return a sentence given a seed with variable order backoff,
+		None if the seed is not in the model'''
+		token = self._backoff_token(seed, ctx)
+		if token is None:
+			return None
+		f_text = self._run_backoff_chain(token, False, ctx)
+		b_text = self._run_backoff_chain(token, True, ctx)
+		# Only include seed once
+		return b_text[::-1][:-1] + f_text
+
+	def _get_original_sentence(self, seed, ctx):
+		'''Return a sentence given a seed, generated again up to max_retries
+		times while a chain gets stuck or it copies the corpus where the
+		two chains meet, None if every chain got stuck'''
+		get_sentence = self._get_backoff_sentence if ctx.backoff else self._get_sentence
+		sent = None
+		for _ in xrange(ctx.max_retries + 1):
+			try:
+				sent = get_sentence(seed, ctx)
+			except _Stuck:
+				continue
+			if sent is None or ctx.ngrams is None or not ctx.ngrams.copies(sent):
+				break
+		return sent
+
+	def _not_found(self, ctx, n=None):
+		'''Return a random not_found sentence, a list of n of them with n'''
+		if n is None:
+			return ctx.rng.choice(self.not_found_list)
+		return list(ctx.rng.choice(self.not_found_list, n))
+
+	def _get_sentence_str(self, sent, ctx):
+		'''Return the true cased string of a list of token ids'''
+		return detokenize(sent, ctx.model['vocab'], self.truecaser)
+
+	def _context(self, key_gram_size, value_gram_size, match, random_state,
+				 backoff=False, max_order=None, min_followers=2, originality=True, max_retries=10,
+				 max_tokens=None, deadline=None):
+		'''Return the context of a call, reloading the model if it changed'''
+		# MarkovDict.add_documents updates the model in place
+		if self.markov_dict.get('version') != self.model_version:
+			with self._lock:
+				if self.markov_dict.get('version') != self.model_version:
+					self._load_model()
+		return _RunContext(dict(self.markov_dict), key_gram_size, value_gram_size,
+						   match, random_state, backoff, max_order, min_followers,
+						   originality, max_retries, max_tokens, deadline)
+
+	def run(self, input_text, key_gram_size=2, value_gram_size=1, match='exact',
+			random_state=None, backoff=False, max_order=None, min_followers=2,
+			originality=True, max_retries=10, max_tokens=None, deadline=None):
 		'''Return a sentence based on gram_size
 		Larger gram_size is more deterministic phrases
-		gram_size cannot be larger than gram_size'''
-		self.key_gram_size = min(key_gram_size, self.markov_dict['gram_size'])
-		self.value_gram_size = min(value_gram_size, self.markov_dict['gram_size'])
-		while self.key_gram_size + self.value_gram_size < self.markov_dict['gram_size']:
-			self.value_gram_size += 1
-
-		seed = self._get_input(input_text)
-		# If seed not in corpus and no neighbor found, return random sent
-		if not seed:
-			return np.random.choice(self.not_found_list)
-		sent = self._get_sentence(seed)
-
-		# Turn into string for output
-		sent_str = self._get_sentence_str(sent)
-
-		# Fix space before punc
-		output = self.truecaser.truecase(sent_str)
-		return output
+		gram_size cannot be larger than gram_size
+		match=substring finds the seed inside words as well (slower)
+		random_state is an int seed or np.random.RandomState, a seed
+		gives the same sentence every time
+		backoff=True ignores key and value gram sizes, it extends the
+		chain a token at a time from the longest context of up to
+		max_order tokens with at least min_followers distinct followers
+		(the MarkovDict needs backoff=True)
+		originality=True keeps chains from copying copy_len tokens in a row
+		from the corpus when the MarkovDict was built with copy_len, chains
+		only draw values that don't copy it, back up a value at a dead end
+		and the sentence is generated again (up to max_retries times) when
+		they still get stuck, the not_found sentences after that
+		max_tokens caps the length of the sentence and deadline the
+		seconds spent on it (neither is limited by default), chains close
+		the sentence early as either runs out and a call past its deadline
+		returns a not_found sentence'''
+		ctx = self._context(key_gram_size, value_gram_size, match, random_state,
+							backoff, max_order, min_followers, originality, max_retries,
+							max_tokens, deadline)
+		seed = self._get_input(input_text, ctx)
+		try:
+			sent = self._get_original_sentence(seed, ctx) if seed else None
+		except _Timeout:
+			sent = None
+		# If seed not in corpus, no neighbor found or out of time, return random sent
+		if sent is None:
+			return self._not_found(ctx)
+
+		# Turn into a true cased string for output
+		return self._get_sentence_str(sent, ctx)
+
+	def run_batch(self, seeds, n_per_seed=10, key_gram_size=2, value_gram_size=1, match='exact',
+				  random_state=None, backoff=False, max_order=None, min_followers=2,
+				  originality=True, max_retries=10, max_tokens=None, deadline=None):
+		'''Return a list of n_per_seed sentences for every input text in seeds
+		n_per_seed may also be a list of counts, one per seed
+		Same parameters as run, the chains of every seed run together
+		over the tables instead of one sentence per call
+		Backoff chains run one after the other
+		deadline covers the whole batch, past it the lockstep chains all
+		get not_found sentences, and with backoff the seeds left do'''
+		ctx = self._context(key_gram_size, value_gram_size, match, random_state,
+							backoff, max_order, min_followers, originality, max_retries,
+							max_tokens, deadline)
+		counts = list(n_per_seed) if hasattr(n_per_seed, '__iter__') else [n_per_seed] * len(seeds)
+		inputs = [self._get_input(input_text, ctx) for input_text in seeds]
+		if ctx.backoff:
+			sents_list = []
+			for seed, n in zip(inputs, counts):
+				try:
+					sents_list.append([self._get_original_sentence(seed, ctx) for _ in xrange(n)]
+									  if seed else None)
+				except _Timeout:
+					sents_list.append(None)
+		else:
+			try:
+				sents_list = self._get_sentences(inputs, counts, ctx)
+			except _Timeout:
+				sents_list = [None] * len(inputs)
+
+		batch = []
+		for sents, n in zip(sents_list, counts):
+			# If seed not in corpus, no neighbor found or out of time, return random sents
+			if sents is None or all(sent is None for sent in sents):
+				batch.append(self._not_found(ctx, n))
+				continue
+			# Sentences that could only copy the corpus get a random sent too
+			sent_strs = iter(detokenize_batch([sent for sent in sents if sent is not None],
+											  ctx.model['vocab'], self.truecaser))
+			batch.append([next(sent_strs) if sent is not None else self._not_found(ctx)
+						  for sent in sents])
+		return batch
 
 if __name__ == '__main__':
 	print 'Fitting Dictionary'
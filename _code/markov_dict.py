@@ -1,139 +1,366 @@
-from nltk.tokenize import sent_tokenize
-from nltk.tokenize.regexp import WhitespaceTokenizer
 import cPickle as pickle
-from _code.syntax_tree import SyntaxTree
-import itertools
-from wordcloud import WordCloud
-import matplotlib.pyplot as plt
-import pandas as pd
+import copy
+from array import array
+from _code.corpus import Corpus, as_corpus, count_sentence, iter_chunks, top_sentences
+from _code.syntax_tree import iter_annotations, default_cache_dir, get_tagged
+from _code.originality import NGramSet
+from _code.seed_index import SeedIndex
+from _code.suffix_model import SuffixModel
+from _code.transition_table import TransitionTable
+from _code.transition_counts import count_transitions
+from _code.vocab import Vocab
+from _code.truecase import TrueCase
+from _code.stop_words import count_words, most_common_words
+from _code.model_file import write_model, ModelFile, pack_strings, StringList
 import numpy as np
 from collections import Counter
 
+# Priority words kept with a model, MarkovChain uses the first few
+PRIORITY_WORDS = 100
+
+
 class MarkovDict(object):
     '''Contains Markov Dict for both forward and backwards
 
-    Input: filename of the corpus, len of Markov Chain
+    Input: corpus (a Corpus, or a filename, directory, glob or iterable of
+    documents to read into one), len of Markov Chain
     Output: use md.api to access info
     use md.wordcloud() for a wordcloud over any corpus
     gtype=naive is a dict without syntax
     gtype=syntax is a dict with syntax included
     gtype=pos is dict with part of speech
-    gtype=syntax_pos is both'''
+    gtype=syntax_pos is both
 
-    def __init__(self, fname, gram_size, gtype='naive'):
-        # Load text and get rid of line breaks
-        with open(fname, 'r') as f:
-            self.corpus_txt = f.read().decode('utf-8').replace('\n', ' ')
-        self.gtype = gtype
+    The text is read once into a Corpus of token ids, never kept as a string
+    Words and tags are interned in md.vocab, the dicts are TransitionTables
+    over token ids, the corpus itself is not kept once the model is built
+    md.save(path) writes a model file, MarkovDict.load(path) maps it back
+    without reading the corpus
+    backoff=True also keeps md.suffix_model, a SuffixModel over the token
+    stream that MarkovChain.run(backoff=True) uses for any context length
+    copy_len keeps md.ngram_set, the hashes of every copy_len token span,
+    so MarkovChain can keep from copying the corpus word for word
+    What MarkovChain derives from the words is built here once and saved
+    with the model: md.truecaser and md.priority_words, the most common
+    words that are not stop words'''
 
-        self.gram_size = gram_size
+    def __init__(self, fname, gram_size, gtype='naive', n_jobs=None, backoff=False,
+                 copy_len=None):
+        self._check_copy_len(copy_len, gram_size)
+        corpus = as_corpus(fname)
+        self._setup(corpus.fname, gram_size, gtype, backoff, copy_len)
         if gtype != 'naive':
             print 'Fitting Syntax Model'
-            self.SyntaxTree = SyntaxTree(fname)
+        counts = self._update_corpus(corpus, [gram_size], n_jobs, corpus is not fname)
+        if gtype != 'naive':
             print 'Syntax Model Complete'
-            self._fit_syntax()
+        self._set_tables(*counts[gram_size])
+        self.api = self._make_api()
+
+    @classmethod
+    def fit_gram_sizes(cls, fname, gram_sizes, gtype='naive', n_jobs=None, backoff=False,
+                       copy_len=None):
+        '''Return {gram_size: MarkovDict} for several gram_sizes
+        The corpus is read, annotated and counted once for all of them'''
+        cls._check_copy_len(copy_len, max(gram_sizes))
+        corpus = as_corpus(fname)
+        md = cls.__new__(cls)
+        md._setup(corpus.fname, gram_sizes[0], gtype, backoff, copy_len)
+        counts = md._update_corpus(corpus, gram_sizes, n_jobs, corpus is not fname)
+        models = {}
+        for gram_size in gram_sizes:
+            model = copy.copy(md)
+            model.gram_size = gram_size
+            model.stats = dict(md.stats)
+            model._set_tables(*counts[gram_size])
+            model.api = model._make_api()
+            models[gram_size] = model
+        return models
+
+    @staticmethod
+    def _check_copy_len(copy_len, gram_size):
+        '''Raise ValueError if copy_len would flag every step as a copy'''
+        # A key and the first token of its value are a corpus span
+        if copy_len is not None and copy_len < gram_size + 2:
+            raise ValueError('copy_len must be at least gram_size + 2 (%d), every step of a chain '
+                             'copies gram_size + 1 tokens of the corpus' % (gram_size + 2))
+
+    def _setup(self, fname, gram_size, gtype, backoff=False, copy_len=None):
+        '''Set up an empty model'''
+        self.fname = fname
+        self.gtype = gtype
+        self.gram_size = gram_size
+        self.vocab = Vocab()
+        self.version = 0
+        self.case_words = []
+        self.case_counts = np.zeros(0, dtype=np.int64)
+        self._case_ids = None
+        self._word_totals = None
+        self.common_sentences = []
+        self.sentence_summary = {}
+        self.sentence_counts = []
+        self.truecaser = None
+        self.priority_words = []
+        self.stats = dict(num_sentences=0, num_words=0)
+        self.suffix_model = SuffixModel([]) if backoff else None
+        self.ngram_set = NGramSet([], copy_len) if copy_len else None
+
+    def add_documents(self, texts, n_jobs=None):
+        '''Add an iterable of documents (or a Corpus) to the model without refitting
+
+        Only the new sentences are tokenized (and annotated for syntax
+        gtypes), their transitions are merged into both dicts
+        MarkovChains built on md.api pick the changes up on their next run'''
+        if isinstance(texts, Corpus):
+            corpus = texts
+            # Its summary started empty, count its sentences on from the model's
+            summary = dict(self.sentence_summary)
+            for sent in corpus.iter_text():
+                count_sentence(sent, summary)
         else:
-            self._fit()
-        self.word_list = list(itertools.chain(*self.f_sent))
-        self.stats = self._make_stats()
-        self.api = dict(
-            corpus_txt=self.corpus_txt,
+            # Counting on from the model's summary gives the one of all the text
+            corpus = Corpus(texts, sentence_summary=self.sentence_summary)
+            summary = None
+        counts = self._update_corpus(corpus, [self.gram_size], n_jobs, corpus is not texts, summary)
+        self._add_tables(*counts[self.gram_size])
+        # Update in place, MarkovChain holds on to this dict
+        self.api.update(self._make_api())
+
+    def _iter_sentences(self, corpus):
+        '''Yield the token ids of every sentence in corpus'''
+        if self.gtype == 'naive':
+            return (self._tokenize(words) for words in corpus.iter_words())
+        annotations = iter_annotations(corpus.iter_text(), cache_dir=default_cache_dir(self.fname))
+        return (self._tokenize_syntax(annotation) for sent, annotation in annotations)
+
+    def _tokenize(self, words):
+        '''Return the token ids of the words of a sentence'''
+        # Capitalize and save the punctuation from the end
+        words = [word.lower() for word in words]
+        words[0] = words[0].capitalize()
+        if len(words[-1]) > 1:
+            words[-1:] = [words[-1][:-1], words[-1][-1]]
+        return [self.vocab.add(word) for word in words]
+
+    def _tokenize_syntax(self, annotation):
+        '''Return the token ids of an annotated sentence'''
+        # Lowercase the words, tup[1:] are the tags
+        return [self.vocab.add(tup[0].lower(), tuple(tup[1:]))
+                for tup in get_tagged(annotation, self.gtype)]
+
+    def _update_corpus(self, corpus, gram_sizes, n_jobs=None, release=False,
+                       sentence_summary=None):
+        '''Merge the tables of a corpus into the model
+        Return {gram_size: (f_counts, b_counts)} of its sentences, which
+        are streamed into the counts and never held as lists
+        release frees the tokens of corpus once they are counted, before
+        the tables are built
+        sentence_summary replaces the sentence summary of the model, the
+        one of corpus when None'''
+        # Keep what MarkovChain and TrueCase need from the raw text, only
+        # the words of corpus are looked at, the tables are copied over
+        case_ids = self._get_case_ids().copy()
+        case_words = list(self.case_words)
+        word_ids = []
+        for word in corpus.words:
+            word_id = case_ids.get(word)
+            if word_id is None:
+                word_id = case_ids[word] = len(case_words)
+                case_words.append(word)
+            word_ids.append(word_id)
+        case_counts = np.zeros(len(case_words), dtype=np.int64)
+        case_counts[:len(self.case_counts)] = self.case_counts
+        np.add.at(case_counts, np.array(word_ids, dtype=np.int64), corpus.case_counts)
+        if self.truecaser is None:
+            self.truecaser = TrueCase(case_words=case_words, case_counts=case_counts)
+        else:
+            self.truecaser = self.truecaser.add_words(case_words, case_counts,
+                                                      corpus.words, corpus.case_counts)
+        word_totals = self._get_word_totals().copy()
+        self.priority_words = [word for word, count in count_words(
+            corpus.words, corpus.case_counts, word_totals).most_common(PRIORITY_WORDS)]
+        self.case_words = case_words
+        self.case_counts = case_counts
+        self._case_ids = case_ids
+        self._word_totals = word_totals
+        self.sentence_summary = corpus.sentence_summary if sentence_summary is None \
+            else sentence_summary
+        self.sentence_counts = top_sentences(self.sentence_summary)
+        self.common_sentences = [key for key, val in self.sentence_counts]
+
+        # The suffix model and ngram set take the sentences as one int array
+        stream = array('i') if self.suffix_model is not None or self.ngram_set is not None else None
+        counts = count_transitions(self._count_sentences(corpus, stream), gram_sizes, n_jobs)
+        if release:
+            corpus.release()
+        if stream is not None:
+            stream = np.frombuffer(stream, dtype=np.int32)
+            if self.suffix_model is not None:
+                self.suffix_model = self.suffix_model.add_stream(stream)
+            if self.ngram_set is not None:
+                self.ngram_set.add_stream(stream)
+        return counts
+
+    def _get_case_ids(self):
+        '''Return the dict of case word -> index into case_words'''
+        if self._case_ids is None:
+            self._case_ids = dict((word, idx) for idx, word in enumerate(self.case_words))
+        return self._case_ids
+
+    def _get_word_totals(self):
+        '''Return the Counter priority_words is taken from'''
+        if self._word_totals is None:
+            self._word_totals = count_words(self.case_words, self.case_counts)
+        return self._word_totals
+
+    def _count_sentences(self, corpus, stream=None):
+        '''Yield the token ids of every sentence in corpus, adding them to
+        the stats and, each followed by -1, to stream'''
+        for sent in self._iter_sentences(corpus):
+            self.stats['num_sentences'] += 1
+            self.stats['num_words'] += len(sent)
+            if stream is not None:
+                stream.extend(sent)
+                stream.append(-1)
+            yield sent
+
+    def _set_tables(self, f_counts, b_counts):
+        '''Build the dicts and seed indexes from transition counts'''
+        self.f_dict = TransitionTable(f_counts, self.gram_size, len(self.vocab))
+        self.b_dict = TransitionTable(b_counts, self.gram_size, len(self.vocab))
+        self.f_index = SeedIndex(self.f_dict, self.vocab)
+        self.b_index = SeedIndex(self.b_dict, self.vocab)
+        self._update_stats()
+        self.version += 1
+
+    def _add_tables(self, f_counts, b_counts):
+        '''Merge transition counts into the dicts and seed indexes, only the
+        keys in the counts are visited'''
+        n_tokens = len(self.vocab)
+        self.f_dict, f_positions = self.f_dict.add_counts(f_counts, n_tokens)
+        self.b_dict, b_positions = self.b_dict.add_counts(b_counts, n_tokens)
+        self.f_index = self.f_index.add_rows(self.f_dict, f_positions)
+        self.b_index = self.b_index.add_rows(self.b_dict, b_positions)
+        self._update_stats()
+        self.version += 1
+
+    def _make_api(self):
+        '''Return the dictionary MarkovChain reads the model from'''
+        return dict(
             gram_size=self.gram_size,
-            word_list=self.word_list,
-            unq_words=set(self.word_list),
-            f_sent=self.f_sent,
-            b_sent=self.b_sent,
+            vocab=self.vocab,
             f_dict=self.f_dict,
             b_dict=self.b_dict,
+            f_index=self.f_index,
+            b_index=self.b_index,
+            suffix_model=self.suffix_model,
+            ngram_set=self.ngram_set,
+            case_words=self.case_words,
+            case_counts=self.case_counts,
+            truecaser=self.truecaser,
+            priority_words=self.priority_words,
+            common_sentences=self.common_sentences,
             stats=self.stats,
-            fname=fname,
-            gtype=gtype
+            fname=self.fname,
+            gtype=self.gtype,
+            version=self.version
             )
 
-    def _fit(self):
-        '''Tokenize the documents, make backwards and forwards lists
-        call the make_dictionary method'''
-
-        tokenizer = WhitespaceTokenizer()
-        # Get the sentences from the corpus
-        sent_list_of_str = sent_tokenize(self.corpus_txt.lower())
-        # Capitalize and save the punctuation from the end
-        sent_cap = [(sent.capitalize()[:-1], sent[-1]) for sent in sent_list_of_str]
-        # Word tokenize to keep contractions, add back on punc
-        self.f_sent = [tokenizer.tokenize(word_tuple[0]) + [word_tuple[1]] for word_tuple in sent_cap]
-        # Reverse those sentences
-        self.b_sent = [list(reversed(word_list)) for word_list in self.f_sent]
-        self.f_dict = self._make_dictionary(self.f_sent)
-        self.b_dict = self._make_dictionary(self.b_sent)
-
-    def _fit_syntax(self):
-        '''Fit sentences that have already been split into syntax components'''
-        # Choose iterable based on type of dictionary available
-        if self.gtype == 'syntax':
-            iter_list = self.SyntaxTree.chunk_list
-        elif self.gtype == 'pos':
-            iter_list = self.SyntaxTree.pos_list
-        else:
-            iter_list = self.SyntaxTree.chunk_pos_list
-
-        # Lowercase the words
-        self.f_sent = []
-        for sent in iter_list:
-            tmp = [tuple([tup[0].lower(), tup[1:]]) for tup in sent]
-            self.f_sent.append(tmp)
-
-        self.b_sent = [list(reversed(chunk_list)) for chunk_list in self.f_sent]
-        self.f_dict = self._make_dictionary(self.f_sent)
-        self.b_dict = self._make_dictionary(self.b_sent)
-
-    def _make_dictionary(self, sentences):
-        '''Return a markov dictionary from a list of sentences
-
-        Keys are tuples of len gram_size; Values are lists of lists
-        Each sub_list contains a tuple of words that follow the key'''
-
-        dictionary = {}
-        for sentence in sentences:
-            sen_len = len(sentence)
-            for word_idx in xrange(sen_len):
-                if word_idx <= (sen_len - self.gram_size):
-                    key_end = word_idx + self.gram_size
-                    key_to_insert = [sentence[i] for i in xrange(word_idx, key_end)]
-
-                    value_to_insert = sentence[key_end:key_end+self.gram_size]
-                    key_to_insert = tuple(key_to_insert)
-                    value_to_insert = tuple(value_to_insert)
-
-                # Put both key an item in dictionary
-                if key_to_insert not in dictionary:
-                    dictionary[key_to_insert] = [value_to_insert]
-                else:
-                    dictionary[key_to_insert] += [value_to_insert]
-        return dictionary
-
     def to_pkl(self, fname):
         '''Pickle the api so it can be used without running'''
         with open(fname, 'wb') as f:
             pickle.dump(self.api, f)
 
-    def _make_stats(self):
-        '''Create common stats most users would want to know'''
-        stats = dict(
-            num_sentences=len(self.f_sent),
-            num_words=sum([len(sent) for sent in self.f_sent]),
-            unq_words=len(set(self.word_list)),
+    def save(self, fname):
+        '''Write the model to a memory mappable model file'''
+        arrays = {}
+        self.vocab.to_arrays(arrays, 'vocab.')
+        self.f_dict.to_arrays(arrays, 'f_dict.')
+        self.b_dict.to_arrays(arrays, 'b_dict.')
+        self.f_index.to_arrays(arrays, 'f_index.')
+        self.b_index.to_arrays(arrays, 'b_index.')
+        arrays['case_words'], arrays['case_word_offsets'] = pack_strings(self.case_words)
+        arrays['case_counts'] = self.case_counts
+        self.truecaser.to_arrays(arrays, 'case.')
+        if self.suffix_model is not None:
+            self.suffix_model.to_arrays(arrays, 'suffix.')
+        if self.ngram_set is not None:
+            self.ngram_set.to_arrays(arrays, 'ngrams.')
+        stats = dict(self.stats)
+        if 'dist_of_val_len' in stats:
+            stats['dist_of_val_len'] = stats['dist_of_val_len'].items()
+        meta = dict(
+            gram_size=self.gram_size,
+            gtype=self.gtype,
+            fname=self.fname,
+            stats=stats,
+            sentence_counts=self.sentence_counts,
+            sentence_summary=self.sentence_summary.items(),
+            priority_words=self.priority_words,
+            copy_len=self.ngram_set.n if self.ngram_set is not None else None,
+            version=self.version
             )
+        write_model(fname, meta, arrays)
+
+    @classmethod
+    def load(cls, fname):
+        '''Return a MarkovDict mapped from a model file written by save()'''
+        model = ModelFile(fname)
+        arrays = model.arrays
+        md = cls.__new__(cls)
+        md.model_file = model
+        md.gram_size = model.meta['gram_size']
+        md.gtype = model.meta['gtype']
+        md.fname = model.meta['fname']
+        md.version = model.meta['version']
+        # Models written before the summary was saved only have the top sentences
+        md.sentence_summary = dict(model.meta.get('sentence_summary', model.meta['sentence_counts']))
+        md.sentence_counts = top_sentences(md.sentence_summary)
+        md.common_sentences = [key for key, val in md.sentence_counts]
+        md.stats = model.meta['stats']
+        if 'dist_of_val_len' in md.stats:
+            md.stats['dist_of_val_len'] = Counter(dict(md.stats['dist_of_val_len']))
+        md.vocab = Vocab.from_arrays(arrays, 'vocab.')
+        md.f_dict = TransitionTable.from_arrays(arrays, 'f_dict.')
+        md.b_dict = TransitionTable.from_arrays(arrays, 'b_dict.')
+        md.f_index = SeedIndex.from_arrays(arrays, 'f_index.', md.vocab, md.gram_size)
+        md.b_index = SeedIndex.from_arrays(arrays, 'b_index.', md.vocab, md.gram_size)
+        md.case_words = StringList(arrays['case_words'], arrays['case_word_offsets'])
+        md.case_counts = arrays['case_counts']
+        md._case_ids = None
+        md._word_totals = None
+        # Files saved before the case tables were stored count the words again
+        if 'case.slots' in arrays:
+            md.truecaser = TrueCase.from_arrays(arrays, 'case.', md.case_words, md.case_counts)
+        else:
+            md.truecaser = TrueCase(case_words=md.case_words, case_counts=md.case_counts)
+        md.priority_words = model.meta.get('priority_words') or \
+            most_common_words(md.case_words, md.case_counts, PRIORITY_WORDS)
+        md.suffix_model = SuffixModel.from_arrays(arrays, 'suffix.') \
+            if 'suffix.stream' in arrays else None
+        copy_len = model.meta.get('copy_len')
+        md.ngram_set = NGramSet.from_arrays(arrays, 'ngrams.', copy_len) if copy_len else None
+        md.api = md._make_api()
+        return md
+
+    def _update_stats(self):
+        '''Update common stats most users would want to know'''
+        # Every token in the vocab came from a sentence
+        self.stats['unq_words'] = len(self.vocab)
         # Get the distribution of value lengths
         if self.gtype != 'naive':
-            val_list = [val for key, val in self.f_dict.iteritems()]
-            len_list = [len(lst) for lst in val_list]
-            stats['dist_of_val_len'] = Counter(len_list)
-        return stats
+            totals = np.concatenate([[0], self.f_dict.cum_counts])[self.f_dict.key_offsets]
+            lens, n_keys = np.unique(np.diff(totals), return_counts=True)
+            self.stats['dist_of_val_len'] = Counter(dict(zip(lens.tolist(), n_keys.tolist())))
 
     def wordcloud(self, **args):
         '''Display a wordcloud from the corpus'''
+        # Plotting needs wordcloud and matplotlib, generation does not
+        from wordcloud import WordCloud
+        import matplotlib.pyplot as plt
+        corpus_txt = ''.join(iter_chunks(self.fname))
         wordcloud = WordCloud(**args)\
-                    .generate(self.corpus_txt)
+                    .generate(corpus_txt)
         plt.figure()
         plt.imshow(wordcloud)
         plt.axis("off")
@@ -141,6 +368,8 @@ class MarkovDict(object):
 
     def plot_dist(self, log=True):
         '''Display a histogram of log value lengths from the dictionary'''
+        import matplotlib.pyplot as plt
+        import pandas as pd
         df = pd.DataFrame.from_dict(self.stats['dist_of_val_len'], orient='index')
         if log:
             tmp = df.apply(lambda x: np.log(x))
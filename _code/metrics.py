@@ -0,0 +1,290 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from _code.markov_chain import MarkovChain
+from _code.truecase import TrueCase
+
+# Seconds, 1us to 10s in quarter decades
+TIME_BOUNDS = [10 ** (exp / 4.0) for exp in xrange(-24, 5)]
+# Sizes, powers of two up to a million
+SIZE_BOUNDS = [2 ** exp for exp in xrange(21)]
+
+
+class Histogram(object):
+    '''Counts of observations in fixed buckets, with count, sum, min and max
+    Percentiles are the upper bound of the bucket they fall in, capped at max'''
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        '''Return the bound of the bucket holding the q-th percentile'''
+        if not self.count:
+            return None
+        rank = q / 100.0 * self.count
+        seen = 0
+        for idx, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                return min(self.bounds[idx], self.max) if idx < len(self.bounds) else self.max
+        return self.max
+
+    def summary(self):
+        '''Return a dict of the histogram'''
+        return dict(count=self.count, sum=self.total,
+                    mean=float(self.total) / self.count if self.count else None,
+                    min=self.min, max=self.max, p50=self.percentile(50),
+                    p90=self.percentile(90), p99=self.percentile(99),
+                    buckets=[[bound, count] for bound, count in
+                             zip(self.bounds + ['inf'], self.buckets) if count])
+
+
+class Metrics(object):
+    '''Stage timers, counters and histograms of the generation hot path
+
+    enable() wraps the stages of MarkovChain and TrueCase to record into a
+    Metrics, disable() puts the plain methods back, so with metrics off
+    nothing on the hot path changes
+    Timers are histograms of seconds named after the stage'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.timers = {}
+        self.counters = {}
+        self.histograms = {}
+
+    def count(self, name, n=1):
+        '''Add n to a counter'''
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def _observe(self, table, bounds, name, value):
+        '''Add value to the histogram name of table'''
+        with self._lock:
+            histogram = table.get(name)
+            if histogram is None:
+                histogram = table[name] = Histogram(bounds)
+            histogram.observe(value)
+
+    def observe(self, name, value):
+        '''Add a size to a histogram'''
+        self._observe(self.histograms, SIZE_BOUNDS, name, value)
+
+    def observe_time(self, name, seconds):
+        '''Add a duration to a timer'''
+        self._observe(self.timers, TIME_BOUNDS, name, seconds)
+
+    @contextmanager
+    def timer(self, name):
+        '''Time a block of code'''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe_time(name, time.time() - start)
+
+    def reset(self):
+        '''Clear every timer, counter and histogram'''
+        with self._lock:
+            self.started = time.time()
+            self.timers = {}
+            self.counters = {}
+            self.histograms = {}
+
+    def snapshot(self):
+        '''Return a dict of every timer, counter and histogram'''
+        with self._lock:
+            return dict(seconds=time.time() - self.started,
+                        counters=dict(self.counters),
+                        timers=dict((name, hist.summary()) for name, hist in self.timers.iteritems()),
+                        histograms=dict((name, hist.summary()) for name, hist
+                                        in self.histograms.iteritems()))
+
+    def report(self):
+        '''Return the snapshot as a table for offline profiling'''
+        snap = self.snapshot()
+        lines = ['%-28s %8s %10s %10s %10s %10s' % ('timer', 'count', 'total s', 'mean ms', 'p90 ms', 'p99 ms')]
+        for name, timer in sorted(snap['timers'].iteritems(), key=lambda item: -item[1]['sum']):
+            lines.append('%-28s %8d %10.4f %10.4f %10.4f %10.4f' % (
+                name, timer['count'], timer['sum'], 1000 * timer['mean'],
+                1000 * timer['p90'], 1000 * timer['p99']))
+        for name, hist in sorted(snap['histograms'].iteritems()):
+            lines.append('%-28s %8d mean %.1f p90 <= %s max %s' % (
+                name, hist['count'], hist['mean'], hist['p90'], hist['max']))
+        for name, value in sorted(snap['counters'].iteritems()):
+            lines.append('%-28s %8d' % (name, value))
+        return '\n'.join(lines)
+
+
+def _direction(args):
+    '''Return the direction of a chain from the (..., dir_dict, ..., ctx)
+    arguments of _run_chain or _run_chains'''
+    ctx = args[-1]
+    return 'backward' if any(arg is ctx.model['b_dict'] for arg in args[:-1]) else 'forward'
+
+
+def _backoff_direction(args):
+    '''Return the direction of a chain from the (token, backward, ctx)
+    arguments of _run_backoff_chain'''
+    return 'backward' if args[1] else 'forward'
+
+
+def _timed(name):
+    '''Return a hook that times a method as name'''
+    def hook(metrics, method):
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                metrics.observe_time(name, time.time() - start)
+        return wrapper
+    return hook
+
+
+def _run_hook(metrics, method):
+    def wrapper(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            metrics.observe_time('run', time.time() - start)
+            metrics.count('requests')
+    return wrapper
+
+
+def _run_batch_hook(metrics, method):
+    def wrapper(self, *args, **kwargs):
+        start = time.time()
+        batch = None
+        try:
+            batch = method(self, *args, **kwargs)
+            return batch
+        finally:
+            metrics.observe_time('run_batch', time.time() - start)
+            if batch is not None:
+                metrics.count('batch_sentences', sum(len(sents) for sents in batch))
+    return wrapper
+
+
+def _not_found_hook(metrics, method):
+    def wrapper(self, ctx, n=None):
+        metrics.count('not_found_fallbacks', 1 if n is None else n)
+        return method(self, ctx, n)
+    return wrapper
+
+
+def _neighbor_hook(metrics, method):
+    def wrapper(self, *args, **kwargs):
+        start = time.time()
+        seed = None
+        try:
+            seed = method(self, *args, **kwargs)
+            return seed
+        finally:
+            metrics.observe_time('get_neighbor', time.time() - start)
+            metrics.count('neighbor_fallbacks')
+            if seed is None:
+                metrics.count('neighbor_misses')
+    return wrapper
+
+
+def _seed_rows_hook(metrics, method):
+    def wrapper(self, *args, **kwargs):
+        key_list = method(self, *args, **kwargs)
+        metrics.observe('key_candidates', len(key_list))
+        return key_list
+    return wrapper
+
+
+def _chain_hook(name, direction):
+    '''Return a hook that times a chain method as name plus the direction
+    of its arguments and records the steps of every chain it runs, which
+    the chain methods add to ctx.steps'''
+    def hook(metrics, method):
+        def wrapper(self, *args):
+            ctx = args[-1]
+            ctx.steps = []
+            start = time.time()
+            try:
+                return method(self, *args)
+            finally:
+                metrics.observe_time(name + '.' + direction(args), time.time() - start)
+                for steps in ctx.steps:
+                    metrics.observe('chain_steps', steps)
+                ctx.steps = None
+        return wrapper
+    return hook
+
+
+# (class, method, hook), a hook takes the Metrics and the plain method
+HOOKS = [
+    (MarkovChain, 'run', _run_hook),
+    (MarkovChain, 'run_batch', _run_batch_hook),
+    (MarkovChain, '_get_input', _timed('get_input')),
+    (MarkovChain, '_get_neighbor', _neighbor_hook),
+    (MarkovChain, '_seed_rows', _seed_rows_hook),
+    (MarkovChain, '_generate_key', _timed('generate_key')),
+    (MarkovChain, '_run_chain', _chain_hook('run_chain', _direction)),
+    (MarkovChain, '_run_chains', _chain_hook('run_chains', _direction)),
+    (MarkovChain, '_run_backoff_chain', _chain_hook('run_backoff_chain', _backoff_direction)),
+    (MarkovChain, '_not_found', _not_found_hook),
+    (MarkovChain, '_get_sentence_str', _timed('get_sentence_str')),
+    (TrueCase, 'truecase', _timed('truecase')),
+    (TrueCase, 'bulk_truecase', _timed('bulk_truecase')),
+]
+
+_originals = {}
+_enabled = [None]
+
+
+def enable(metrics=None):
+    '''Start recording into metrics (a new Metrics if None), return it'''
+    disable()
+    metrics = metrics or Metrics()
+    for cls, name, hook in HOOKS:
+        method = cls.__dict__[name]
+        _originals[(cls, name)] = method
+        setattr(cls, name, hook(metrics, method))
+    _enabled[0] = metrics
+    return metrics
+
+
+def disable():
+    '''Stop recording, the plain methods are back in place'''
+    for (cls, name), method in _originals.items():
+        setattr(cls, name, method)
+    _originals.clear()
+    _enabled[0] = None
+
+
+def current():
+    '''Return the Metrics being recorded into, None when off'''
+    return _enabled[0]
+
+
+@contextmanager
+def profile(metrics=None):
+    '''Record the stages of the code run in the block
+    with profile() as metrics: ... then print metrics.report()'''
+    metrics = enable(metrics)
+    try:
+        yield metrics
+    finally:
+        disable()
@@ -0,0 +1,190 @@
+import json
+import mmap
+import os
+import struct
+import zlib
+import numpy as np
+
+MAGIC = 'MSGMODEL'
+VERSION = 1
+# magic, version, length of the json header
+_PREFIX = struct.Struct('<8sII')
+_ALIGN = 16
+
+
+def _aligned(offset):
+    '''Return offset rounded up to the array alignment'''
+    return (offset + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def write_model(fname, meta, arrays):
+    '''Write a model file
+
+    Layout: magic, version, json header, then every array aligned to 16 bytes
+    meta is any json serializable dict, arrays is a dict of name -> ndarray
+    The header records the dtype, shape and offset of each array
+    The file is written next to fname and renamed over it, so a process
+    with the old file mapped keeps reading the old file'''
+    arrays = dict((name, np.ascontiguousarray(arr)) for name, arr in arrays.iteritems())
+    layout = {}
+    offset = 0
+    for name in sorted(arrays):
+        arr = arrays[name]
+        offset = _aligned(offset)
+        layout[name] = dict(dtype=arr.dtype.str, shape=list(arr.shape), offset=offset)
+        offset += arr.nbytes
+    header = json.dumps(dict(meta=meta, arrays=layout))
+    data_start = _aligned(_PREFIX.size + len(header))
+
+    # Truncating a mapped file in place would SIGBUS its readers
+    tmp = fname + '.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(_PREFIX.pack(MAGIC, VERSION, len(header)))
+            f.write(header)
+            for name in sorted(arrays):
+                f.write('\0' * (data_start + layout[name]['offset'] - f.tell()))
+                f.write(arrays[name].tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, fname)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class ModelFile(object):
+    '''Read-only memory map of a model file
+
+    model.meta is the json header, model.arrays maps names to read-only
+    arrays backed by the file, so pages are shared between processes
+    that open the same model'''
+
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, header_len = _PREFIX.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a model file' % fname)
+        if version != VERSION:
+            raise ValueError('%s has model version %d, expected %d' % (fname, version, VERSION))
+        header = json.loads(self._mmap[_PREFIX.size:_PREFIX.size + header_len])
+        self.meta = header['meta']
+        data_start = _aligned(_PREFIX.size + header_len)
+
+        self.arrays = {}
+        for name, info in header['arrays'].iteritems():
+            dtype = np.dtype(str(info['dtype']))
+            count = int(np.prod(info['shape']))
+            if count:
+                arr = np.frombuffer(self._mmap, dtype, count, data_start + info['offset'])
+            else:
+                arr = np.zeros(0, dtype)
+            self.arrays[name] = arr.reshape(info['shape'])
+
+
+def pack_strings(strings):
+    '''Return a utf-8 blob and offsets for a list of strings'''
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(s) for s in encoded])
+    blob = np.frombuffer(''.join(encoded), dtype=np.uint8) if encoded else np.zeros(0, np.uint8)
+    return blob, offsets
+
+
+class StringList(object):
+    '''List of strings decoded on access from a blob and offsets'''
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return self.blob[self.offsets[idx]:self.offsets[idx + 1]].tostring().decode('utf-8')
+
+    def __iter__(self):
+        for idx in xrange(len(self)):
+            yield self[idx]
+
+
+def string_hash(word):
+    '''Return a hash of word that is the same in every process'''
+    return zlib.crc32(word.encode('utf-8')) & 0xffffffff
+
+
+def make_slots(strings):
+    '''Return an open addressing table of the ids of strings by
+    string_hash, at most half full, -1 is empty'''
+    n_slots = 1
+    while n_slots < 2 * len(strings):
+        n_slots *= 2
+    slots = np.empty(n_slots, dtype=np.int32)
+    slots.fill(-1)
+    mask = n_slots - 1
+    for idx, string in enumerate(strings):
+        slot = string_hash(string) & mask
+        while slots[slot] >= 0:
+            slot = (slot + 1) & mask
+        slots[slot] = idx
+    return slots
+
+
+def find_slot(slots, strings, word):
+    '''Return the id of word in strings through its slots table, or None'''
+    mask = len(slots) - 1
+    slot = string_hash(word) & mask
+    while True:
+        idx = int(slots[slot])
+        if idx < 0 or strings[idx] == word:
+            return idx if idx >= 0 else None
+        slot = (slot + 1) & mask
+
+
+class StringMap(object):
+    '''Read-only dict of strings to strings over packed arrays
+
+    keys and values are StringLists, slots the table of make_slots(keys),
+    so a lookup is one probe on average and nothing is unpacked when
+    a model file is opened. Keys found are remembered in a dict, so the
+    common words cost a dict lookup after their first use
+    An empty value stands for None'''
+
+    def __init__(self, keys, values, slots):
+        self.keys = keys
+        self.values = values
+        self.slots = slots
+        self._found = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _lookup(self, word):
+        '''Return (True, value) for a key, (False, None) otherwise'''
+        try:
+            return True, self._found[word]
+        except KeyError:
+            pass
+        idx = find_slot(self.slots, self.keys, word)
+        if idx is None:
+            return False, None
+        value = self.values[idx] or None
+        self._found[word] = value
+        return True, value
+
+    def __contains__(self, word):
+        return self._lookup(word)[0]
+
+    def get(self, word, default=None):
+        found, value = self._lookup(word)
+        return value if found else default
+
+    def __getitem__(self, word):
+        found, value = self._lookup(word)
+        if not found:
+            raise KeyError(word)
+        return value
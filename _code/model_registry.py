@@ -0,0 +1,144 @@
+import glob
+import os
+import sys
+import threading
+from collections import OrderedDict
+from _code.markov_dict import MarkovDict
+from _code.markov_chain import MarkovChain
+from _code.neighbor_index import NeighborIndex
+
+# Models are <name>.msgm, a neighbor index for one is <name>.neighbors.msgm
+MODEL_EXT = '.msgm'
+NEIGHBORS_EXT = '.neighbors' + MODEL_EXT
+
+
+class ModelRegistry(object):
+    '''MarkovChains over the model files of a directory, loaded on first use
+
+    Input: directory of files written by MarkovDict.save, memory budget
+    in bytes and keyword arguments for every MarkovChain
+    A model is named after its file, data/models/obama.msgm is 'obama'
+    Models are memory mapped, so the cost of a resident model is the size
+    of its files; past the budget the least recently used models are
+    dropped (the one just loaded always stays)
+    A model is loaded once even when many threads ask for it at once'''
+
+    def __init__(self, model_dir, budget=1 << 30, **chain_kwargs):
+        self.model_dir = model_dir
+        self.budget = budget
+        self.chain_kwargs = chain_kwargs
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self.loads = 0
+        self.hits = 0
+        self.evictions = 0
+        self.refresh()
+
+    def refresh(self):
+        '''Find the model files in model_dir again'''
+        paths = {}
+        for path in glob.glob(os.path.join(self.model_dir, '*' + MODEL_EXT)):
+            if path.endswith(NEIGHBORS_EXT):
+                continue
+            paths[os.path.basename(path)[:-len(MODEL_EXT)]] = path
+        with self._lock:
+            self._paths = paths
+
+    def names(self):
+        '''Return the names of every model found'''
+        return sorted(self._paths)
+
+    def __contains__(self, name):
+        return name in self._paths
+
+    def _neighbors_path(self, name):
+        '''Return the path of the neighbor index of a model, None if it has none'''
+        path = self._paths[name][:-len(MODEL_EXT)] + NEIGHBORS_EXT
+        return path if os.path.exists(path) else None
+
+    def _cost(self, name):
+        '''Return the bytes a model maps'''
+        paths = [self._paths[name], self._neighbors_path(name)]
+        return sum(os.path.getsize(path) for path in paths if path)
+
+    def _load(self, name):
+        '''Return a MarkovChain over a model file'''
+        kwargs = dict(self.chain_kwargs)
+        neighbors_path = self._neighbors_path(name)
+        if neighbors_path:
+            kwargs['neighbor_dict'] = NeighborIndex.load(neighbors_path)
+        return MarkovChain(MarkovDict.load(self._paths[name]).api, **kwargs)
+
+    def get(self, name):
+        '''Return the MarkovChain of a model, loading it if needed
+        Raise KeyError for a name with no model file'''
+        if name not in self._paths:
+            raise KeyError(name)
+        with self._lock:
+            if name in self._models:
+                self._models[name] = self._models.pop(name)
+                self.hits += 1
+                return self._models[name][0]
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+        with load_lock:
+            # Another thread may have loaded it while we waited
+            with self._lock:
+                if name in self._models:
+                    self._models[name] = self._models.pop(name)
+                    self.hits += 1
+                    return self._models[name][0]
+            mc = self._load(name)
+            cost = self._cost(name)
+            with self._lock:
+                self._models[name] = (mc, cost)
+                self.loads += 1
+                self._evict()
+        return mc
+
+    def _evict(self):
+        '''Drop least recently used models until the rest fit the budget'''
+        while len(self._models) > 1 and self.resident_bytes() > self.budget:
+            self._models.popitem(last=False)
+            self.evictions += 1
+
+    def resident_bytes(self):
+        '''Return the bytes mapped by the resident models'''
+        return sum(cost for mc, cost in self._models.itervalues())
+
+    def warm(self, names):
+        '''Load models ahead of the first request, most important first
+        Names without a model file are skipped'''
+        # Load the least important first so the budget keeps the first ones
+        for name in reversed(names):
+            if name in self._paths:
+                self.get(name)
+        return self
+
+    def stats(self):
+        '''Return a dict of the resident models and counters'''
+        with self._lock:
+            return dict(models=self.names(), resident=list(self._models),
+                        resident_bytes=self.resident_bytes(), budget=self.budget,
+                        loads=self.loads, hits=self.hits, evictions=self.evictions)
+
+
+def model_name(fname):
+    '''Return the model name of a corpus file, data/obama_corpus.txt is obama'''
+    name = os.path.splitext(os.path.basename(fname))[0]
+    return name[:-len('_corpus')] if name.endswith('_corpus') else name
+
+
+if __name__ == '__main__':
+    # python -m _code.model_registry MODEL_DIR CORPUS... fits and saves a model per corpus
+    if len(sys.argv) < 3:
+        print 'Usage: python -m _code.model_registry MODEL_DIR CORPUS...'
+        sys.exit(1)
+    model_dir = sys.argv[1]
+    if not os.path.isdir(model_dir):
+        os.makedirs(model_dir)
+    for fname in sys.argv[2:]:
+        out = os.path.join(model_dir, model_name(fname) + MODEL_EXT)
+        print 'Fitting %s' % fname
+        MarkovDict(fname, 3, gtype='syntax_pos').save(out)
+        print 'Wrote %s' % out
@@ -0,0 +1,204 @@
+import io
+import sys
+import numpy as np
+from _code.model_file import write_model, ModelFile, pack_strings, StringList, MAGIC, \
+    make_slots, find_slot
+
+
+def iter_vectors(fname):
+    '''Yield (word, vector) for every line of a text embedding file
+    (GloVe, or word2vec text with its "n_words dim" header line)'''
+    with io.open(fname, 'r', encoding='utf-8', errors='replace') as f:
+        for line_no, line in enumerate(f):
+            parts = line.rstrip().split(' ')
+            if line_no == 0 and len(parts) == 2:
+                continue
+            if len(parts) < 2:
+                continue
+            yield parts[0], np.array(parts[1:], dtype=np.float32)
+
+
+def vocab_words(source):
+    '''Return the distinct lowercase words of a model file or a corpus'''
+    with open(source, 'rb') as f:
+        is_model = f.read(len(MAGIC)) == MAGIC
+    if is_model:
+        arrays = ModelFile(source).arrays
+        words = StringList(arrays['case_words'], arrays['case_word_offsets'])
+    else:
+        from _code.corpus import Corpus
+        words = Corpus(source).words
+    return sorted(set(word.lower() for word in words))
+
+
+class NeighborIndex(object):
+    '''Nearest corpus words of words outside the corpus, memory mapped
+
+    Input: dict of query word -> list of neighbor words, and the words of
+    the corpus, neighbors outside the corpus are dropped at build time
+    The neighbors of query q are words[neighbor_ids[neighbor_offsets[q]:
+    neighbor_offsets[q + 1]]], nearest first
+    slots is an open addressing table of query ids by the crc32 of the
+    query word (-1 is empty), so a lookup is one probe on average and
+    nothing is unpacked when the file is opened
+    NeighborIndex.build makes one from a local embedding file'''
+
+    _fields = ['query_blob', 'query_offsets', 'word_blob', 'word_offsets',
+               'neighbor_offsets', 'neighbor_ids', 'slots']
+
+    def __init__(self, neighbor_dict, words):
+        in_corpus = set(word.lower() for word in words)
+        word_ids = {}
+        seen = set()
+        queries = []
+        neighbor_ids = []
+        neighbor_offsets = [0]
+        for query, neighbors in sorted(neighbor_dict.iteritems()):
+            query = query.lower()
+            # Words in the corpus are seeds themselves
+            if query in in_corpus or query in seen:
+                continue
+            seen.add(query)
+            ids = []
+            for word in neighbors:
+                word = word.lower()
+                if word in in_corpus and word != query:
+                    ids.append(word_ids.setdefault(word, len(word_ids)))
+            if not ids:
+                continue
+            queries.append(query)
+            neighbor_ids.extend(ids)
+            neighbor_offsets.append(len(neighbor_ids))
+        words = sorted(word_ids, key=word_ids.get)
+        self.query_blob, self.query_offsets = pack_strings(queries)
+        self.word_blob, self.word_offsets = pack_strings(words)
+        self.neighbor_offsets = np.array(neighbor_offsets, dtype=np.int64)
+        self.neighbor_ids = np.array(neighbor_ids, dtype=np.int32)
+        self.slots = make_slots(queries)
+        self._set_views()
+
+    def _set_views(self):
+        '''Set the string views over the blobs'''
+        self.queries = StringList(self.query_blob, self.query_offsets)
+        self.words = StringList(self.word_blob, self.word_offsets)
+
+    def __len__(self):
+        return len(self.queries)
+
+    def _query_id(self, word):
+        '''Return the id of a query word or None'''
+        return find_slot(self.slots, self.queries, word)
+
+    def get(self, word, default=None):
+        '''Return the corpus words nearest to word, nearest first'''
+        query_id = self._query_id(word.lower())
+        if query_id is None:
+            return default
+        lo = self.neighbor_offsets[query_id]
+        hi = self.neighbor_offsets[query_id + 1]
+        return [self.words[idx] for idx in self.neighbor_ids[lo:hi]]
+
+    def __getitem__(self, word):
+        neighbors = self.get(word)
+        if neighbors is None:
+            raise KeyError(word)
+        return neighbors
+
+    def __contains__(self, word):
+        return self._query_id(word.lower()) is not None
+
+    def save(self, fname):
+        '''Write the index to a memory mappable model file'''
+        write_model(fname, dict(kind='neighbors'),
+                    dict((field, getattr(self, field)) for field in self._fields))
+
+    @classmethod
+    def load(cls, fname):
+        '''Return a NeighborIndex mapped from a file written by save()'''
+        model = ModelFile(fname)
+        if model.meta.get('kind') != 'neighbors':
+            raise ValueError('%s is not a neighbor index' % fname)
+        index = cls.__new__(cls)
+        index.model_file = model
+        for field in cls._fields:
+            setattr(index, field, model.arrays[field])
+        index._set_views()
+        return index
+
+    @classmethod
+    def build(cls, vectors_fname, words, k=10, max_queries=None, block_size=1024):
+        '''Return the index of the k corpus words nearest (by cosine) to
+        each word of an embedding file that is not in the corpus
+
+        The file is read twice: once for the vectors of the corpus words,
+        then a block of queries at a time, so only the corpus vectors
+        are held in memory
+        max_queries keeps the first words of the file (GloVe and word2vec
+        list the most common first)'''
+        in_corpus = set(word.lower() for word in words)
+        cand_words = []
+        cand_vectors = []
+        seen = set()
+        for word, vector in iter_vectors(vectors_fname):
+            word = word.lower()
+            if word in in_corpus and word not in seen:
+                seen.add(word)
+                cand_words.append(word)
+                cand_vectors.append(vector)
+        if not cand_vectors:
+            return cls({}, words)
+        cand = np.vstack(cand_vectors)
+        cand /= np.maximum(np.linalg.norm(cand, axis=1), 1e-12)[:, None]
+        k = min(k, len(cand_words))
+
+        neighbor_dict = {}
+        queued = set()
+        block_words = []
+        block_vectors = []
+        n_queries = 0
+        for word, vector in iter_vectors(vectors_fname):
+            word = word.lower()
+            if word in in_corpus or word in queued or len(vector) != cand.shape[1]:
+                continue
+            queued.add(word)
+            block_words.append(word)
+            block_vectors.append(vector)
+            n_queries += 1
+            last = max_queries is not None and n_queries >= max_queries
+            if len(block_words) == block_size or last:
+                cls._add_block(neighbor_dict, block_words, block_vectors, cand, cand_words, k)
+                block_words = []
+                block_vectors = []
+            if last:
+                break
+        if block_words:
+            cls._add_block(neighbor_dict, block_words, block_vectors, cand, cand_words, k)
+        return cls(neighbor_dict, cand_words)
+
+    @staticmethod
+    def _add_block(neighbor_dict, block_words, block_vectors, cand, cand_words, k):
+        '''Add the k nearest corpus words of a block of queries'''
+        block = np.vstack(block_vectors)
+        block /= np.maximum(np.linalg.norm(block, axis=1), 1e-12)[:, None]
+        sims = block.dot(cand.T)
+        top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        order = np.argsort(-sims[np.arange(len(top))[:, None], top], axis=1)
+        top = top[np.arange(len(top))[:, None], order]
+        for word, ids in zip(block_words, top.tolist()):
+            neighbor_dict[word] = [cand_words[idx] for idx in ids]
+
+
+if __name__ == '__main__':
+    # python -m _code.neighbor_index MODEL_OR_CORPUS VECTORS OUT [K] [MAX_QUERIES]
+    if len(sys.argv) < 4:
+        print 'Usage: python -m _code.neighbor_index MODEL_OR_CORPUS VECTORS OUT [K] [MAX_QUERIES]'
+        sys.exit(1)
+    source, vectors_fname, out_fname = sys.argv[1:4]
+    k = int(sys.argv[4]) if len(sys.argv) > 4 else 10
+    max_queries = int(sys.argv[5]) if len(sys.argv) > 5 else None
+    print 'Reading corpus words'
+    words = vocab_words(source)
+    print 'Finding neighbors of out of corpus words'
+    index = NeighborIndex.build(vectors_fname, words, k, max_queries)
+    index.save(out_fname)
+    print 'Wrote %d words to %s' % (len(index), out_fname)
@@ -0,0 +1,116 @@
+import numpy as np
+
+_BASE = 1000003
+_MASK = (1 << 64) - 1
+
+
+def _window_hashes(stream, n):
+    '''Return the hash of every n token window of stream that holds no
+    sentence break (-1), uint64 arithmetic wraps like the python hash'''
+    if len(stream) < n:
+        return np.zeros(0, dtype=np.uint64)
+    # Shift ids by one so token 0 still changes the hash
+    tokens = (np.asarray(stream, dtype=np.int64) + 1).astype(np.uint64)
+    n_windows = len(tokens) - n + 1
+    hashes = np.zeros(n_windows, dtype=np.uint64)
+    base = np.uint64(_BASE)
+    for offset in xrange(n):
+        hashes = hashes * base + tokens[offset:offset + n_windows]
+    breaks = np.concatenate([[0], np.cumsum(tokens == 0)])
+    return hashes[breaks[n:] == breaks[:n_windows]]
+
+
+class NGramSet(object):
+    '''Hashed set of every n token span of the corpus
+
+    Input: list of sentences of token ids, n
+    hashes is a sorted uint64 array, so the set is compact, memory mapped
+    with the model and a lookup is one searchsorted
+    A chain whose last n tokens are in the set is copying the corpus,
+    checking it costs O(n) whatever the size of the corpus'''
+
+    def __init__(self, sentences, n):
+        self.n = n
+        self.hashes = np.zeros(0, dtype=np.uint64)
+        self._pow = pow(_BASE, n - 1, 1 << 64)
+        self.add(sentences)
+
+    def add(self, sentences):
+        '''Add the spans of more sentences to the set'''
+        stream = []
+        for sentence in sentences:
+            stream.extend(sentence)
+            stream.append(-1)
+        self.add_stream(stream)
+
+    def add_stream(self, stream):
+        '''Add the spans of a stream of sentences each followed by -1'''
+        self.hashes = np.union1d(self.hashes, _window_hashes(stream, self.n)).astype(np.uint64)
+
+    def to_arrays(self, arrays, prefix):
+        '''Add the hashes to arrays'''
+        arrays[prefix + 'hashes'] = self.hashes
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix, n):
+        '''Return an NGramSet backed by arrays written with to_arrays'''
+        ngrams = cls.__new__(cls)
+        ngrams.n = n
+        ngrams.hashes = arrays[prefix + 'hashes']
+        ngrams._pow = pow(_BASE, n - 1, 1 << 64)
+        return ngrams
+
+    def _has_hash(self, value):
+        '''Return True if a hash is in the set'''
+        idx = np.searchsorted(self.hashes, np.uint64(value))
+        return idx < len(self.hashes) and int(self.hashes[idx]) == value
+
+    def _hash(self, tokens):
+        '''Return the hash of a list of token ids'''
+        value = 0
+        for token in tokens:
+            value = (value * _BASE + token + 1) & _MASK
+        return value
+
+    def copies_end(self, text, backward=False):
+        '''Return True if the last n tokens of text are a corpus span
+        text of a backward chain is reversed, so is the span'''
+        if len(text) < self.n:
+            return False
+        window = text[-self.n:]
+        return self._has_hash(self._hash(window[::-1] if backward else window))
+
+    def copies(self, text):
+        '''Return True if any n tokens in a row of text are a corpus span
+        A rolling hash keeps it O(len(text))'''
+        if len(text) < self.n:
+            return False
+        value = self._hash(text[:self.n])
+        if self._has_hash(value):
+            return True
+        for idx in xrange(self.n, len(text)):
+            value = (value - (text[idx - self.n] + 1) * self._pow) & _MASK
+            value = (value * _BASE + text[idx] + 1) & _MASK
+            if self._has_hash(value):
+                return True
+        return False
+
+    def copies_rows(self, text, lengths, rows, backward=False):
+        '''Return a bool array, True where the n tokens before lengths[row]
+        in text[row] are a corpus span, for each of rows'''
+        copied = np.zeros(len(rows), dtype=bool)
+        full = lengths[rows] >= self.n
+        if not full.any() or not len(self.hashes):
+            return copied
+        rows = rows[full]
+        cols = lengths[rows][:, None] + np.arange(-self.n, 0)
+        if backward:
+            cols = cols[:, ::-1]
+        tokens = (text[rows[:, None], cols] + 1).astype(np.uint64)
+        hashes = np.zeros(len(rows), dtype=np.uint64)
+        base = np.uint64(_BASE)
+        for offset in xrange(self.n):
+            hashes = hashes * base + tokens[:, offset]
+        idx = np.minimum(np.searchsorted(self.hashes, hashes), len(self.hashes) - 1)
+        copied[full] = self.hashes[idx] == hashes
+        return copied
@@ -0,0 +1,128 @@
+import numpy as np
+
+
+class _Postings(object):
+    '''Rows of a table grouped by term id, CSR style'''
+
+    def __init__(self, term_ids, n_terms):
+        # Keys whose token has no term (no tags in gtype=naive) are dropped
+        order = np.argsort(term_ids, kind='mergesort')
+        order = order[term_ids[order] >= 0]
+        self.rows = order.astype(np.int32)
+        counts = np.bincount(term_ids[order], minlength=max(n_terms, 1))
+        self.starts = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    def to_arrays(self, arrays, prefix):
+        '''Add the arrays of the postings to arrays'''
+        arrays[prefix + 'rows'] = self.rows
+        arrays[prefix + 'starts'] = self.starts
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix):
+        '''Return postings backed by arrays written with to_arrays'''
+        postings = cls.__new__(cls)
+        postings.rows = arrays[prefix + 'rows']
+        postings.starts = arrays[prefix + 'starts']
+        return postings
+
+    def add_rows(self, positions, new_rows, term_ids, n_terms):
+        '''Return the postings after rows were inserted before the old rows
+        at positions, new_rows are where they went and term_ids their terms
+        The old rows are shifted in bulk, only the new ones are placed'''
+        postings = _Postings.__new__(_Postings)
+        rows = self.rows + np.searchsorted(positions, self.rows, side='right')
+        counts = np.zeros(max(n_terms, 1, len(self.starts) - 1), dtype=np.int64)
+        counts[:len(self.starts) - 1] = np.diff(self.starts)
+        # Grouped by term, the rows of a term in order
+        order = np.lexsort((new_rows, term_ids))
+        order = order[term_ids[order] >= 0]
+        new_rows = new_rows[order]
+        term_ids = term_ids[order]
+        at = [self.starts[term] + np.searchsorted(rows[self.starts[term]:self.starts[term + 1]], row)
+              if term < len(self.starts) - 1 else len(rows)
+              for row, term in zip(new_rows.tolist(), term_ids.tolist())]
+        postings.rows = np.insert(rows, np.array(at, dtype=np.int64), new_rows).astype(np.int32)
+        counts += np.bincount(term_ids, minlength=len(counts))
+        postings.starts = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        return postings
+
+    def get(self, term_id):
+        '''Return the rows for term_id'''
+        return self.rows[self.starts[term_id]:self.starts[term_id + 1]]
+
+
+class SeedIndex(object):
+    '''Positional inverted index from tokens to the keys that contain them
+
+    Input: a TransitionTable and the Vocab it was built with
+    words[offset] holds the rows of the keys with each word at key[offset]
+    For syntax gtypes tags[offset] does the same for the tags, so a lookup
+    matches the same keys as `seed in key[offset]` does'''
+
+    def __init__(self, table, vocab):
+        self.vocab = vocab
+        token_word = np.array(vocab.token_word, dtype=np.int32)
+        token_tag = np.array(vocab.token_tag, dtype=np.int32)
+        self.words = []
+        self.tags = []
+        for offset in xrange(table.gram_size):
+            tokens = table.keys[:, offset]
+            self.words.append(_Postings(token_word[tokens], len(vocab.words)))
+            self.tags.append(_Postings(token_tag[tokens], len(vocab.tags)))
+
+    def add_rows(self, table, positions):
+        '''Return the index of table, this index's table with new keys
+        inserted before the old rows at positions (see TransitionTable.add_counts)'''
+        index = SeedIndex.__new__(SeedIndex)
+        index.vocab = self.vocab
+        index.words = []
+        index.tags = []
+        new_rows = positions + np.arange(len(positions))
+        for offset in xrange(table.gram_size):
+            tokens = table.keys[new_rows, offset].tolist()
+            word_ids = np.array([self.vocab.token_word[token] for token in tokens], dtype=np.int64)
+            tag_ids = np.array([self.vocab.token_tag[token] for token in tokens], dtype=np.int64)
+            index.words.append(self.words[offset].add_rows(positions, new_rows, word_ids,
+                                                           len(self.vocab.words)))
+            index.tags.append(self.tags[offset].add_rows(positions, new_rows, tag_ids,
+                                                         len(self.vocab.tags)))
+        return index
+
+    def to_arrays(self, arrays, prefix):
+        '''Add the arrays of the index to arrays, the vocab is saved on its own'''
+        for offset in xrange(len(self.words)):
+            self.words[offset].to_arrays(arrays, '%swords.%d.' % (prefix, offset))
+            self.tags[offset].to_arrays(arrays, '%stags.%d.' % (prefix, offset))
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix, vocab, gram_size):
+        '''Return a SeedIndex backed by arrays written with to_arrays'''
+        index = cls.__new__(cls)
+        index.vocab = vocab
+        index.words = [_Postings.from_arrays(arrays, '%swords.%d.' % (prefix, offset))
+                       for offset in xrange(gram_size)]
+        index.tags = [_Postings.from_arrays(arrays, '%stags.%d.' % (prefix, offset))
+                      for offset in xrange(gram_size)]
+        return index
+
+    def lookup(self, seed, offset, match='exact'):
+        '''Return the rows of the keys that have seed at key[offset]
+
+        A seed is a word, or a tuple of tags for syntax gtypes
+        match=exact is a single probe
+        match=substring also finds the seed inside words, it scans the
+        distinct words rather than every key'''
+        if isinstance(seed, tuple):
+            tag_id = self.vocab.tag_id(seed)
+            return [] if tag_id is None else self.tags[offset].get(tag_id)
+
+        if match == 'exact' or self.vocab.tags:
+            word_id = self.vocab.word_id(seed)
+            return [] if word_id is None else self.words[offset].get(word_id)
+
+        postings = self.words[offset]
+        row_list = [postings.get(word_id) for word_id, word in enumerate(self.vocab.words)
+                    if seed in word]
+        if not row_list:
+            return []
+        return np.concatenate(row_list)
@@ -0,0 +1,153 @@
+import re
+import threading
+import time
+import weakref
+from collections import deque
+import numpy as np
+
+
+class SentencePool(object):
+    '''Bounded pools of pre-generated sentences for hot seeds
+
+    Input: a MarkovChain or a function returning the current one (say
+    lambda: registry.get(name)), the seeds to keep pools for (default its
+    priority_list), the size of each pool, the seconds a fallback run may
+    spend and the most tokens of a sentence
+    A background thread refills a pool with run_batch once it drops below
+    half its size, get() serves from the pools and falls back to mc.run
+    with deadline
+    The chain is only asked for when a refill or a fallback runs and only
+    a weak reference to it is kept, so an evicted model is freed. A
+    different chain coming back, such as a reloaded model, starts the
+    pools over
+
+    metrics() reports the hit rate and the refill lag, the time from a
+    pool dropping below half to being full again'''
+
+    def __init__(self, chain, seeds=None, size=50, key_gram_size=2, value_gram_size=1,
+                 interval=1.0, deadline=None, max_tokens=None):
+        self._get_chain = chain if callable(chain) else lambda: chain
+        self.seeds = seeds
+        self.size = size
+        self.deadline = deadline
+        self.max_tokens = max_tokens
+        self.key_gram_size = key_gram_size
+        self.value_gram_size = value_gram_size
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._running = False
+        self._rng = np.random.RandomState()
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self.refill_lags = deque(maxlen=1000)
+        self._use_chain(self._get_chain())
+
+    def _use_chain(self, mc):
+        '''Start empty pools for the seeds of mc'''
+        seeds = mc.priority_list if self.seeds is None else self.seeds
+        with self._lock:
+            self._source = weakref.ref(mc)
+            self.priority_list = list(mc.priority_list)
+            self.stop_words = mc.stop_words
+            self._pools = dict((seed.lower(), deque()) for seed in seeds)
+            self._low_since = dict((seed, time.time()) for seed in self._pools)
+
+    def _chain(self):
+        '''Return the current MarkovChain, starting the pools over when it
+        is not the one they were filled from'''
+        mc = self._get_chain()
+        if self._source() is not mc:
+            self._use_chain(mc)
+        return mc
+
+    def start(self):
+        '''Start the refill thread, pools fill in the background'''
+        if self._thread is not None:
+            return self
+        self._running = True
+        self._thread = threading.Thread(target=self._refill_loop, name='sentence-pool')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        '''Stop the refill thread'''
+        self._running = False
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _refill_loop(self):
+        '''Top up low pools until stopped'''
+        while self._running:
+            self.refill()
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def refill(self):
+        '''Fill every pool that is below half its size'''
+        with self._lock:
+            if all(since is None for since in self._low_since.itervalues()):
+                return
+        mc = self._chain()
+        with self._lock:
+            pools = self._pools.items()
+        for seed, pool in pools:
+            if self._low_since.get(seed) is None:
+                continue
+            sents = mc.run_batch([seed], self.size - len(pool),
+                                 self.key_gram_size, self.value_gram_size,
+                                 max_tokens=self.max_tokens)[0]
+            with self._lock:
+                # The pools started over for another chain in the meantime
+                if self._pools.get(seed) is not pool:
+                    return
+                pool.extend(sents[:self.size - len(pool)])
+                self.refill_lags.append(time.time() - self._low_since[seed])
+                self._low_since[seed] = None
+                self.refills += 1
+
+    def _pick_seed(self, input_text):
+        '''Return the pooled seed run would pick for input_text, or None'''
+        # Same clean up and choice of candidates as MarkovChain._get_input
+        words = re.sub('[?.,!]', '', input_text.lower()).split()
+        candidates = [w for w in words if w in self.priority_list] or \
+            [w for w in words if w not in self.stop_words] or words
+        if not candidates or any(w not in self._pools for w in candidates):
+            return None
+        return self._rng.choice(candidates)
+
+    def get(self, input_text):
+        '''Return a sentence for input_text, from a pool when possible'''
+        seed = self._pick_seed(input_text)
+        sent = None
+        with self._lock:
+            pool = self._pools.get(seed)
+            if pool:
+                sent = pool.popleft()
+                if len(pool) < self.size // 2 and self._low_since[seed] is None:
+                    self._low_since[seed] = time.time()
+                    self._wake.set()
+                self.hits += 1
+            else:
+                self.misses += 1
+        if sent is None:
+            sent = self._chain().run(input_text, self.key_gram_size, self.value_gram_size,
+                               max_tokens=self.max_tokens, deadline=self.deadline)
+        return sent
+
+    def metrics(self):
+        '''Return a dict of pool counters, hit rate and refill lag in seconds'''
+        with self._lock:
+            requests = self.hits + self.misses
+            lags = list(self.refill_lags)
+            return dict(hits=self.hits, misses=self.misses,
+                        hit_rate=float(self.hits) / requests if requests else None,
+                        refills=self.refills,
+                        refill_lag_mean=float(np.mean(lags)) if lags else None,
+                        refill_lag_max=max(lags) if lags else None,
+                        pool_sizes=dict((seed, len(pool)) for seed, pool in self._pools.iteritems()))
@@ -0,0 +1,34 @@
+from collections import Counter
+from string import punctuation
+
+# The english stop words of NLTK, kept here so generation needs neither
+# nltk nor its data
+ENGLISH_STOP_WORDS = frozenset('''
+i me my myself we our ours ourselves you your yours yourself yourselves he
+him his himself she her hers herself it its itself they them their theirs
+themselves what which who whom this that these those am is are was were be
+been being have has had having do does did doing a an the and but if or
+because as until while of at by for with about against between into through
+during before after above below to from up down in out on off over under
+again further then once here there when where why how all any both each few
+more most other some such no nor not only own same so than too very s t can
+will just don should now
+'''.split())
+
+
+def count_words(words, counts, totals=None):
+    '''Return a Counter of the lowercase words of words with their counts,
+    leaving out stop words and words that are only punctuation
+    The counts are added to totals when it is given'''
+    totals = Counter() if totals is None else totals
+    for word, count in zip(words, counts):
+        lower = word.lower()
+        if lower not in ENGLISH_STOP_WORDS and lower.strip(punctuation):
+            totals[lower] += int(count)
+    return totals
+
+
+def most_common_words(words, counts, n=10):
+    '''Return the n most common lowercase words of words with their counts,
+    leaving out stop words and words that are only punctuation'''
+    return [word for word, count in count_words(words, counts).most_common(n)]
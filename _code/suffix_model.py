@@ -0,0 +1,176 @@
+from bisect import bisect_left, bisect_right
+import numpy as np
+
+# Separates sentences in the token stream, no context can match across it
+END = -1
+
+
+def suffix_array(stream):
+    '''Return the suffix array of an int array by prefix doubling
+    Suffixes are ranked by their first k tokens, then 2k, until every
+    rank is distinct'''
+    n_tokens = len(stream)
+    if not n_tokens:
+        return np.zeros(0, dtype=np.int32)
+    rank = np.unique(stream, return_inverse=True)[1].astype(np.int64)
+    sa = np.argsort(rank, kind='mergesort')
+    k = 1
+    while True:
+        # Rank of the suffix k tokens on, -1 past the end sorts first
+        second = np.empty(n_tokens, dtype=np.int64)
+        second.fill(-1)
+        second[:n_tokens - k] = rank[k:]
+        sa = np.lexsort((second, rank))
+        first_sorted = rank[sa]
+        second_sorted = second[sa]
+        changed = (first_sorted[1:] != first_sorted[:-1]) | (second_sorted[1:] != second_sorted[:-1])
+        rank = np.empty(n_tokens, dtype=np.int64)
+        rank[sa] = np.concatenate([[0], np.cumsum(changed)])
+        if rank[sa[-1]] == n_tokens - 1 or k >= n_tokens:
+            break
+        k *= 2
+    return sa.astype(np.int32)
+
+
+def _make_stream(sentences):
+    '''Return sentences as one int32 array, each between END tokens'''
+    stream = [END]
+    for sentence in sentences:
+        stream.extend(sentence)
+        stream.append(END)
+    return np.array(stream, dtype=np.int32)
+
+
+class _Prefixes(object):
+    '''Sequence view of the first k tokens of each suffix so bisect can
+    search the suffix array'''
+
+    def __init__(self, stream, sa, k):
+        self.stream = stream
+        self.sa = sa
+        self.k = k
+
+    def __len__(self):
+        return len(self.sa)
+
+    def __getitem__(self, idx):
+        start = self.sa[idx]
+        return self.stream[start:start + self.k].tolist()
+
+
+class _SuffixIndex(object):
+    '''A token stream and its suffix array'''
+
+    def __init__(self, stream, sa=None):
+        self.stream = stream
+        self.sa = suffix_array(stream) if sa is None else sa
+
+    def find(self, context):
+        '''Return the (lo, hi) range of suffixes that start with context'''
+        context = list(context)
+        prefixes = _Prefixes(self.stream, self.sa, len(context))
+        return bisect_left(prefixes, context), bisect_right(prefixes, context)
+
+    def followers(self, lo, hi, order):
+        '''Return the token after each occurrence in a range'''
+        return self.stream[self.sa[lo:hi] + order]
+
+    def follower(self, idx, order):
+        '''Return the token after the occurrence at idx, None at the end'''
+        token = int(self.stream[self.sa[idx] + order])
+        return None if token == END else token
+
+
+class SuffixModel(object):
+    '''Follower queries for any context length over one token stream
+
+    Input: list of sentences of token ids
+    stream holds every sentence between END tokens, f is its suffix array
+    and b the suffix array of the stream reversed (a view, not a copy), so
+    the backward chain runs over the same tokens
+    Memory is the stream and two suffix arrays whatever the order asked,
+    the followers of a context are the tokens after the suffixes that
+    start with it, sampling one of those suffixes samples in proportion
+    to the counts a TransitionTable would hold'''
+
+    def __init__(self, sentences):
+        self._set_stream(_make_stream(sentences))
+
+    def _set_stream(self, stream, f_sa=None, b_sa=None):
+        '''Index stream forward and backward'''
+        self.stream = stream
+        self.f = _SuffixIndex(stream, f_sa)
+        self.b = _SuffixIndex(stream[::-1], b_sa)
+
+    def __len__(self):
+        return len(self.stream)
+
+    def add(self, sentences):
+        '''Return a SuffixModel with sentences added, indexes are rebuilt'''
+        return self.add_stream(_make_stream(sentences)[1:])
+
+    def add_stream(self, stream):
+        '''Return a SuffixModel with a stream of sentences each followed
+        by END added, indexes are rebuilt'''
+        model = SuffixModel.__new__(SuffixModel)
+        model._set_stream(np.concatenate([self.stream, np.asarray(stream, dtype=np.int32)]))
+        return model
+
+    def to_arrays(self, arrays, prefix):
+        '''Add the stream and suffix arrays to arrays'''
+        arrays[prefix + 'stream'] = self.stream
+        arrays[prefix + 'f_sa'] = self.f.sa
+        arrays[prefix + 'b_sa'] = self.b.sa
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix):
+        '''Return a SuffixModel backed by arrays written with to_arrays'''
+        model = cls.__new__(cls)
+        model._set_stream(arrays[prefix + 'stream'], arrays[prefix + 'f_sa'],
+                          arrays[prefix + 'b_sa'])
+        return model
+
+    def index(self, backward=False):
+        '''Return the forward or backward _SuffixIndex'''
+        return self.b if backward else self.f
+
+    def find(self, context, backward=False):
+        '''Return the (lo, hi) range of occurrences of context'''
+        return self.index(backward).find(context)
+
+    def count(self, context, backward=False):
+        '''Return how many times context appears'''
+        lo, hi = self.find(context, backward)
+        return hi - lo
+
+    def n_followers(self, context, backward=False):
+        '''Return the number of distinct tokens (END included) after context'''
+        index = self.index(backward)
+        lo, hi = index.find(context)
+        return len(np.unique(index.followers(lo, hi, len(context))))
+
+    def sample(self, context, rand, backward=False):
+        '''Return a follower of context with probability equal to
+        distribution in corpus, None at the end of a sentence
+        rand is a uniform draw in [0, 1)'''
+        index = self.index(backward)
+        lo, hi = index.find(context)
+        if lo == hi:
+            raise KeyError(tuple(context))
+        return index.follower(lo + int(rand * (hi - lo)), len(context))
+
+    def backoff_sample(self, text, max_order, min_followers, rand, backward=False):
+        '''Return (follower, order) for the longest context at the end of
+        text, up to max_order tokens, with at least min_followers distinct
+        followers, backing off one token at a time down to one'''
+        index = self.index(backward)
+        for order in xrange(min(max_order, len(text)), 0, -1):
+            lo, hi = index.find(text[-order:])
+            if order == 1:
+                break
+            if hi - lo >= min_followers and \
+                    len(np.unique(index.followers(lo, hi, order))) >= min_followers:
+                break
+        if lo == hi:
+            raise KeyError(tuple(text[-order:]))
+        return index.follower(lo + int(rand * (hi - lo)), order), order
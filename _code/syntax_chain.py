@@ -1,19 +1,26 @@
 import numpy as np
-from nltk.tokenize.regexp import WhitespaceTokenizer
 from _code.truecase import TrueCase
-from string import punctuation
+from _code.detokenize import merge_words
 from _code.syntax_tree import SyntaxTree
+from _code.corpus import as_corpus
+from _code.grammar_table import GrammarTable
+from _code.model_file import write_model, ModelFile, pack_strings, StringList
 
 class SyntaxChain(object):
     '''Return random sentences with reasonable syntax
     gtype=syntax gives syntax tags
     gtype=pos gives part of speech tags
-    gtype=syntax_pos gives both'''
+    gtype=syntax_pos gives both
+
+    The structures and the words of each tag are counted once into a
+    GrammarTable, save() writes it to a model file and load() maps it
+    back without annotating the corpus again'''
 
     def __init__(self, fname, gtype='syntax'):
-        self.tokenizer = WhitespaceTokenizer()
-        self.truecaser = TrueCase(fname)
-        self.SyntaxTree = SyntaxTree(fname)
+        # Read the corpus once for both
+        corpus = as_corpus(fname)
+        self.truecaser = TrueCase(corpus)
+        self.SyntaxTree = SyntaxTree(corpus)
         self.gtype = gtype
         if self.gtype == 'syntax':
             self.tup_list = self.SyntaxTree.chunk_list
@@ -21,51 +28,57 @@ class SyntaxChain(object):
             self.tup_list = self.SyntaxTree.pos_list
         else:
             self.tup_list = self.SyntaxTree.chunk_pos_list
+        self.grammar = GrammarTable(self.tup_list)
+
+    def save(self, fname):
+        '''Write the grammar and case tables to a memory mappable model file'''
+        arrays = {}
+        self.grammar.to_arrays(arrays, 'grammar.')
+        case_words = self.truecaser.word_list
+        arrays['case_words'], arrays['case_word_offsets'] = pack_strings(case_words)
+        arrays['case_counts'] = np.array([self.truecaser.word_dict_count[w] for w in case_words],
+                                         dtype=np.int64)
+        self.truecaser.to_arrays(arrays, 'case.')
+        write_model(fname, dict(gtype=self.gtype), arrays)
+
+    @classmethod
+    def load(cls, fname):
+        '''Return a SyntaxChain mapped from a model file written by save()'''
+        model = ModelFile(fname)
+        arrays = model.arrays
+        sc = cls.__new__(cls)
+        sc.model_file = model
+        sc.gtype = model.meta['gtype']
+        sc.SyntaxTree = None
+        sc.tup_list = None
+        sc.grammar = GrammarTable.from_arrays(arrays, 'grammar.')
+        case_words = StringList(arrays['case_words'], arrays['case_word_offsets'])
+        if 'case.slots' in arrays:
+            sc.truecaser = TrueCase.from_arrays(arrays, 'case.', case_words, arrays['case_counts'])
+        else:
+            sc.truecaser = TrueCase(case_words=case_words, case_counts=arrays['case_counts'])
+        return sc
 
     def _pick_structure(self, min_appearances=2):
         '''Return a tuple of tags indicating basic sent structure'''
-        grammar_dict = self.SyntaxTree.get_grammar(self.tup_list)
-
-        # Get a list of the most common structures
-        choice_list = []
-        max_val = 0
-        for key, value in grammar_dict.iteritems():
-            max_val = max([max_val, value])
-            if value >= min_appearances:
-                choice_list.append(key)
-        if not choice_list:
-            print 'Set min_appearances below %' % max_val
+        # Any of the structures seen min_appearances times
+        struct_id = self.grammar.pick_structure(min_appearances)
+        if struct_id is None:
+            # The most common structure is seen struct_counts[0] times
+            print 'Set min_appearances to %d or below' % self.grammar.struct_counts[:1].sum()
             return None
-        return np.random.choice(choice_list)
+        return self.grammar.structure(struct_id)
 
     def _fill_words(self, struct):
         '''Return a list of words based on struct'''
-        sent = []
-        _, _, tag_w_words = self.SyntaxTree.get_tools(self.tup_list)
-        for tag in struct:
-            word_list = tag_w_words[tag]
-            sent.append(np.random.choice(word_list))
-        return sent
-
-    def _clean_sent(self, sent_str):
-        '''Return a sentence with the spacing fixed'''
-        clean_str = ''
-        for i, char in enumerate(sent_str):
-            if char == ' ' and sent_str[i + 1] in punctuation:
-                continue
-            else:
-                clean_str += char
-        if clean_str[-1] not in punctuation:
-            clean_str += '.'
-        return clean_str
+        return self.grammar.fill_words(struct)
 
     def run(self, min_appearances=2):
         struct = self._pick_structure(min_appearances)
-        if struct:
-            sent = self._fill_words(struct)
-            sent_str = ' '.join(sent)
-            sent_str = self._clean_sent(sent_str)
-            sent_str = self.truecaser.truecase(sent_str)
+        sent = self._fill_words(struct) if struct is not None and len(struct) else None
+        if sent:
+            # Fix the spacing and end the sentence while casing it
+            sent_str = self.truecaser.truecase(merge_words(sent, end='.'))
         else:
             sent_str = 'Try Again!'
         return sent_str
@@ -1,70 +1,163 @@
-from practnlptools.tools import Annotator
-from nltk.tokenize import sent_tokenize
 from collections import Counter
-from nltk.tokenize.regexp import WhitespaceTokenizer
+from multiprocessing import Pool, cpu_count
+import hashlib
 import itertools
+import os
 import cPickle as pickle
+from _code.corpus import Corpus, iter_sentences
+
+
+def _annotate_shard(args):
+    '''Return (shard index, annotations) for a shard of sentences'''
+    shard_idx, sent_list_of_str, dep_parse = args
+    # Only fitting a syntax model needs practnlptools
+    from practnlptools.tools import Annotator
+    annotator = Annotator()
+    return shard_idx, annotator.getBatchAnnotations(sent_list_of_str, dep_parse)
+
+
+def _clean(sent):
+    '''Return a sentence the annotator can take, (, ) break it'''
+    return sent.replace('(', '').replace(')', '')
+
+
+def _get_shard_fname(cache_dir, shard, dep_parse):
+    '''Return the cache filename for a shard, a hash of its sentences'''
+    shard_hash = hashlib.sha1()
+    shard_hash.update(str(dep_parse))
+    for sent in shard:
+        shard_hash.update(sent.encode('utf-8') + '\n')
+    return os.path.join(cache_dir, shard_hash.hexdigest() + '.pkl')
+
+
+def default_cache_dir(source):
+    '''Return the directory annotated shards are cached in by default
+    None (no cache) for globs and iterables of documents'''
+    if not isinstance(source, basestring):
+        return None
+    if os.path.isdir(source):
+        return source.rstrip('/') + '_annotations'
+    if os.path.isfile(source):
+        return source.rsplit(".", 1)[0] + '_annotations'
+    return None
+
+
+def get_tagged(annotation, gtype):
+    '''Return the (word, tags...) tuples of an annotation for a gtype'''
+    if gtype == 'syntax':
+        return annotation['chunk']
+    elif gtype == 'pos':
+        return annotation['pos']
+    #         word      grammar  part of speech
+    return [(chunk[0], chunk[1], pos[1]) for chunk, pos in zip(annotation['chunk'], annotation['pos'])]
+
+
+def iter_annotations(sentences, dep_parse=False, shard_size=500, n_jobs=None,
+                     cache_dir=None, progress=None):
+    '''Yield (sentence, annotation) for a stream of sentences
+
+    Sentences are annotated in shards of shard_size on n_jobs processes
+    (default all cores), a few shards at a time so memory stays bounded
+    Each shard is cached in cache_dir under a hash of its content so an
+    interrupted fit picks up where it stopped
+    progress(n_done, n_shards) is called as shards complete, n_shards is
+    None when the number of sentences is not known up front'''
+    n_shards = None
+    if hasattr(sentences, '__len__'):
+        n_shards = (len(sentences) + shard_size - 1) // shard_size
+    if cache_dir and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    n_jobs = n_jobs or cpu_count()
+    if n_shards is not None:
+        n_jobs = max(1, min(n_jobs, n_shards))
+    pool = Pool(n_jobs) if n_jobs > 1 else None
+
+    sent_iter = iter(sentences)
+    n_done = 0
+    try:
+        while True:
+            window = []
+            for _ in xrange(2 * n_jobs):
+                shard = list(itertools.islice(sent_iter, shard_size))
+                if not shard:
+                    break
+                window.append(shard)
+            if not window:
+                break
+            clean_window = [[_clean(sent) for sent in shard] for shard in window]
+
+            # Load the shards that were already annotated
+            results = [None] * len(window)
+            paths = [None] * len(window)
+            if cache_dir:
+                for idx, shard in enumerate(clean_window):
+                    paths[idx] = _get_shard_fname(cache_dir, shard, dep_parse)
+                    if os.path.exists(paths[idx]):
+                        with open(paths[idx], 'rb') as f:
+                            results[idx] = pickle.load(f)
+            todo = [(idx, shard, dep_parse) for idx, shard in enumerate(clean_window)
+                    if results[idx] is None]
+            if pool is not None and len(todo) > 1:
+                done_iter = pool.imap_unordered(_annotate_shard, todo)
+            else:
+                done_iter = itertools.imap(_annotate_shard, todo)
+            for idx, annotations in done_iter:
+                if cache_dir:
+                    # Write then rename so a crash never leaves half a shard
+                    with open(paths[idx] + '.tmp', 'wb') as f:
+                        pickle.dump(annotations, f, pickle.HIGHEST_PROTOCOL)
+                    os.rename(paths[idx] + '.tmp', paths[idx])
+                results[idx] = annotations
+
+            for shard, annotations in zip(window, results):
+                n_done += 1
+                if progress:
+                    progress(n_done, n_shards)
+                for pair in zip(shard, annotations):
+                    yield pair
+    finally:
+        if pool is not None:
+            pool.terminate()
+
 
 class SyntaxTree(object):
     '''Return a syntax object
-    Annotator comes from https://github.com/biplab-iitb/practNLPTools'''
-
-    def __init__(self, fname, dep_parse=False):
-        # Get corpus
-        with open(fname, 'r') as f:
-            self.corpus_txt = f.read().decode('utf-8').replace('\n', ' ')
-
-        str_lst = sent_tokenize(self.corpus_txt)
-
-        # (, ) break the annotator
-        str_lst = [x.replace('(', '') for x in str_lst]
-        self.sent_list_of_str = [x.replace(')','') for x in str_lst]
-
-        # Get annotations for all sentences
-        fpath = self._get_pkl_fname(fname)
-        # Load from pkl if already fit once (saves two minutes)
-        try:
-            with open(fpath, 'r') as f:
-                self.annotations_list = pickle.load(f)['annotations_list']
-                print 'Loading from file'
-                save = False
-        except:
-            self.annotations_list = self._fit(self.sent_list_of_str, dep_parse)
-            save = True
+    Annotator comes from https://github.com/biplab-iitb/practNLPTools
+
+    fname is a Corpus, or a file, directory, glob or iterable of documents
+    Annotation runs through iter_annotations, see there for shard_size,
+    n_jobs, cache_dir (default next to the corpus) and progress'''
+
+    def __init__(self, fname, dep_parse=False, shard_size=500, n_jobs=None,
+                 cache_dir=None, progress=None):
+        # Get sentences from the corpus
+        if isinstance(fname, Corpus):
+            str_lst = list(fname.iter_text())
+            fname = fname.fname
+        else:
+            str_lst = list(iter_sentences(fname))
+        self.sent_list_of_str = [_clean(x) for x in str_lst]
+
+        # Get annotations for all sentences, cached shards are not refit
+        if cache_dir is None:
+            cache_dir = default_cache_dir(fname)
+        self.annotations_list = [annotation for sent, annotation in
+                                 iter_annotations(str_lst, dep_parse, shard_size, n_jobs,
+                                                  cache_dir, progress)]
         # Get syntax_list feature, among others available, x is dict
         self.syntax_list = [x['syntax_tree'] for x in self.annotations_list]
         self.pos_list = [x['pos'] for x in self.annotations_list]
         self.chunk_list = [x['chunk'] for x in self.annotations_list]
-        self.chunk_pos_list = self._get_chunk_pos(self.chunk_list, self.pos_list)
+        self.chunk_pos_list = [get_tagged(x, 'syntax_pos') for x in self.annotations_list]
 
         self.api = dict(
         annotations_list=self.annotations_list,
         syntax_list=self.syntax_list,
         pos_list=self.pos_list,
-        corpus_txt=self.corpus_txt,
         chunk_list=self.chunk_list,
         chunk_pos_list=self.chunk_pos_list,
-        fname=fname
+        fname=fname if isinstance(fname, basestring) else None
         )
-        if save:
-            self.to_pkl(fpath)
-
-    def _get_chunk_pos(self, chunk_list, pos_list):
-        '''Return a list of three tuples (word, chunk, pos)'''
-        chunk_pos_list = []
-        for chunk_sent, pos_sent in zip(chunk_list, pos_list):
-            tmp = []
-            for chunk, pos in zip(chunk_sent, pos_sent):
-                #            word      grammar  part of speech
-                tmp.append((chunk[0], chunk[1], pos[1]))
-            chunk_pos_list.append(tmp)
-        return chunk_pos_list
-
-    def _fit(self, sent_list_of_str, dep_parse):
-        '''Return annotations from a list of strings, as a list of dicts
-        dep_parse is dependency parsing optional feature (takes a long time)'''
-        annotator = Annotator()
-        return annotator.getBatchAnnotations(sent_list_of_str, dep_parse)
 
     def get_tools(self, sent_list):
         '''Return sent_list in a variety of formats'''
@@ -95,11 +188,6 @@ class SyntaxTree(object):
         grammar_counter = Counter(sent_struct)
         return grammar_counter
 
-    def _get_pkl_fname(self, fname):
-        '''Return the filename that would have been pkled automatically'''
-        fname = fname.rsplit(".", 1)[0] + '_markov_dict.pkl'
-        return fname
-
     def to_pkl(self, fname):
         '''Pickle the api so it can be used without running'''
         with open(fname, 'wb') as f:
@@ -0,0 +1,105 @@
+from itertools import chain, islice
+from multiprocessing import Pool, cpu_count
+
+
+def _count_sentence(sentence, gram_size, f_counts, b_counts):
+    '''Add the forward and backward transitions of a sentence to counts
+
+    Keys are tuples of len gram_size; Values are the tuples of words that
+    follow the key, stored once with the number of occurrences
+    The backward key at i is the forward slice ending at n - i reversed,
+    so no reversed copy of the sentence is made
+    The last key of a sentence is counted once for every word that
+    follows it, each time with the end value ()
+    Sentences shorter than gram_size have no key'''
+    sen_len = len(sentence)
+    if sen_len < gram_size:
+        return
+    for word_idx in xrange(sen_len - gram_size + 1):
+        key_end = word_idx + gram_size
+        key = tuple(sentence[word_idx:key_end])
+        value = tuple(sentence[key_end:key_end + gram_size])
+        value_counts = f_counts.setdefault(key, {})
+        value_counts[value] = value_counts.get(value, 0) + 1
+
+        key_start = sen_len - key_end
+        key = tuple(sentence[key_start:sen_len - word_idx][::-1])
+        value = tuple(sentence[max(key_start - gram_size, 0):key_start][::-1])
+        value_counts = b_counts.setdefault(key, {})
+        value_counts[value] = value_counts.get(value, 0) + 1
+
+    if gram_size == 1:
+        return
+    for counts, key in ((f_counts, tuple(sentence[-gram_size:])),
+                        (b_counts, tuple(sentence[gram_size - 1::-1]))):
+        value_counts = counts[key]
+        value_counts[()] = value_counts.get((), 0) + gram_size - 1
+
+
+def _count_shard(args):
+    '''Return {gram_size: (f_counts, b_counts)} for a shard of sentences'''
+    sentences, gram_sizes = args
+    counts = dict((gram_size, ({}, {})) for gram_size in gram_sizes)
+    for sentence in sentences:
+        for gram_size in gram_sizes:
+            f_counts, b_counts = counts[gram_size]
+            _count_sentence(sentence, gram_size, f_counts, b_counts)
+    return counts
+
+
+def merge_counts(counts, other):
+    '''Add the key -> {value: count} dict other into counts, return counts'''
+    for key, other_values in other.iteritems():
+        value_counts = counts.get(key)
+        if value_counts is None:
+            counts[key] = other_values
+            continue
+        for value, count in other_values.iteritems():
+            value_counts[value] = value_counts.get(value, 0) + count
+    return counts
+
+
+def _merge_shard(counts, other):
+    '''Add a _count_shard result into counts'''
+    for gram_size, (f_counts, b_counts) in other.iteritems():
+        merge_counts(counts[gram_size][0], f_counts)
+        merge_counts(counts[gram_size][1], b_counts)
+
+
+def _iter_shards(sentences, gram_sizes, shard_size):
+    '''Yield (shard, gram_sizes) for every shard_size sentences'''
+    sentences = iter(sentences)
+    while True:
+        shard = list(islice(sentences, shard_size))
+        if not shard:
+            return
+        yield shard, gram_sizes
+
+
+def count_transitions(sentences, gram_sizes, n_jobs=None, shard_size=5000):
+    '''Return {gram_size: (f_counts, b_counts)} for an iterable of sentences
+
+    sentences are lists of token ids; every gram_size is counted in the
+    same sweep. The sentences are read shard_size at a time and never
+    held all at once: a window of n_jobs shards is counted on n_jobs
+    processes (default all cores) while the next window is read, and
+    each partial count is merged into the total as it comes back'''
+    counts = dict((gram_size, ({}, {})) for gram_size in gram_sizes)
+    n_jobs = n_jobs or cpu_count()
+    shards = _iter_shards(sentences, gram_sizes, shard_size)
+    window = list(islice(shards, n_jobs))
+    if n_jobs <= 1 or len(window) <= 1:
+        for shard in chain(window, shards):
+            _merge_shard(counts, _count_shard(shard))
+        return counts
+
+    pool = Pool(n_jobs)
+    try:
+        while window:
+            parts = pool.map_async(_count_shard, window)
+            window = list(islice(shards, n_jobs))
+            for part in parts.get():
+                _merge_shard(counts, part)
+    finally:
+        pool.terminate()
+    return counts
@@ -0,0 +1,398 @@
+import random
+from bisect import bisect_left, bisect_right
+import numpy as np
+
+
+class _KeyRows(object):
+    '''Sequence view of the key rows so bisect can search them'''
+
+    def __init__(self, keys):
+        self.keys = keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, row):
+        return self.keys[row].tolist()
+
+
+class TransitionTable(object):
+    '''Markov transitions stored CSR style in flat int arrays
+
+    Input: dict of key -> {value: count}, keys and values are tuples of
+    token ids, gram_size and the number of tokens in the vocab
+
+    keys is an (n_keys, gram_size) array sorted so the keys starting with
+    token t are rows first_offsets[t]:first_offsets[t + 1]
+    The followers of row r are key_offsets[r]:key_offsets[r + 1], follower f
+    is value_tokens[value_offsets[f]:value_offsets[f + 1]]
+    cum_counts is a running count over all followers, so a value is
+    sampled with a single bisect, in proportion to how often it followed
+    the key in the corpus
+    end_steps counts how far each follower is from the end of a sentence,
+    so sample_within can steer a chain to an end within a budget'''
+
+    _fields = ['keys', 'first_offsets', 'key_offsets', 'value_offsets', 'value_tokens', 'cum_counts']
+    # Steps to a sentence end are counted up to end_horizon
+    end_horizon = 16
+
+    def __init__(self, counts, gram_size, n_tokens):
+        self.gram_size = gram_size
+        sorted_keys = sorted(counts)
+        self.keys = np.array(sorted_keys, dtype=np.int32).reshape(-1, gram_size)
+
+        first_counts = np.bincount(self.keys[:, 0], minlength=n_tokens) if len(self.keys) \
+            else np.zeros(n_tokens, dtype=np.int64)
+        self.first_offsets = np.concatenate([[0], np.cumsum(first_counts)]).astype(np.int64)
+
+        key_offsets = [0]
+        value_offsets = [0]
+        value_tokens = []
+        cum_counts = []
+        total = 0
+        for key in sorted_keys:
+            for value, count in counts[key].iteritems():
+                value_tokens.extend(value)
+                value_offsets.append(len(value_tokens))
+                total += count
+                cum_counts.append(total)
+            key_offsets.append(len(cum_counts))
+        self.key_offsets = np.array(key_offsets, dtype=np.int64)
+        self.value_offsets = np.array(value_offsets, dtype=np.int64)
+        self.value_tokens = np.array(value_tokens, dtype=np.int32)
+        self.cum_counts = np.array(cum_counts, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def to_arrays(self, arrays, prefix):
+        '''Add the arrays of the table to arrays'''
+        for field in self._fields:
+            arrays[prefix + field] = getattr(self, field)
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix):
+        '''Return a TransitionTable backed by arrays written with to_arrays'''
+        table = cls.__new__(cls)
+        for field in cls._fields:
+            setattr(table, field, arrays[prefix + field])
+        table.gram_size = table.keys.shape[1]
+        return table
+
+    def to_counts(self):
+        '''Return the table as a dict of key -> {value: count}'''
+        counts = {}
+        cum_counts = self.cum_counts.tolist()
+        for row in xrange(len(self.keys)):
+            lo = self.key_offsets[row]
+            hi = self.key_offsets[row + 1]
+            prev = cum_counts[lo - 1] if lo else 0
+            value_counts = {}
+            for follower in xrange(lo, hi):
+                value_counts[self.value(follower)] = cum_counts[follower] - prev
+                prev = cum_counts[follower]
+            counts[self.key(row)] = value_counts
+        return counts
+
+    def add_counts(self, counts, n_tokens):
+        '''Return a table with the key -> {value: count} dict counts added,
+        and the rows of this table the new keys were put in front of
+
+        Only the keys in counts are looked up, the rest of the table is
+        copied over in bulk, so the cost grows with counts rather than
+        with the table. New values go after the old followers of their key
+        and new keys in their sorted place, as if the table was built from
+        the merged counts'''
+        n_first = len(self.first_offsets) - 1
+        sorted_keys = sorted(counts)
+        rows, found = self._find_rows(sorted_keys, max(n_tokens, n_first))
+        pair_rows, pair_values = [], []
+        for key, row, exists in zip(sorted_keys, rows.tolist(), found.tolist()):
+            if exists:
+                for value in counts[key]:
+                    pair_rows.append(row)
+                    pair_values.append(value)
+        known = iter(self._find_followers(pair_rows, pair_values, max(n_tokens, n_first)).tolist())
+        deltas = {}
+        row_added = {}
+        follower_at, new_counts, new_values = [], [], []
+        key_at, new_keys, new_sizes = [], [], []
+        for key, row, exists in zip(sorted_keys, rows.tolist(), found.tolist()):
+            value_counts = counts[key]
+            if exists:
+                hi = self.key_offsets[row + 1]
+                for value, count in value_counts.iteritems():
+                    follower = next(known)
+                    if follower < 0:
+                        follower_at.append(hi)
+                        new_counts.append(count)
+                        new_values.append(value)
+                        row_added[row] = row_added.get(row, 0) + 1
+                    else:
+                        deltas[follower] = deltas.get(follower, 0) + count
+                continue
+            # A new key and its followers go in front of row, after any
+            # values added to the key before it
+            key_at.append(row)
+            new_keys.append(key)
+            new_sizes.append(len(value_counts))
+            at = self.key_offsets[row]
+            for value, count in value_counts.iteritems():
+                follower_at.append(at)
+                new_counts.append(count)
+                new_values.append(value)
+
+        follower_at = np.array(follower_at, dtype=np.int64)
+        follower_counts = np.diff(np.concatenate([[0], self.cum_counts])).astype(np.int64)
+        if deltas:
+            follower_counts[np.array(deltas.keys(), dtype=np.int64)] += np.array(deltas.values(), dtype=np.int64)
+        follower_counts = np.insert(follower_counts, follower_at, np.array(new_counts, dtype=np.int64))
+        value_lens = np.array([len(value) for value in new_values], dtype=np.int64)
+        token_at = np.repeat(self.value_offsets[follower_at], value_lens)
+        tokens = np.array([token for value in new_values for token in value], dtype=np.int32)
+        value_lens = np.insert(np.diff(self.value_offsets), follower_at, value_lens)
+        row_sizes = np.diff(self.key_offsets)
+        if row_added:
+            row_sizes[np.array(row_added.keys(), dtype=np.int64)] += np.array(row_added.values(), dtype=np.int64)
+        key_at = np.array(key_at, dtype=np.int64)
+        row_sizes = np.insert(row_sizes, key_at, np.array(new_sizes, dtype=np.int64))
+        new_keys = np.array(new_keys, dtype=np.int32).reshape(-1, self.gram_size)
+
+        table = TransitionTable.__new__(TransitionTable)
+        table.gram_size = self.gram_size
+        table.keys = np.insert(self.keys, key_at, new_keys, axis=0)
+        first_counts = np.zeros(max(n_tokens, n_first), dtype=np.int64)
+        first_counts[:n_first] = np.diff(self.first_offsets)
+        first_counts += np.bincount(new_keys[:, 0], minlength=len(first_counts))
+        table.first_offsets = np.concatenate([[0], np.cumsum(first_counts)]).astype(np.int64)
+        table.key_offsets = np.concatenate([[0], np.cumsum(row_sizes)]).astype(np.int64)
+        table.value_offsets = np.concatenate([[0], np.cumsum(value_lens)]).astype(np.int64)
+        table.value_tokens = np.insert(self.value_tokens, token_at, tokens)
+        table.cum_counts = np.cumsum(follower_counts).astype(np.int64)
+        return table, key_at
+
+    def _find_rows(self, keys, n_tokens):
+        '''Return the row each of a sorted list of keys is at or would be
+        inserted at, and whether it is there, keys may hold tokens up to n_tokens'''
+        n_keys = len(self.keys)
+        if n_tokens ** self.gram_size < 2 ** 63:
+            codes = self._encode(self.keys, n_tokens)
+            query = self._encode(np.array(keys, dtype=np.int64).reshape(-1, self.gram_size), n_tokens)
+            rows = np.searchsorted(codes, query)
+            found = rows < n_keys
+            found[found] = codes[rows[found]] == query[found]
+            return rows, found
+        key_rows = _KeyRows(self.keys)
+        n_first = len(self.first_offsets) - 1
+        rows = []
+        for key in keys:
+            first = key[0]
+            rows.append(bisect_left(key_rows, list(key), int(self.first_offsets[first]),
+                                    int(self.first_offsets[first + 1])) if first < n_first else n_keys)
+        rows = np.array(rows, dtype=np.int64)
+        found = np.array([row < n_keys and self.key(row) == key for row, key in zip(rows, keys)],
+                         dtype=bool)
+        return rows, found
+
+    def _find_followers(self, rows, values, n_tokens):
+        '''Return the follower of each (row, value) pair, -1 where the key
+        at row has no such value, values may hold tokens up to n_tokens'''
+        rows = np.asarray(rows, dtype=np.int64)
+        base = n_tokens + 1
+        if not len(rows) or base ** self.gram_size >= 2 ** 63:
+            return np.array([self._find_follower(row, value) for row, value
+                             in zip(rows.tolist(), values)], dtype=np.int64)
+        # Every follower of the rows asked about, as codes comparable to the values
+        owners, owner_rows = np.unique(rows, return_inverse=True)
+        lo = self.key_offsets[owners]
+        sizes = self.key_offsets[owners + 1] - lo
+        seg_starts = np.cumsum(sizes) - sizes
+        followers = np.arange(sizes.sum()) - np.repeat(seg_starts - lo, sizes)
+        if not len(followers):
+            return np.zeros(len(rows), dtype=np.int64) - 1
+        starts = self.value_offsets[followers]
+        lens = self.value_offsets[followers + 1] - starts
+        cols = np.arange(self.gram_size)
+        tokens = self.value_tokens[np.minimum(starts[:, None] + cols, max(len(self.value_tokens) - 1, 0))] \
+            if len(self.value_tokens) else np.zeros((len(followers), self.gram_size), dtype=np.int64)
+        have = self._encode(np.where(cols < lens[:, None], tokens + 1, 0), base)
+        # Tokens are shifted by one so a shorter value never codes like a longer one
+        padded = np.array([list(value) + [-1] * (self.gram_size - len(value)) for value in values],
+                          dtype=np.int64).reshape(-1, self.gram_size)
+        want = self._encode(padded + 1, base)
+        # Codes ranked so (owner, code) fits one int64
+        ranks = np.unique(np.concatenate([have, want]), return_inverse=True)[1]
+        n_ranks = ranks.max() + 1
+        have = np.repeat(np.arange(len(owners)), sizes) * n_ranks + ranks[:len(have)]
+        want = owner_rows * n_ranks + ranks[len(have):]
+        order = np.argsort(have, kind='mergesort')
+        idx = np.minimum(np.searchsorted(have[order], want), len(have) - 1)
+        return np.where(have[order][idx] == want, followers[order][idx], -1)
+
+    def _find_follower(self, row, value):
+        '''Return the follower of value in the key at row, -1 if it has none'''
+        for follower in xrange(self.key_offsets[row], self.key_offsets[row + 1]):
+            if self.value(follower) == value:
+                return follower
+        return -1
+
+    def row(self, key):
+        '''Return the row of key or None'''
+        first = key[0]
+        if first >= len(self.first_offsets) - 1:
+            return None
+        lo = int(self.first_offsets[first])
+        hi = int(self.first_offsets[first + 1])
+        key = list(key)
+        row = bisect_left(_KeyRows(self.keys), key, lo, hi)
+        if row < hi and self.keys[row].tolist() == key:
+            return row
+        return None
+
+    def key(self, row):
+        '''Return the key at row as a tuple of token ids'''
+        return tuple(self.keys[row].tolist())
+
+    def count(self, row):
+        '''Return the number of times the key at row was seen'''
+        lo = self.key_offsets[row]
+        hi = self.key_offsets[row + 1]
+        base = self.cum_counts[lo - 1] if lo else 0
+        return int(self.cum_counts[hi - 1] - base)
+
+    def value(self, follower):
+        '''Return the value of a follower as a tuple of token ids'''
+        lo = self.value_offsets[follower]
+        hi = self.value_offsets[follower + 1]
+        return tuple(self.value_tokens[lo:hi].tolist())
+
+    def sample(self, key, rand=None):
+        '''Return a value with probability equal to distribution in corpus
+        rand is a uniform draw in [0, 1), taken from random if not given'''
+        if rand is None:
+            rand = random.random()
+        row = self.row(key)
+        if row is None:
+            raise KeyError(key)
+        lo = int(self.key_offsets[row])
+        hi = int(self.key_offsets[row + 1])
+        base = self.cum_counts[lo - 1] if lo else 0
+        target = base + rand * (self.cum_counts[hi - 1] - base)
+        follower = min(bisect_right(self.cum_counts, target, lo, hi), hi - 1)
+        return self.value(follower)
+
+    def follower_counts(self, row):
+        '''Return the count of each follower of the key at row'''
+        lo = self.key_offsets[row]
+        hi = self.key_offsets[row + 1]
+        base = self.cum_counts[lo - 1] if lo else 0
+        return np.diff(np.concatenate([[base], self.cum_counts[lo:hi]]))
+
+    def _key_codes(self):
+        '''Return each key as one int64 in base n_tokens, or None if that overflows
+        The codes sort in the same order as the keys'''
+        if not hasattr(self, '_codes'):
+            n_tokens = max(len(self.first_offsets) - 1, 1)
+            self._codes = None
+            if n_tokens ** self.gram_size < 2 ** 63:
+                self._codes = self._encode(self.keys)
+        return self._codes
+
+    def _encode(self, keys, n_tokens=None):
+        '''Return the base n_tokens code of each row of keys'''
+        n_tokens = max(n_tokens or len(self.first_offsets) - 1, 1)
+        codes = np.zeros(len(keys), dtype=np.int64)
+        for offset in xrange(keys.shape[1]):
+            codes = codes * n_tokens + keys[:, offset]
+        return codes
+
+    def rows(self, keys):
+        '''Return the row of every key in an (n, gram_size) array, -1 if missing'''
+        keys = np.asarray(keys, dtype=np.int64).reshape(-1, self.gram_size)
+        codes = self._key_codes()
+        if codes is None:
+            rows = [self.row(key) for key in keys.tolist()]
+            return np.array([-1 if row is None else row for row in rows], dtype=np.int64)
+        n_tokens = len(self.first_offsets) - 1
+        valid = ((keys >= 0) & (keys < n_tokens)).all(axis=1)
+        query = self._encode(np.where(valid[:, None], keys, 0))
+        rows = np.searchsorted(codes, query)
+        rows = np.minimum(rows, max(len(codes) - 1, 0))
+        found = valid & (len(codes) > 0)
+        if len(codes):
+            found &= codes[rows] == query
+        return np.where(found, rows, -1)
+
+    def sample_rows(self, rows, rand):
+        '''Return a sampled follower for each row, rand is uniform in [0, 1)
+        cum_counts runs over the whole table, so one searchsorted
+        samples every row at once'''
+        lo = self.key_offsets[rows]
+        hi = self.key_offsets[rows + 1]
+        base = np.where(lo > 0, self.cum_counts[np.maximum(lo - 1, 0)], 0)
+        target = base + rand * (self.cum_counts[hi - 1] - base)
+        followers = np.searchsorted(self.cum_counts, target, side='right')
+        return np.minimum(followers, hi - 1)
+
+    def end_steps(self, value_gram_size):
+        '''Return for each follower the fewest steps of value_gram_size
+        tokens to the end of a sentence once it is taken, 0 for the end
+        value (), end_horizon + 1 when it is further than end_horizon
+        Counted once per value_gram_size, backwards from the end values'''
+        if not hasattr(self, '_end_steps'):
+            self._end_steps = {}
+        if value_gram_size not in self._end_steps:
+            self._end_steps[value_gram_size] = self._count_end_steps(value_gram_size)
+        return self._end_steps[value_gram_size]
+
+    def _count_end_steps(self, value_gram_size):
+        '''Return end_steps for value_gram_size'''
+        n_followers = len(self.cum_counts)
+        far = self.end_horizon + 1
+        value_lens = np.minimum(np.diff(self.value_offsets), value_gram_size)
+        ends = value_lens == 0
+        if not len(self.value_tokens):
+            return np.where(ends, 0, far)
+        # The key after a follower is the key and its value, less as many
+        # tokens from the front as the value added
+        follower_rows = np.repeat(np.arange(len(self.keys)), np.diff(self.key_offsets))
+        cols = np.minimum(self.value_offsets[:-1, None] + np.arange(value_gram_size),
+                          len(self.value_tokens) - 1)
+        joined = np.hstack([self.keys[follower_rows], self.value_tokens[cols]])
+        next_keys = joined[np.arange(n_followers)[:, None],
+                           value_lens[:, None] + np.arange(self.gram_size)]
+        next_rows = self.rows(next_keys)
+        steps = np.where(ends, 0, far)
+        for _ in xrange(self.end_horizon):
+            row_steps = np.minimum.reduceat(steps, self.key_offsets[:-1])
+            next_steps = np.where(next_rows >= 0, row_steps[np.maximum(next_rows, 0)] + 1, far)
+            updated = np.where(ends, 0, np.minimum(next_steps, far))
+            if (updated == steps).all():
+                break
+            steps = updated
+        return steps
+
+    def sample_within(self, rows, rand, max_steps, value_gram_size):
+        '''Return a follower for each row, drawn in proportion to counts
+        among the followers that end the sentence within max_steps steps,
+        or among the closest to an end when none of them do'''
+        rows = np.asarray(rows, dtype=np.int64)
+        lo = self.key_offsets[rows]
+        sizes = self.key_offsets[rows + 1] - lo
+        seg_starts = np.cumsum(sizes) - sizes
+        # Every follower of every row, one segment per row
+        followers = np.arange(sizes.sum()) - np.repeat(seg_starts - lo, sizes)
+        steps = self.end_steps(value_gram_size)[followers]
+        within = steps <= np.repeat(max_steps, sizes)
+        closest = steps == np.repeat(np.minimum.reduceat(steps, seg_starts), sizes)
+        any_within = np.bincount(np.repeat(np.arange(len(rows)), sizes), within,
+                                 minlength=len(rows)) > 0
+        keep = np.where(np.repeat(any_within, sizes), within, closest)
+        counts = self.cum_counts[followers] - \
+            np.where(followers > 0, self.cum_counts[np.maximum(followers - 1, 0)], 0)
+        cum_weights = np.cumsum(np.where(keep, counts, 0))
+        base = np.where(seg_starts > 0, cum_weights[np.maximum(seg_starts - 1, 0)], 0)
+        seg_ends = seg_starts + sizes - 1
+        target = base + rand * (cum_weights[seg_ends] - base)
+        idx = np.clip(np.searchsorted(cum_weights, target, side='right'), seg_starts, seg_ends)
+        return followers[idx]
@@ -1,73 +1,216 @@
-from nltk.tokenize.regexp import WhitespaceTokenizer
-from collections import Counter
+import threading
+from collections import Counter, OrderedDict
 import numpy as np
 from string import punctuation
+from _code.corpus import as_corpus
+from _code.model_file import pack_strings, make_slots, StringList, StringMap
 
 class TrueCase(object):
-    '''True case from a corpus'''
-
-    def __init__(self, fname):
-        with open(fname, 'r') as f:
-            self.corpus_txt = f.read().decode('utf-8').replace('\n', ' ')
-        self.tokenizer = WhitespaceTokenizer()
-        self.word_list = self.tokenizer.tokenize(self.corpus_txt)
-        self.lower_word_list = [w.lower() for w in self.word_list]
-        self.word_dict_count = Counter(self.word_list)
-
-    def truecase(self, sent):
-        '''Return a true_cased sentence to look well formatted'''
-        if isinstance(sent, basestring):
-            sent = self.tokenizer.tokenize(sent)
-        output = []
+    '''True case from a corpus
+
+    Input: the corpus (a Corpus, or a filename, directory, glob or iterable
+    of documents to read into one), or case_words and case_counts as kept
+    by a MarkovDict (distinct words in order of appearance and their counts)
+
+    case_map takes a lowercase word to the case it appears in most
+    (None keeps the word as given), words never seen in lower, capital
+    or all caps map to their first appearance. first_case is that first
+    appearance for every lowercase word, unknown words fall back to it
+    with the punctuation stripped
+    Whole sentences go through an LRU cache of cache_size results
+    to_arrays() stores both maps in a model file and from_arrays() maps
+    them back without counting the words again'''
+
+    def __init__(self, fname=None, case_words=None, case_counts=None, cache_size=10000):
+        if fname is not None and case_words is None:
+            corpus = as_corpus(fname)
+            case_words = corpus.words
+            case_counts = corpus.case_counts
+        self.word_list = list(case_words)
+        self.case_counts = case_counts
+        self._word_dict_count = None
+        self._make_case_map()
+        self._init_cache(cache_size)
+
+    def _init_cache(self, cache_size):
+        '''Set up an empty sentence cache'''
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def word_dict_count(self):
+        '''Counter of every distinct word of the corpus, counted on first use'''
+        if self._word_dict_count is None:
+            self._word_dict_count = Counter(dict(zip(self.word_list, [int(c) for c in self.case_counts])))
+        return self._word_dict_count
+
+    def to_arrays(self, arrays, prefix):
+        '''Add the arrays of case_map and first_case to arrays'''
+        keys = sorted(self.first_case)
+        arrays[prefix + 'keys'], arrays[prefix + 'key_offsets'] = pack_strings(keys)
+        arrays[prefix + 'forms'], arrays[prefix + 'form_offsets'] = pack_strings(
+            [self.case_map[key] or u'' for key in keys])
+        arrays[prefix + 'first'], arrays[prefix + 'first_offsets'] = pack_strings(
+            [self.first_case[key] for key in keys])
+        arrays[prefix + 'slots'] = make_slots(keys)
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix, case_words, case_counts, cache_size=10000):
+        '''Return a TrueCase over arrays written by to_arrays
+        case_words and case_counts are only read if word_dict_count is used'''
+        tc = cls.__new__(cls)
+        tc.word_list = case_words
+        tc.case_counts = case_counts
+        tc._word_dict_count = None
+        keys = StringList(arrays[prefix + 'keys'], arrays[prefix + 'key_offsets'])
+        slots = arrays[prefix + 'slots']
+        tc.case_map = StringMap(keys, StringList(arrays[prefix + 'forms'], arrays[prefix + 'form_offsets']), slots)
+        tc.first_case = StringMap(keys, StringList(arrays[prefix + 'first'], arrays[prefix + 'first_offsets']), slots)
+        tc._init_cache(cache_size)
+        return tc
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_cache'], state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_cache(self.cache_size)
+
+    def _make_case_map(self):
+        '''Build case_map and first_case from the word counts'''
+        # Only the first appearance of each word matters for the fallback
+        self.first_case = {}
+        for word in self.word_list:
+            self.first_case.setdefault(word.lower(), word)
+
+        self.case_map = {}
+        for lower in self.first_case:
+            self._set_case(lower)
+
+    def _set_case(self, lower):
+        '''Set the case_map entry of a lowercase word from the word counts'''
+        counts = self.word_dict_count
+        all_caps = counts[lower.upper()]
+        capital = counts[lower.capitalize()]
+        lower_count = counts[lower]
         # If it appears capital more often, use that case
-        for word in sent:
-            capital = 0
-            lower = 0
-            all_caps = 0
-            try:
-                lower += self.word_dict_count[word.lower()]
-            except:
-                lower += 0
-            try:
-                capital += self.word_dict_count[word.capitalize()]
-            except:
-                capital += 0
-            try:
-                all_caps += self.word_dict_count[word.upper()]
-            except:
-                all_caps += 0
-
-            # find max of those three options
-            idx = np.argsort([all_caps, capital, lower])[-1]
-
-            # If not found in dictionary, find original case
-            if (all_caps + capital + lower) == 0:
-                try:
-                    i = self.lower_word_list.index(word.lower())
-                    output.append(self.word_list[i])
-                except:
-                    try:
-                        i = self.lower_word_list.index(word.lower().strip(punctuation))
-                        output.append(self.word_list[i])
-                    except:
-                        output.append(word)
-            elif idx == 0:
-                output.append(word.upper())
-            elif idx == 1:
-                output.append(word.capitalize())
-            else:
-                output.append(word)
+        # ties go to lower, then capital
+        if not (all_caps or capital or lower_count):
+            self.case_map[lower] = self.first_case[lower]
+        elif lower_count >= capital and lower_count >= all_caps:
+            self.case_map[lower] = None
+        elif capital >= all_caps:
+            self.case_map[lower] = lower.capitalize()
+        else:
+            self.case_map[lower] = lower.upper()
+
+    def add_words(self, case_words, case_counts, words, counts):
+        '''Return a TrueCase over case_words and case_counts, which are this
+        one's with words (in order of appearance) and their counts added
+        The maps are copied and only the lowercase forms of words are cased
+        again, a TrueCase read from a model file is rebuilt'''
+        if not isinstance(self.case_map, dict):
+            return TrueCase(case_words=case_words, case_counts=case_counts, cache_size=self.cache_size)
+        tc = TrueCase.__new__(TrueCase)
+        tc.word_list = list(case_words)
+        tc.case_counts = case_counts
+        tc._word_dict_count = self.word_dict_count.copy()
+        tc._word_dict_count.update(dict(zip(words, [int(c) for c in counts])))
+        tc.first_case = dict(self.first_case)
+        tc.case_map = dict(self.case_map)
+        lowers = set()
+        for word in words:
+            lower = word.lower()
+            tc.first_case.setdefault(lower, word)
+            lowers.add(lower)
+        for lower in lowers:
+            tc._set_case(lower)
+        tc._init_cache(self.cache_size)
+        return tc
 
+    def _case_word(self, word):
+        '''Return word in its preferred case'''
+        lower = word.lower()
+        if lower not in self.case_map:
+            return self.first_case.get(lower.strip(punctuation), word)
+        form = self.case_map[lower]
+        return word if form is None else form
+
+    def _join(self, output):
+        '''Return the sentence string of a list of true cased words'''
         # sometimes sentence delimiters get picked up in the middle of words
         # they should only go at the end
         sent_str = ' '.join([x.strip('!?.') for x in output[:-1]]) + ' ' + output[-1]
-        sent_str = sent_str[0].upper() + sent_str[1:]
+        return sent_str[0].upper() + sent_str[1:]
 
+    def _cache_get(self, sent):
+        '''Return the cached result for sent or None, marking it recently used'''
+        with self._lock:
+            result = self._cache.pop(sent, None)
+            if result is not None:
+                self._cache[sent] = result
+            return result
+
+    def _cache_set(self, sent, result):
+        '''Cache result, dropping the least recently used when full'''
+        if not self.cache_size:
+            return
+        with self._lock:
+            self._cache[sent] = result
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def truecase(self, sent, key=None):
+        '''Return a true_cased sentence to look well formatted
+        sent may be an iterator, the words are cased as they come and the
+        result is cached under key (sent itself when None)'''
+        if key is None:
+            sent = key = sent if isinstance(sent, basestring) else tuple(sent)
+        sent_str = self._cache_get(key)
+        if sent_str is not None:
+            return sent_str
+        if isinstance(sent, basestring):
+            sent = sent.split()
+        output = []
+        word = None
+        for token in sent:
+            if word is not None:
+                output.append(word.strip('!?.'))
+            word = self._case_word(token)
+        sent_str = ' '.join(output) + ' ' + word
+        sent_str = sent_str[0].upper() + sent_str[1:]
+        self._cache_set(key, sent_str)
         return sent_str
 
     def bulk_truecase(self, list_sent):
-        '''Return a list of true_cased strings from an iterable'''
-        output = []
-        for sent in list_sent:
-            output.append(self.truecase(sent))
+        '''Return a list of true_cased strings from an iterable
+
+        Sentences missing from the cache are cased together: every
+        distinct lowercase word is looked up once and the forms are
+        gathered back into the sentences with array indexing'''
+        keys = [sent if isinstance(sent, basestring) else tuple(sent) for sent in list_sent]
+        output = [self._cache_get(key) for key in keys]
+        todo = [idx for idx, sent_str in enumerate(output) if sent_str is None]
+        if not todo:
+            return output
+
+        sents = [keys[idx].split() if isinstance(keys[idx], basestring)
+                 else list(keys[idx]) for idx in todo]
+        words = np.array([word for sent in sents for word in sent] or [u''], dtype=object)
+        lowers, inverse = np.unique([word.lower() for word in words], return_inverse=True)
+        # None keeps the word as given, unknown words use the stripped fallback
+        forms = np.array([self.case_map[lower] if lower in self.case_map
+                          else self.first_case.get(lower.strip(punctuation), False)
+                          for lower in lowers], dtype=object)[inverse]
+        keep = np.array([form is None or form is False for form in forms], dtype=bool)
+        forms[keep] = words[keep]
+
+        start = 0
+        for idx, sent in zip(todo, sents):
+            output[idx] = self._join(forms[start:start + len(sent)].tolist())
+            self._cache_set(keys[idx], output[idx])
+            start += len(sent)
         return output
@@ -0,0 +1,123 @@
+from array import array
+from bisect import bisect_left
+import numpy as np
+from _code.model_file import pack_strings, StringList
+
+
+class _SortedWords(object):
+    '''Sequence view of the words in sorted order so bisect can search them'''
+
+    def __init__(self, words, order):
+        self.words = words
+        self.order = order
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, idx):
+        return self.words[self.order[idx]]
+
+
+class Vocab(object):
+    '''Intern words and syntax tags as ints
+
+    A token is a word with optional tags (gtype=naive has no tags)
+    Every distinct (word, tags) pair gets a token id, and words and tags
+    get ids of their own so chains can be stored as flat int arrays
+    and decoded to strings only at the end
+
+    A vocab loaded from a model file looks words up by bisecting a sorted
+    order instead of building dicts, the dicts are only made by add()'''
+
+    def __init__(self):
+        self.words = []
+        self.tags = []
+        self.token_word = array('i')
+        self.token_tag = array('i')
+        self._word_ids = {}
+        self._tag_ids = {}
+        self._token_ids = {}
+
+    def __len__(self):
+        return len(self.token_word)
+
+    def _intern(self, item, ids, items):
+        '''Return the id of item, adding it if unseen'''
+        idx = ids.get(item)
+        if idx is None:
+            idx = len(items)
+            ids[item] = idx
+            items.append(item)
+        return idx
+
+    def _make_ids(self):
+        '''Build the lookup dicts and mutable lists of a loaded vocab'''
+        self.words = list(self.words)
+        self.token_word = array('i', self.token_word)
+        self.token_tag = array('i', self.token_tag)
+        self._word_ids = dict((word, idx) for idx, word in enumerate(self.words))
+        self._tag_ids = dict((tags, idx) for idx, tags in enumerate(self.tags))
+        self._token_ids = dict(((word_id, tag_id), idx) for idx, (word_id, tag_id)
+                               in enumerate(zip(self.token_word, self.token_tag)))
+
+    def add(self, word, tags=None):
+        '''Return the token id of word with tags, adding it if unseen'''
+        if self._word_ids is None:
+            self._make_ids()
+        word_id = self._intern(word, self._word_ids, self.words)
+        tag_id = -1 if tags is None else self._intern(tags, self._tag_ids, self.tags)
+        token_id = self._token_ids.get((word_id, tag_id))
+        if token_id is None:
+            token_id = len(self.token_word)
+            self._token_ids[(word_id, tag_id)] = token_id
+            self.token_word.append(word_id)
+            self.token_tag.append(tag_id)
+        return token_id
+
+    def word_id(self, word):
+        '''Return the id of word or None'''
+        if self._word_ids is not None:
+            return self._word_ids.get(word)
+        idx = bisect_left(_SortedWords(self.words, self.word_order), word)
+        if idx < len(self.word_order) and self.words[self.word_order[idx]] == word:
+            return int(self.word_order[idx])
+        return None
+
+    def tag_id(self, tags):
+        '''Return the id of a tags tuple or None'''
+        if self._tag_ids is None:
+            return self.tags.index(tags) if tags in self.tags else None
+        return self._tag_ids.get(tags)
+
+    def word(self, token_id):
+        '''Return the word of a token'''
+        return self.words[self.token_word[token_id]]
+
+    def decode(self, token_ids):
+        '''Return the list of words for a list of token ids'''
+        return [self.words[self.token_word[idx]] for idx in token_ids]
+
+    def to_arrays(self, arrays, prefix):
+        '''Add the arrays needed to rebuild the vocab to arrays'''
+        arrays[prefix + 'words'], arrays[prefix + 'word_offsets'] = pack_strings(self.words)
+        arrays[prefix + 'word_order'] = np.array(
+            sorted(xrange(len(self.words)), key=self.words.__getitem__), dtype=np.int32)
+        tags = [' '.join(tags) for tags in self.tags]
+        arrays[prefix + 'tags'], arrays[prefix + 'tag_offsets'] = pack_strings(tags)
+        arrays[prefix + 'token_word'] = np.array(self.token_word, dtype=np.int32)
+        arrays[prefix + 'token_tag'] = np.array(self.token_tag, dtype=np.int32)
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix):
+        '''Return a Vocab backed by arrays written with to_arrays'''
+        vocab = cls.__new__(cls)
+        vocab.words = StringList(arrays[prefix + 'words'], arrays[prefix + 'word_offsets'])
+        vocab.word_order = arrays[prefix + 'word_order']
+        tags = StringList(arrays[prefix + 'tags'], arrays[prefix + 'tag_offsets'])
+        vocab.tags = [tuple(tag_str.split(' ')) for tag_str in tags]
+        vocab.token_word = arrays[prefix + 'token_word']
+        vocab.token_tag = arrays[prefix + 'token_tag']
+        vocab._word_ids = None
+        vocab._tag_ids = None
+        vocab._token_ids = None
+        return vocab
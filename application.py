@@ -1,29 +1,168 @@
-from flask import Flask, request, render_template
-from flask_bootstrap import Bootstrap
-import cPickle as pickle
-from _code.markov_dict import MarkovDict
-from _code.markov_chain import MarkovChain
+import argparse
+import random
+import time
+from flask import Flask, request, render_template, jsonify, abort
+from _code import metrics as stage_metrics
+from _code.model_registry import ModelRegistry
+from _code.sentence_pool import SentencePool
+from _code.batcher import Batcher, Overloaded, BatchTimeout
 
 
 app = Flask(__name__)
+# Set in __main__, one MarkovChain per model file in --models
+registry = None
+# Model served when a request names no corpus
+DEFAULT_CORPUS = 'obama'
+# Set by running with --pool, pools sentences of the default corpus
+pool = None
+# Seconds a /recommend call may spend generating before it falls back
+DEADLINE = 0.25
+# Most tokens of a /recommend sentence
+MAX_TOKENS = 100
+# Most seconds a /recommend/batch call may ask for
+MAX_DEADLINE = 2.0
+# Most seeds and sentences per seed of a /recommend/batch call
+MAX_SEEDS = 100
+MAX_PER_SEED = 100
+# Set by running with --batch-window, coalesces /recommend calls into batches
+batcher = None
+
+def get_param(params, name, cast, default=None, low=None, high=None):
+    '''Return params[name] cast to a number, default when it is missing
+    or null, 400 if it is not a number or outside low and high'''
+    value = params.get(name)
+    if value is None:
+        return default
+    try:
+        value = cast(value)
+    except (TypeError, ValueError):
+        abort(400)
+    if (low is not None and value < low) or (high is not None and value > high):
+        abort(400)
+    return value
+
+def get_chain(corpus):
+    '''Return the MarkovChain of a corpus, 404 if there is no such model'''
+    try:
+        return registry.get(corpus or DEFAULT_CORPUS)
+    except KeyError:
+        abort(404)
 
 @app.route("/")
 def main():
-    return render_template('index.html')
+    return render_template('index.html', corpora=registry.names(), corpus=DEFAULT_CORPUS)
 
 @app.route("/recommend", methods=['POST'])
 def recommend():
-    user_input = str(request.form['seed'])
-    sent = mc.run(user_input, 2, 1)
+    user_input = request.form['seed']
+    corpus = request.form.get('corpus') or DEFAULT_CORPUS
+    if pool is not None and corpus == DEFAULT_CORPUS:
+        sent = pool.get(user_input)
+    elif batcher is not None:
+        mc = get_chain(corpus)
+        try:
+            sent = batcher.run(mc, user_input, 2, 1)
+        except Overloaded:
+            abort(503)
+        except BatchTimeout:
+            sent = random.choice(mc.not_found_list)
+    else:
+        sent = get_chain(corpus).run(user_input, 2, 1, max_tokens=MAX_TOKENS, deadline=DEADLINE)
 
-    return render_template('index.html', recommend=True, sent=sent)
+    return render_template('index.html', recommend=True, sent=sent,
+                           corpora=registry.names(), corpus=corpus)
 
-if __name__ == '__main__':
+@app.route("/recommend/batch", methods=['POST'])
+def recommend_batch():
+    '''JSON in: {"seeds": [...], "n_per_seed": 10}, optional corpus,
+    key_gram_size, value_gram_size, max_tokens, deadline in seconds and
+    an int random_state for repeatable output
+    Seeds are strings, at most MAX_SEEDS of them, with at most
+    MAX_PER_SEED sentences per seed, MAX_TOKENS tokens and MAX_DEADLINE
+    seconds (default DEADLINE), 400 past those
+    JSON out: the sentences for each seed and the throughput in
+    sentences per second'''
+    params = request.get_json(force=True)
+    if not isinstance(params, dict):
+        abort(400)
+    seeds = params.get('seeds')
+    if not isinstance(seeds, list) or not 0 < len(seeds) <= MAX_SEEDS or \
+            not all(isinstance(seed, basestring) for seed in seeds):
+        abort(400)
+    n_per_seed = get_param(params, 'n_per_seed', int, 10, 1, MAX_PER_SEED)
+    mc = get_chain(params.get('corpus'))
+    gram_size = mc.markov_dict['gram_size']
+    key_gram_size = get_param(params, 'key_gram_size', int, 2, 1, gram_size)
+    value_gram_size = get_param(params, 'value_gram_size', int, 1, 1, gram_size)
+    random_state = get_param(params, 'random_state', int)
+    max_tokens = get_param(params, 'max_tokens', int, MAX_TOKENS, 1, MAX_TOKENS)
+    deadline = get_param(params, 'deadline', float, DEADLINE, 0, MAX_DEADLINE)
+    if deadline <= 0:
+        abort(400)
+    start = time.time()
+    batch = mc.run_batch(seeds, n_per_seed, key_gram_size, value_gram_size,
+                         random_state=random_state, max_tokens=max_tokens, deadline=deadline)
+    seconds = time.time() - start
+    n_sentences = len(seeds) * n_per_seed
+    return jsonify(sentences=batch, n_sentences=n_sentences, seconds=seconds,
+                   sentences_per_second=n_sentences / seconds if seconds else None)
+
+@app.route("/models")
+def models():
+    return jsonify(**registry.stats())
 
-    with open('data/neighbours.pkl') as f:
-        neighbor_dict = pickle.load(f)
+@app.route("/pool/metrics")
+def pool_metrics():
+    if pool is None:
+        return jsonify(enabled=False)
+    return jsonify(enabled=True, **pool.metrics())
+
+@app.route("/metrics")
+def metrics():
+    '''Stage timers, counters and histograms when run with --metrics,
+    with the model and pool stats; ?reset=1 starts a new window'''
+    recorder = stage_metrics.current()
+    stages = recorder.snapshot() if recorder is not None else None
+    if recorder is not None and request.args.get('reset'):
+        recorder.reset()
+    return jsonify(enabled=recorder is not None, stages=stages, models=registry.stats(),
+                   pool=pool.metrics() if pool is not None else None,
+                   batcher=batcher.metrics() if batcher is not None else None)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models', default='data/models',
+                        help='directory of model files, build them with python -m _code.model_registry')
+    parser.add_argument('--budget', type=int, default=1024,
+                        help='megabytes of models to keep loaded')
+    parser.add_argument('--warm', default=DEFAULT_CORPUS,
+                        help='comma separated models to load at boot, most important first')
+    parser.add_argument('--pool', action='store_true',
+                        help='keep ready sentences for the priority words of the default corpus')
+    parser.add_argument('--batch-window', type=float, default=0,
+                        help='milliseconds to gather /recommend calls into one batch, 0 runs each alone')
+    parser.add_argument('--queue-depth', type=int, default=256,
+                        help='queued /recommend calls before answering 503')
+    parser.add_argument('--workers', type=int, default=2, help='threads running batches')
+    parser.add_argument('--timeout', type=float, default=1.0,
+                        help='seconds a batched /recommend call waits in all')
+    parser.add_argument('--metrics', action='store_true',
+                        help='time every generation stage, served on /metrics')
+    args = parser.parse_args()
 
-    md = MarkovDict('data/obama_corpus.txt', 3, gtype='syntax_pos')
-    mc = MarkovChain(md.api, neighbor_dict)
+    if args.metrics:
+        stage_metrics.enable()
+    registry = ModelRegistry(args.models, args.budget << 20)
+    registry.warm([name for name in args.warm.split(',') if name])
+    if args.pool:
+        # Keep sentences for the priority words ready, refilled in the background
+        # Asks the registry on every refill, so the pool never pins an evicted model
+        pool = SentencePool(lambda: registry.get(DEFAULT_CORPUS), deadline=DEADLINE,
+                            max_tokens=MAX_TOKENS).start()
+    if args.batch_window > 0:
+        batcher = Batcher(args.batch_window / 1000.0, queue_depth=args.queue_depth,
+                          workers=args.workers, timeout=args.timeout, deadline=DEADLINE,
+                          max_tokens=MAX_TOKENS).start()
 
-    app.run(host='0.0.0.0', port=8000, debug=False)
+    # MarkovChain keeps no per-request state, one model serves every thread
+    app.run(host='0.0.0.0', port=8000, debug=False, threaded=True)
@@ -0,0 +1,69 @@
+'''Compare two result files of benchmarks/run.py
+
+python benchmarks/compare.py OLD.json NEW.json [--threshold 1.25]
+Prints every timing and memory number side by side with new / old and
+flags the ones that got worse by more than threshold'''
+import argparse
+import json
+
+# Higher is better for these, everything else is a time or a size
+_HIGHER_BETTER = ('sentences_per_second', 'batch_sentences_per_second')
+_CASE_KEYS = ('bench', 'corpus_name', 'gtype', 'gram_size')
+
+
+def _case_key(result):
+    '''Return what identifies a case across runs'''
+    return tuple(result.get(key) for key in _CASE_KEYS)
+
+
+def _metrics(result, prefix=''):
+    '''Yield (name, value) for every number in a result, nested dicts flattened'''
+    for name, value in sorted(result.iteritems()):
+        if name in _CASE_KEYS:
+            continue
+        if isinstance(value, dict):
+            for item in _metrics(value, prefix + name + '.'):
+                yield item
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield prefix + name, value
+
+
+def compare(old, new, threshold=1.25):
+    '''Return (rows, n_regressions), a row is case, metric, old, new, ratio, worse'''
+    old_results = dict((_case_key(result), result) for result in old['results'])
+    rows = []
+    n_regressions = 0
+    for result in new['results']:
+        key = _case_key(result)
+        if key not in old_results:
+            continue
+        old_metrics = dict(_metrics(old_results[key]))
+        for name, value in _metrics(result):
+            if name not in old_metrics or name in ('n_runs', 'n_per_seed'):
+                continue
+            ratio = value / float(old_metrics[name]) if old_metrics[name] else None
+            worse = False
+            if ratio is not None:
+                worse = ratio < 1 / threshold if name.split('.')[-1] in _HIGHER_BETTER else ratio > threshold
+            n_regressions += worse
+            rows.append((key, name, old_metrics[name], value, ratio, worse))
+    return rows, n_regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=1.25)
+    args = parser.parse_args()
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    rows, n_regressions = compare(old, new, args.threshold)
+    print '%s -> %s' % (old['meta'].get('commit'), new['meta'].get('commit'))
+    for key, name, old_value, new_value, ratio, worse in rows:
+        print '%-45s %-32s %12.4g %12.4g %7s %s' % (
+            ' '.join(str(part) for part in key if part is not None), name, old_value, new_value,
+            '%.2fx' % ratio if ratio is not None else '-', 'WORSE' if worse else '')
+    print '%d regressions past %.2fx' % (n_regressions, args.threshold)
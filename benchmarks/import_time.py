@@ -0,0 +1,80 @@
+'''Cold import time of the modules a worker loads
+
+Every sample runs in a fresh interpreter, so nothing is cached in
+sys.modules, and reports the seconds taken and the third party
+packages the import pulled in
+
+python benchmarks/import_time.py [--repeat 5] [--model data/models/obama.msgm]
+--model also times loading a model file and generating a sentence'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in the child interpreter, prints a json line
+_PROBE = '''
+import json, sys, time
+sys.path.insert(0, %(repo)r)
+start = time.time()
+%(statement)s
+seconds = time.time() - start
+packages = sorted(set(name.split('.')[0] for name, module in sys.modules.items()
+                      if module is not None and 'site-packages' in (getattr(module, '__file__', '') or '')))
+print json.dumps(dict(seconds=seconds, packages=packages))
+'''
+
+TARGETS = [
+    ('markov_chain', 'import _code.markov_chain'),
+    ('model_registry', 'import _code.model_registry'),
+    ('markov_dict', 'import _code.markov_dict'),
+    ('application', 'import application'),
+]
+
+
+def time_statement(statement, repeat):
+    '''Return (list of seconds, third party packages) over repeat fresh interpreters'''
+    samples = []
+    packages = None
+    for _ in xrange(repeat):
+        out = subprocess.check_output([sys.executable, '-c', _PROBE % dict(repo=REPO, statement=statement)],
+                                      cwd=REPO)
+        result = json.loads(out.strip().splitlines()[-1])
+        samples.append(result['seconds'])
+        packages = result['packages']
+    return samples, packages
+
+
+def run(repeat=5, model=None):
+    '''Return {name: dict(median, min, packages)} for every target'''
+    targets = list(TARGETS)
+    if model:
+        targets.append(('serve_model', 'from _code.markov_chain import MarkovChain\n'
+                        'MarkovChain.from_model(%r).run("america", random_state=0)' % model))
+    results = {}
+    for name, statement in targets:
+        try:
+            samples, packages = time_statement(statement, repeat)
+        except subprocess.CalledProcessError:
+            results[name] = dict(error='import failed, a dependency is missing')
+            continue
+        samples.sort()
+        results[name] = dict(median=samples[len(samples) // 2], min=samples[0], packages=packages)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--model', help='model file to load and run from')
+    args = parser.parse_args()
+    results = run(args.repeat, args.model)
+    for name in sorted(results):
+        result = results[name]
+        if 'error' in result:
+            print '%-16s %s' % (name, result['error'])
+        else:
+            print '%-16s %.3fs median %.3fs min  %s' % (name, result['median'], result['min'],
+                                                        ', '.join(result['packages']))
@@ -0,0 +1,268 @@
+'''Benchmark suite for building, loading and generating
+
+Runs on data/obama_corpus.txt, data/sanders_corpus.txt and synthetic
+corpora scaled up from them, and writes every measurement to a json file
+so two commits can be compared with benchmarks/compare.py, cold import
+times come from benchmarks/import_time.py
+
+python benchmarks/run.py [--quick] [--out results.json]
+
+Each case runs in a fresh interpreter so its peak RSS is its own
+Annotation uses benchmarks/stubs.StubAnnotator unless --real-annotator,
+the corpora are copied to a scratch directory so stub annotations never
+land in the annotation cache next to the real corpora'''
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(BENCH_DIR)
+CORPORA = ['data/obama_corpus.txt', 'data/sanders_corpus.txt']
+
+
+def percentiles(samples):
+    '''Return the latency summary of a list of seconds'''
+    import numpy as np
+    samples = np.asarray(samples)
+    return dict(p50=float(np.percentile(samples, 50)), p90=float(np.percentile(samples, 90)),
+                p99=float(np.percentile(samples, 99)), max=float(samples.max()),
+                mean=float(samples.mean()))
+
+
+def peak_rss():
+    '''Return the peak RSS in bytes of this process and of its children'''
+    # ru_maxrss is in kilobytes on Linux
+    return dict(peak_rss_bytes=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                peak_children_rss_bytes=resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024)
+
+
+def bench_build(case):
+    '''Fit a MarkovDict and save it to case['model']'''
+    from _code.markov_dict import MarkovDict
+    start = time.time()
+    md = MarkovDict(case['corpus'], case['gram_size'], gtype=case['gtype'])
+    build_seconds = time.time() - start
+    start = time.time()
+    md.save(case['model'])
+    return dict(build_seconds=build_seconds, save_seconds=time.time() - start,
+                model_bytes=os.path.getsize(case['model']), n_keys=len(md.f_dict),
+                num_sentences=md.stats['num_sentences'], num_words=md.stats['num_words'],
+                unq_words=md.stats['unq_words'])
+
+
+def bench_load(case):
+    '''Time a cold load of a model file into a MarkovChain'''
+    start = time.time()
+    from _code.markov_dict import MarkovDict
+    from _code.markov_chain import MarkovChain
+    import_seconds = time.time() - start
+    start = time.time()
+    md = MarkovDict.load(case['model'])
+    mc = MarkovChain(md.api)
+    return dict(import_seconds=import_seconds, load_seconds=time.time() - start)
+
+
+def bench_run(case):
+    '''MarkovChain.run latency and run_batch throughput on a model file'''
+    from _code.markov_chain import MarkovChain
+    mc = MarkovChain.from_model(case['model'])
+    seeds = mc.priority_list
+    latencies = []
+    for idx in xrange(case['n_runs']):
+        start = time.time()
+        mc.run(seeds[idx % len(seeds)], random_state=idx)
+        latencies.append(time.time() - start)
+    n_batch = case['n_per_seed'] * len(seeds)
+    start = time.time()
+    mc.run_batch(seeds, case['n_per_seed'], random_state=0)
+    batch_seconds = time.time() - start
+    return dict(run_latency=percentiles(latencies),
+                sentences_per_second=len(latencies) / sum(latencies),
+                batch_sentences_per_second=n_batch / batch_seconds)
+
+
+def bench_add(case):
+    '''MarkovDict.add_documents time for batches of new sentences
+    The sentences are the corpus's own with a fifth of the words renamed,
+    so they bring new keys as well as counts for old ones'''
+    import numpy as np
+    import stubs
+    from _code.markov_dict import MarkovDict
+    md = MarkovDict.load(case['model'])
+    rng = np.random.RandomState(0)
+    sents = stubs.sent_tokenize(io.open(case['corpus'], encoding='utf-8').read())
+    # The first add on a loaded model builds its lookup dicts
+    md.add_documents(sents[:1], n_jobs=1)
+    add_seconds = {}
+    for batch_size in case['batch_sizes']:
+        docs = []
+        for sent in sents[rng.randint(max(len(sents) - batch_size, 1)):][:batch_size]:
+            words = sent.split()
+            renamed = rng.random_sample(len(words)) < 0.2
+            docs.append(u' '.join(u'%sx%d' % (word, batch_size) if renamed[idx] and word.isalpha()
+                                  else word for idx, word in enumerate(words)))
+        start = time.time()
+        md.add_documents([u' '.join(docs)], n_jobs=1)
+        add_seconds[str(batch_size)] = time.time() - start
+    return dict(add_seconds=add_seconds, n_keys=len(md.f_dict))
+
+
+def bench_syntax(case):
+    '''SyntaxChain build time and run latency'''
+    import numpy as np
+    from _code.syntax_chain import SyntaxChain
+    start = time.time()
+    sc = SyntaxChain(case['corpus'], case['gtype'])
+    build_seconds = time.time() - start
+    np.random.seed(0)
+    latencies = []
+    for _ in xrange(case['n_runs']):
+        start = time.time()
+        sc.run()
+        latencies.append(time.time() - start)
+    return dict(build_seconds=build_seconds, run_latency=percentiles(latencies),
+                sentences_per_second=len(latencies) / sum(latencies))
+
+
+BENCHES = dict(build=bench_build, load=bench_load, run=bench_run, add=bench_add, syntax=bench_syntax)
+
+
+def run_child(case):
+    '''Run one case in this process and return its measurements'''
+    sys.path.insert(0, REPO)
+    sys.path.insert(0, BENCH_DIR)
+    import stubs
+    splitter = stubs.install(annotator=not case['real_annotator'])
+    result = BENCHES[case['bench']](case)
+    result.update(peak_rss())
+    result['sentence_splitter'] = splitter
+    return result
+
+
+def run_case(case):
+    '''Run one case in a fresh interpreter, return case and measurements'''
+    out = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                   '--child', json.dumps(case)], cwd=REPO)
+    result = dict(case)
+    result.update(json.loads(out.strip().splitlines()[-1]))
+    return result
+
+
+def scale_corpus(fnames, scale, out, seed=0):
+    '''Write a corpus scale times the size of fnames together
+    Each copy after the first renames a fifth of the words, so the vocab
+    and the tables grow with the text instead of repeating it'''
+    import numpy as np
+    rng = np.random.RandomState(seed)
+    text = u' '.join(io.open(os.path.join(REPO, fname), encoding='utf-8').read() for fname in fnames)
+    words = text.split()
+    with io.open(out, 'w', encoding='utf-8') as f:
+        f.write(text)
+        for copy in xrange(1, scale):
+            renamed = rng.random_sample(len(words)) < 0.2
+            f.write(u' ' + u' '.join(u'%s%d' % (word, copy) if renamed[idx] and word.isalpha() else word
+                                      for idx, word in enumerate(words)))
+    return out
+
+
+def git_commit():
+    '''Return the commit the tree is at, None outside git'''
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(args):
+    '''Run every case, return the results document'''
+    import numpy as np
+    scratch = tempfile.mkdtemp(prefix='msg_bench_')
+    results = []
+    try:
+        corpora = []
+        for fname in CORPORA:
+            path = os.path.join(scratch, os.path.basename(fname))
+            shutil.copy(os.path.join(REPO, fname), path)
+            corpora.append((os.path.basename(fname).split('_')[0], path))
+        for scale in args.scales:
+            path = os.path.join(scratch, 'scaled_x%d.txt' % scale)
+            corpora.append(('scaled_x%d' % scale, scale_corpus(CORPORA, scale, path)))
+
+        common = dict(real_annotator=args.real_annotator, n_runs=args.runs,
+                      n_per_seed=args.n_per_seed, batch_sizes=args.batch_sizes)
+        for name, path in corpora:
+            for gtype in args.gtypes:
+                for gram_size in args.gram_sizes:
+                    model = os.path.join(scratch, '%s_%s_%d.msgm' % (name, gtype, gram_size))
+                    base = dict(common, corpus_name=name, corpus=path, gtype=gtype,
+                                gram_size=gram_size, model=model)
+                    for bench in ('build', 'load', 'run', 'add'):
+                        print >> sys.stderr, '%s %s %s gram_size=%d' % (bench, name, gtype, gram_size)
+                        results.append(run_case(dict(base, bench=bench)))
+                    # Annotations are cached per corpus, start the next fit cold
+                    shutil.rmtree(path.rsplit('.', 1)[0] + '_annotations', ignore_errors=True)
+            for gtype in args.syntax_gtypes:
+                print >> sys.stderr, 'syntax %s %s' % (name, gtype)
+                results.append(run_case(dict(common, bench='syntax', corpus_name=name,
+                                             corpus=path, gtype=gtype)))
+                shutil.rmtree(path.rsplit('.', 1)[0] + '_annotations', ignore_errors=True)
+        print >> sys.stderr, 'import'
+        sys.path.insert(0, BENCH_DIR)
+        import import_time
+        for name, result in sorted(import_time.run(args.import_repeat).iteritems()):
+            results.append(dict(result, bench='import', corpus_name=name))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    for result in results:
+        # Scratch paths differ every run
+        result.pop('corpus', None)
+        result.pop('model', None)
+    meta = dict(commit=git_commit(), time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                python=platform.python_version(), numpy=np.__version__,
+                machine=platform.machine(), cpu_count=os.sysconf('SC_NPROCESSORS_ONLN'),
+                annotator='practnlptools' if args.real_annotator else 'stub')
+    return dict(meta=meta, results=results)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == '--child':
+        print json.dumps(run_child(json.loads(sys.argv[2])))
+        sys.exit(0)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--out', help='json file to write, default benchmarks/results/<commit>.json')
+    parser.add_argument('--gtypes', default='naive,syntax_pos')
+    parser.add_argument('--gram-sizes', default='2,3,4')
+    parser.add_argument('--syntax-gtypes', default='syntax')
+    parser.add_argument('--scales', default='4', help='sizes of the synthetic corpora, 0 for none')
+    parser.add_argument('--runs', type=int, default=500, help='MarkovChain.run calls per model')
+    parser.add_argument('--n-per-seed', type=int, default=50)
+    parser.add_argument('--batch-sizes', default='1,10,100,1000',
+                        help='sentences per MarkovDict.add_documents call')
+    parser.add_argument('--import-repeat', type=int, default=5, help='fresh interpreters per import timing')
+    parser.add_argument('--real-annotator', action='store_true', help='annotate with practnlptools')
+    parser.add_argument('--quick', action='store_true', help='naive gram_size 3, no scaled corpus')
+    args = parser.parse_args()
+    args.gtypes = [gtype for gtype in args.gtypes.split(',') if gtype]
+    args.gram_sizes = [int(size) for size in args.gram_sizes.split(',') if size]
+    args.syntax_gtypes = [gtype for gtype in args.syntax_gtypes.split(',') if gtype]
+    args.batch_sizes = [int(size) for size in args.batch_sizes.split(',') if size]
+    args.scales = [int(scale) for scale in args.scales.split(',') if int(scale) > 1]
+    if args.quick:
+        args.gtypes, args.gram_sizes, args.scales, args.runs = ['naive'], [3], [], 200
+
+    doc = run_suite(args)
+    out = args.out or os.path.join(BENCH_DIR, 'results', '%s.json' % (doc['meta']['commit'] or 'latest'))
+    if not os.path.isdir(os.path.dirname(os.path.abspath(out))):
+        os.makedirs(os.path.dirname(os.path.abspath(out)))
+    with open(out, 'w') as f:
+        json.dump(doc, f, indent=2, sort_keys=True)
+    print 'Wrote %d results to %s' % (len(doc['results']), out)
@@ -0,0 +1,105 @@
+'''Deterministic local stand-ins so the benchmarks run on an offline box
+
+install() puts StubAnnotator in place of practnlptools and, when nltk or
+its punkt data is missing, a regex sentence splitter in place of
+sent_tokenize. Both are deterministic, so two runs annotate the same
+corpus the same way, but the tags are only shaped like real ones: the
+timings leave out the cost of the real annotator'''
+import re
+import sys
+import types
+
+_TOKEN = re.compile(r"\w+(?:[-']\w+)*|[^\w\s]", re.UNICODE)
+_SENTENCE_END = re.compile(r'(?<=[.!?])\s+', re.UNICODE)
+
+_CLOSED = dict(
+    DT='a an the this that these those every each some any no',
+    IN='of in to for with on at by from about as into over after before under between through',
+    PRP='i you he she it we they me him her us them',
+    CC='and but or nor so yet',
+    MD='will would can could should must may might shall',
+    VBZ='is has does',
+    VBP='are have do am',
+    VBD='was were had did',
+    RB='not very also just now then there here too never always',
+)
+_WORD_TAGS = dict((word, tag) for tag, words in _CLOSED.items() for word in words.split())
+_SUFFIXES = [('ing', 'VBG'), ('ed', 'VBD'), ('ly', 'RB'), ('tion', 'NN'), ('s', 'NNS'),
+             ('al', 'JJ'), ('ive', 'JJ'), ('ous', 'JJ')]
+_CHUNKS = dict(DT='NP', PRP='NP', NN='NP', NNS='NP', NNP='NP', CD='NP', JJ='NP',
+               IN='PP', MD='VP', VBZ='VP', VBP='VP', VBD='VP', VBG='VP', RB='ADVP')
+
+
+def pos_tag(token):
+    '''Return a part of speech for a token from its spelling alone'''
+    lower = token.lower()
+    if lower in _WORD_TAGS:
+        return _WORD_TAGS[lower]
+    if not token[0].isalnum():
+        return '.' if token in '.!?' else ','
+    if token[0].isdigit():
+        return 'CD'
+    if token[0].isupper():
+        return 'NNP'
+    for suffix, tag in _SUFFIXES:
+        if lower.endswith(suffix) and len(lower) > len(suffix) + 2:
+            return tag
+    return 'NN'
+
+
+class StubAnnotator(object):
+    '''practnlptools.tools.Annotator with rule based pos and chunk tags'''
+
+    def getAnnotations(self, sent, dep_parse=False):
+        tokens = _TOKEN.findall(sent)
+        pos = [(token, pos_tag(token)) for token in tokens]
+        chunk = []
+        prev = None
+        for token, tag in pos:
+            phrase = _CHUNKS.get(tag)
+            if phrase is None:
+                chunk.append((token, 'O'))
+            else:
+                chunk.append((token, ('I-' if phrase == prev else 'B-') + phrase))
+            prev = phrase
+        return dict(pos=pos, chunk=chunk, syntax_tree='', srl=[], ner=[], words=tokens)
+
+    def getBatchAnnotations(self, sentences, dep_parse=False):
+        return [self.getAnnotations(sent, dep_parse) for sent in sentences]
+
+
+def sent_tokenize(text):
+    '''Split text after . ! or ? followed by whitespace'''
+    return [sent for sent in _SENTENCE_END.split(text.strip()) if sent]
+
+
+def _module(name):
+    '''Return the module called name, a new empty one if it can't be imported'''
+    try:
+        __import__(name)
+        return sys.modules[name]
+    except ImportError:
+        module = types.ModuleType(name)
+        sys.modules[name] = module
+        return module
+
+
+def install(annotator=True):
+    '''Put the stubs in place, return the name of the sentence splitter used
+    Call before anything annotates, forked workers inherit the stubs'''
+    if annotator:
+        package = types.ModuleType('practnlptools')
+        tools = types.ModuleType('practnlptools.tools')
+        tools.Annotator = StubAnnotator
+        package.tools = tools
+        sys.modules['practnlptools'] = package
+        sys.modules['practnlptools.tools'] = tools
+    try:
+        import nltk
+        nltk.data.find('tokenizers/punkt')
+        return 'nltk'
+    except (ImportError, LookupError):
+        tokenize = _module('nltk.tokenize')
+        tokenize.sent_tokenize = sent_tokenize
+        _module('nltk').tokenize = tokenize
+        return 'regex'
@@ -0,0 +1,72 @@
+'''Requests gathered in one window share one run_batch call
+
+python -m unittest discover tests'''
+import os
+import sys
+import threading
+import unittest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from _code.batcher import Batcher
+
+
+class FakeChain(object):
+    '''Records its calls, a sentence is the input text and its number'''
+
+    def __init__(self):
+        self.calls = []
+
+    def run(self, input_text, *args, **kwargs):
+        self.calls.append(('run', input_text))
+        return '%s 0' % input_text
+
+    def run_batch(self, seeds, n_per_seed, *args, **kwargs):
+        self.calls.append(('run_batch', list(seeds), list(n_per_seed)))
+        return [['%s %d' % (seed, idx) for idx in xrange(n)] for seed, n in zip(seeds, n_per_seed)]
+
+
+class BatcherTest(unittest.TestCase):
+
+    def ask(self, batcher, mc, texts):
+        '''Return the sentences for texts asked from a thread each'''
+        sents = [None] * len(texts)
+
+        def ask_one(idx):
+            sents[idx] = batcher.run(mc, texts[idx])
+        threads = [threading.Thread(target=ask_one, args=(idx,)) for idx in xrange(len(texts))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return sents
+
+    def test_distinct_seeds_one_run_batch(self):
+        mc = FakeChain()
+        batcher = Batcher(window=0.2, workers=1, timeout=5.0, min_batch=4).start()
+        try:
+            texts = ['health', 'war', 'jobs', 'health', 'taxes', 'energy']
+            sents = self.ask(batcher, mc, texts)
+        finally:
+            batcher.stop()
+        self.assertEqual(len(mc.calls), 1)
+        name, seeds, counts = mc.calls[0]
+        self.assertEqual(name, 'run_batch')
+        self.assertEqual(sorted(seeds), ['energy', 'health', 'jobs', 'taxes', 'war'])
+        self.assertEqual(dict(zip(seeds, counts))['health'], 2)
+        self.assertEqual(sorted(sents), ['energy 0', 'health 0', 'health 1', 'jobs 0', 'taxes 0', 'war 0'])
+
+    def test_small_group_runs_one_by_one(self):
+        mc = FakeChain()
+        batcher = Batcher(window=0.2, workers=1, timeout=5.0, min_batch=4).start()
+        try:
+            sents = self.ask(batcher, mc, ['health', 'war'])
+        finally:
+            batcher.stop()
+        self.assertEqual(sorted(call[0] for call in mc.calls), ['run', 'run'])
+        self.assertEqual(sorted(sents), ['health 0', 'war 0'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+'''Sentences generated with copy_len set are whole sentences
+
+python -m unittest discover tests'''
+import os
+import sys
+import unittest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+sys.path.insert(0, os.path.join(REPO, 'benchmarks'))
+import stubs
+stubs.install()
+
+from _code.markov_dict import MarkovDict
+from _code.markov_chain import MarkovChain
+
+SEEDS = ['health', 'america', 'war', 'jobs', 'people', 'economy', 'country', 'time']
+NOT_FOUND = 'Nothing found.'
+
+
+class OriginalityTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        md = MarkovDict(os.path.join(REPO, 'data', 'obama_corpus.txt'), 3, gtype='naive', copy_len=8)
+        cls.mc = MarkovChain(md.api, not_found_list=[NOT_FOUND])
+
+    def assertWhole(self, sents):
+        for sent in sents:
+            self.assertIn(sent.rstrip()[-1:], '.!?"\'', sent)
+
+    def test_run_ends_on_end_token(self):
+        self.assertWhole([self.mc.run(SEEDS[idx % len(SEEDS)], random_state=idx) for idx in xrange(200)])
+
+    def test_run_batch_ends_on_end_token(self):
+        for sents in self.mc.run_batch(SEEDS, 25, random_state=0):
+            self.assertEqual(len(sents), 25)
+            self.assertWhole(sents)
+
+    def test_mostly_generated(self):
+        sents = [self.mc.run(SEEDS[idx % len(SEEDS)], random_state=idx) for idx in xrange(200)]
+        self.assertLess(sents.count(NOT_FOUND), 20)
+
+    def test_copy_len_too_short(self):
+        self.assertRaises(ValueError, MarkovDict, os.path.join(REPO, 'data', 'obama_corpus.txt'),
+                          3, gtype='naive', copy_len=4)
+
+    def test_copy_len_value_gram_size(self):
+        md = MarkovDict(os.path.join(REPO, 'data', 'obama_corpus.txt'), 3, gtype='naive', copy_len=5)
+        mc = MarkovChain(md.api)
+        self.assertRaises(ValueError, mc.run, 'health', value_gram_size=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
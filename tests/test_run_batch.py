@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+'''run_batch answers every seed, seeds with no words get not_found sentences
+
+python -m unittest discover tests'''
+import os
+import sys
+import unittest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+sys.path.insert(0, os.path.join(REPO, 'benchmarks'))
+import stubs
+stubs.install()
+
+from _code.markov_dict import MarkovDict
+from _code.markov_chain import MarkovChain
+
+NOT_FOUND = 'Nothing found.'
+
+
+class RunBatchTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        md = MarkovDict(os.path.join(REPO, 'data', 'obama_corpus.txt'), 3, gtype='naive')
+        cls.mc = MarkovChain(md.api, not_found_list=[NOT_FOUND])
+
+    def test_empty_and_punctuation_seeds(self):
+        batch = self.mc.run_batch(['', '?', ' ,. ', 'health'], 3, random_state=0)
+        self.assertEqual(len(batch), 4)
+        for sents in batch[:3]:
+            self.assertEqual(sents, [NOT_FOUND] * 3)
+        self.assertNotIn(NOT_FOUND, batch[3])
+
+    def test_empty_seed_run(self):
+        self.assertEqual(self.mc.run('?!', random_state=0), NOT_FOUND)
+
+    def test_unicode_seeds(self):
+        batch = self.mc.run_batch([u'sant\xe9', u'health – care'], 2, random_state=0)
+        self.assertEqual([len(sents) for sents in batch], [2, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()